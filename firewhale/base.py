@@ -2,13 +2,9 @@
 import json
 from dataclasses import dataclass, field
 from typing import Any
-from nftables import Nftables
 
 from .nf import *
 
-nft = Nftables()
-nft.set_json_output(True)
-
 TABLE_FILTER = "filter"
 FIREWHALE_CHAIN = { "family": "ip", "table": TABLE_FILTER, "name": "firewhale" }
 DOCKER_USER_CHAIN = { "family": "ip", "table": TABLE_FILTER, "name": "DOCKER-USER" }
@@ -104,15 +100,19 @@ allowEstablishedRule = rule_for_chain(FIREWHALE_CHAIN, {
 #     ]
 # })
 
-def initialize_core_chains():
-    for chain in list_table_chains("ip", "filter"):
+def initialize_core_chains(chains=None):
+    """ Creates the Firewhale chain and verdict maps. `chains` may be passed to reuse an existing listing of the filter table """
+    if chains is None:
+        chains = list_table_chains("ip", "filter")
+
+    for chain in chains:
         if chain["name"] == "DOCKER-USER":
             docker_chain = chain
             break
     else:
         raise RuntimeError("DOCKER-USER Chain not found")
 
-    nfc("add table ip filter")
+    nfc({ "add": { "table": { "family": "ip", "name": TABLE_FILTER } } })
 
     chain_maps = [
         {
@@ -167,7 +167,7 @@ def full_cleanup():
 
     print("Removing Container Chains")
     try:
-        container_chains = [ch for ch in list_table_chains("ip", "filter") if ch["name"].startswith("firewhale-container-")]
+        container_chains = [ch for ch in list_table_chains("ip", "filter") if ch["name"].startswith(("firewhale-container-", "firewhale-shared-"))]
         nfc([
             *( { "flush": { "chain": chain } } for chain in container_chains ),
             *( { "delete": { "chain": chain } } for chain in container_chains ),
@@ -0,0 +1,237 @@
+
+import contextlib
+import gc
+import json
+import os
+import time
+from dataclasses import dataclass, asdict
+from typing import Dict, List
+
+from .fakedocker import FakeDockerClient
+
+
+@dataclass
+class Metric:
+    name: str
+    value: float
+    unit: str
+    higher_is_better: bool = False
+    # Absolute changes smaller than this are run-to-run noise and never count as regressions
+    noise: float = 0
+
+    def __str__(self):
+        return f"{self.name:<28} {self.value:>12.3f} {self.unit}"
+
+
+@dataclass
+class BenchEnv:
+    docker: FakeDockerClient
+    backend: 'MemoryNFTBackend'
+    ipmanager: 'IPSetManager'
+
+
+def service_labels(service: str, project: str = "app") -> Dict[str, str]:
+    """ Labels of a typical Compose service with a handful of Firewhale rules, including a service peer """
+    return {
+        "com.docker.compose.project": project,
+        "com.docker.compose.service": service,
+        "firewhale.enabled": "true",
+        "firewhale.outbound-rules": json.dumps([
+            "tcp; db.default; 5432",
+            "tcp; 10.0.0.0/8; 443",
+            "udp; 1.1.1.1; 53",
+        ]),
+        "firewhale.inbound-rules": json.dumps([
+            "tcp; *; 80",
+        ]),
+    }
+
+def fresh_environment(*, latency: float = 0) -> BenchEnv:
+    """ Resets Firewhale's process-wide state onto a fake Docker client and an in-memory NFTables """
+    from ..dockercache import set_docker_client
+    from ..nfbackends import nf_backend_store
+    from ..nfbackends.memory import MemoryNFTBackend
+    from ..ipmanager.base import IPSetManager
+    from ..ipmanager.local import LocalSubscriptionManager
+    from ..container import Container
+    from ..rule import rule_cache
+    from ..shadow import nf_shadow
+
+    docker = FakeDockerClient()
+    set_docker_client(docker)
+
+    backend = MemoryNFTBackend(latency=latency)
+    nf_backend_store.set_backend(backend)
+
+    ipmanager = LocalSubscriptionManager()
+    IPSetManager.instance = ipmanager
+
+    Container.applied_ips.clear()
+    Container.applied_chains.clear()
+    rule_cache.clear()
+    nf_shadow.load([])
+    nf_shadow.loaded = False
+
+    return BenchEnv(docker, backend, ipmanager)
+
+def populate(env: BenchEnv, containers: int):
+    env.docker.run("db", labels=service_labels("db"), networks=["app_default"])
+    for i in range(containers - 1):
+        env.docker.run(f"web-{i}", labels=service_labels(f"web{i % 20}"), networks=["app_default"])
+
+def handle_events(events, *, window: float = 0) -> List[float]:
+    """
+    Feeds Docker events through the cache, the EventCoalescer and a queue the way `serve` does: every event updates
+    the cache as it arrives and is handled from the queue afterwards, so eg a container's `destroy` reaches the cache
+    before its `die` is handled. Returns each event's latency from emission to commit
+    """
+    from queue import SimpleQueue
+    from ..dockercache import container_cache
+    from ..events import EventCoalescer
+    from ..serve import process_docker_event
+
+    queued = SimpleQueue()
+    coalescer = EventCoalescer(queued.put, window=window)
+    # Container ID -> emission times of its events that haven't been handled yet
+    emitted: Dict[str, List[float]] = {}
+    for event in events:
+        container_cache().handle_event(event)
+        emitted.setdefault(event["id"], []).append(event["timeNano"] / 1e9)
+        coalescer.push(event["id"], event["Action"])
+    coalescer.close()
+
+    latencies = []
+    while not queued.empty():
+        event = queued.get()
+        process_docker_event(event)
+        now = time.time()
+        times = emitted[event.container_id]
+        latencies.extend(now - t for t in times[:len(event.events)])
+        del times[:len(event.events)]
+    return latencies
+
+def _percentile(values: List[float], p: float) -> float:
+    values = sorted(values)
+    if not values: return 0
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+def _rss_mb() -> float:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+    except OSError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+@contextlib.contextmanager
+def _quiet():
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+
+# === Scenarios ===
+
+def bench_cold_start(containers: int) -> Metric:
+    """ Time for `initialize_nftables` to set up rules for `containers` already-running containers """
+    from ..serve import initialize_nftables
+
+    with _quiet():
+        env = fresh_environment()
+        populate(env, containers)
+        start = time.perf_counter()
+        initialize_nftables(env.ipmanager)
+        elapsed = time.perf_counter() - start
+    return Metric(f"cold_start_{containers}", elapsed, "s")
+
+def _churn(env: BenchEnv, stream, cycles: int, pool: List[str], counter: List[int]) -> List[float]:
+    """ Replaces the oldest container with a new one `cycles` times, handling the events after each step """
+    latencies = []
+    for _ in range(cycles):
+        name = f"churn-{counter[0]}"
+        counter[0] += 1
+        env.docker.run(name, labels=service_labels(f"web{counter[0] % 20}"), networks=["app_default"])
+        latencies.extend(handle_events(stream.drain()))
+        pool.append(name)
+
+        old = pool.pop(0)
+        env.docker.remove(old)
+        latencies.extend(handle_events(stream.drain()))
+    return latencies
+
+def bench_churn(containers: int, cycles: int) -> List[Metric]:
+    """ Event throughput and latency while containers are replaced one by one on a host running `containers` """
+    from ..serve import initialize_nftables
+
+    with _quiet():
+        env = fresh_environment()
+        populate(env, containers)
+        initialize_nftables(env.ipmanager)
+        stream = env.docker.events()
+
+        pool = [f"web-{i}" for i in range(containers - 1)]
+        start = time.perf_counter()
+        latencies = _churn(env, stream, cycles, pool, [0])
+        elapsed = time.perf_counter() - start
+
+    return [
+        Metric("churn_events_per_s", len(latencies) / elapsed, "events/s", higher_is_better=True),
+        Metric("churn_latency_p50", _percentile(latencies, 50) * 1000, "ms"),
+        Metric("churn_latency_p99", _percentile(latencies, 99) * 1000, "ms"),
+    ]
+
+def bench_memory(containers: int, cycles: int) -> Metric:
+    """ Resident memory growth over a long churn run, after a warm-up round """
+    from ..serve import initialize_nftables
+
+    with _quiet():
+        env = fresh_environment()
+        populate(env, containers)
+        initialize_nftables(env.ipmanager)
+        stream = env.docker.events()
+
+        pool = [f"web-{i}" for i in range(containers - 1)]
+        counter = [0]
+        _churn(env, stream, min(cycles, 200), pool, counter)
+        gc.collect()
+        before = _rss_mb()
+        _churn(env, stream, cycles, pool, counter)
+        gc.collect()
+        after = _rss_mb()
+
+    return Metric(f"memory_growth_{cycles}_cycles", after - before, "MiB", noise=2)
+
+def run_suite(*, cold_start_sizes: List[int] = (100, 1000, 5000), churn_containers: int = 200, churn_cycles: int = 500, memory_cycles: int = 2000) -> List[Metric]:
+    metrics = []
+    for size in cold_start_sizes:
+        metrics.append(bench_cold_start(size))
+    metrics.extend(bench_churn(churn_containers, churn_cycles))
+    if memory_cycles:
+        metrics.append(bench_memory(churn_containers, memory_cycles))
+    return metrics
+
+
+# === Baselines ===
+
+def save_baseline(path: str, metrics: List[Metric]):
+    with open(path, "w") as f:
+        json.dump({ "metrics": [asdict(m) for m in metrics] }, f, indent=2)
+
+def load_baseline(path: str) -> Dict[str, Metric]:
+    with open(path) as f:
+        data = json.load(f)
+    return { m["name"]: Metric(**m) for m in data["metrics"] }
+
+def find_regressions(metrics: List[Metric], baseline: Dict[str, Metric], *, threshold: float = 0.25, thresholds: Dict[str, float] = {}) -> List[str]:
+    """ Metrics that are worse than the baseline by more than `threshold` (relative; `thresholds` overrides per metric) """
+    regressions = []
+    for m in metrics:
+        base = baseline.get(m.name)
+        if base is None or abs(m.value - base.value) <= max(m.noise, base.noise) or base.value == 0:
+            continue
+        allowed = thresholds.get(m.name, threshold)
+        change = (m.value - base.value) / abs(base.value)
+        if m.higher_is_better:
+            change = -change
+        if change > allowed:
+            regressions.append(f"{m.name}: {m.value:.3f} {m.unit} vs baseline {base.value:.3f} ({change:.0%} worse, {allowed:.0%} allowed)")
+    return regressions
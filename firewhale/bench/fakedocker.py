@@ -0,0 +1,237 @@
+
+import copy
+import ipaddress
+import itertools
+import queue
+import time
+import uuid
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List
+
+import docker.errors
+from docker.models.containers import ContainerCollection
+
+
+@dataclass
+class ScriptedEvent:
+    """ One step of a scripted event stream. `delay` is slept before the step is played """
+    action: str
+    name: str
+    labels: Dict[str, str] = field(default_factory=dict)
+    networks: List[str] = field(default_factory=lambda: ["bridge"])
+    delay: float = 0
+
+
+class _FakeContainers(ContainerCollection):
+    def get(self, container_id):
+        attrs = self.client._inspect(container_id)
+        return self.prepare_model(attrs)
+
+    def list(self, all=False, **kwargs):
+        return [self.prepare_model(a) for a in self.client._all_attrs(all)]
+
+
+class _FakeAPI:
+    def __init__(self, client: 'FakeDockerClient'):
+        self.client = client
+
+    def containers(self, all=False, **kwargs):
+        summaries = []
+        for attrs in self.client._all_attrs(all):
+            summaries.append({
+                "Id": attrs["Id"],
+                "Names": [attrs["Name"]],
+                "Labels": dict(attrs["Config"]["Labels"]),
+                "State": attrs["State"]["Status"],
+                "NetworkSettings": { "Networks": copy.deepcopy(attrs["NetworkSettings"]["Networks"]) },
+            })
+        return summaries
+
+
+class _EventStream:
+    def __init__(self, q: queue.Queue):
+        self._q = q
+
+    def __iter__(self):
+        while True:
+            event = self._q.get()
+            if event is None:
+                return
+            yield event
+
+    def close(self):
+        self._q.put(None)
+
+    def drain(self) -> List[dict]:
+        """ Events published so far, without blocking """
+        events = []
+        while not self._q.empty():
+            event = self._q.get_nowait()
+            if event is not None:
+                events.append(event)
+        return events
+
+
+class FakeDockerClient:
+    """
+    Stand-in for `docker.DockerClient` with the calls Firewhale makes (`info`, `events`, `api.containers`,
+    `containers.get/list/prepare_model`). Containers live in memory, get IPs from per-network subnets,
+    and every change is published on the event stream the same way the Docker daemon reports it.
+    """
+
+    def __init__(self, *, swarm: bool = False, node_id: str = "fake-node"):
+        self.swarm = swarm
+        self.node_id = node_id
+        self.api = _FakeAPI(self)
+        self.containers = _FakeContainers(client=self)
+
+        self._attrs: Dict[str, dict] = {}
+        self._by_name: Dict[str, str] = {}
+        self._streams: List[queue.Queue] = []
+        # Network name -> (network id, subnet)
+        self._networks: Dict[str, tuple] = {}
+        self._free_ips: Dict[str, List[str]] = {}
+        self._next_host: Dict[str, int] = {}
+        self._subnets = (ipaddress.ip_network(f"10.{i}.0.0/16") for i in itertools.count(1))
+
+    # === docker.DockerClient ===
+
+    def info(self):
+        return {
+            "ID": self.node_id,
+            "Swarm": { "LocalNodeState": "active" if self.swarm else "inactive" },
+        }
+
+    def events(self, decode=True, filters=None):
+        q = queue.Queue()
+        self._streams.append(q)
+        return _EventStream(q)
+
+    def close(self):
+        for q in self._streams:
+            q.put(None)
+
+    # === Scripting ===
+
+    def create(self, name: str, *, labels: Dict[str, str] = None, networks: Iterable[str] = ("bridge",)) -> str:
+        cid = uuid.uuid4().hex + uuid.uuid4().hex
+        self._attrs[cid] = {
+            "Id": cid,
+            "Name": f"/{name}",
+            "Config": { "Labels": dict(labels or {}) },
+            "State": { "Status": "created", "Running": False },
+            "NetworkSettings": { "Networks": {
+                net: { "NetworkID": self._network(net)[0], "IPAddress": "", "IPPrefixLen": 0 } for net in networks
+            } },
+        }
+        self._by_name[name] = cid
+        self._emit("create", cid)
+        return cid
+
+    def start(self, name_or_id: str):
+        attrs = self._inspect(name_or_id, copy_attrs=False)
+        for net_name, net in attrs["NetworkSettings"]["Networks"].items():
+            _, subnet = self._network(net_name)
+            net["IPAddress"] = self._allocate_ip(net_name)
+            net["IPPrefixLen"] = subnet.prefixlen
+        attrs["State"] = { "Status": "running", "Running": True }
+        self._emit("start", attrs["Id"])
+
+    def stop(self, name_or_id: str):
+        """ Stops the container, which Docker reports as a `die` event """
+        attrs = self._inspect(name_or_id, copy_attrs=False)
+        for net_name, net in attrs["NetworkSettings"]["Networks"].items():
+            if net["IPAddress"]:
+                self._free_ips[net_name].append(net["IPAddress"])
+            net["IPAddress"] = ""
+            net["IPPrefixLen"] = 0
+        attrs["State"] = { "Status": "exited", "Running": False }
+        self._emit("die", attrs["Id"])
+
+    def remove(self, name_or_id: str):
+        attrs = self._inspect(name_or_id, copy_attrs=False)
+        if attrs["State"]["Running"]:
+            self.stop(name_or_id)
+        del self._attrs[attrs["Id"]]
+        self._by_name.pop(attrs["Name"].lstrip("/"), None)
+        self._emit("destroy", attrs["Id"], attrs=attrs)
+
+    def run(self, name: str, **kwargs) -> str:
+        cid = self.create(name, **kwargs)
+        self.start(cid)
+        return cid
+
+    def play(self, script: Iterable[ScriptedEvent]):
+        """ Applies the steps of a script in order, publishing the resulting events """
+        for step in script:
+            if step.delay:
+                time.sleep(step.delay)
+            if step.action == "create":
+                self.create(step.name, labels=step.labels, networks=step.networks)
+            elif step.action == "run":
+                self.run(step.name, labels=step.labels, networks=step.networks)
+            elif step.action == "start":
+                self.start(step.name)
+            elif step.action in ("stop", "die"):
+                self.stop(step.name)
+            elif step.action in ("remove", "destroy"):
+                self.remove(step.name)
+            else:
+                raise ValueError(f"Unknown scripted action: {step.action}")
+
+    # === Internals ===
+
+    def _network(self, name: str):
+        if name not in self._networks:
+            self._networks[name] = (uuid.uuid4().hex, next(self._subnets))
+            self._free_ips[name] = []
+            # .1 is the gateway
+            self._next_host[name] = 2
+        return self._networks[name]
+
+    def _allocate_ip(self, net_name: str) -> str:
+        free = self._free_ips[net_name]
+        if free:
+            return free.pop(0)
+        _, subnet = self._networks[net_name]
+        host = self._next_host[net_name]
+        if host >= subnet.num_addresses - 1:
+            raise RuntimeError(f"Network {net_name} is full")
+        self._next_host[net_name] = host + 1
+        return str(subnet.network_address + host)
+
+    def _find(self, name_or_id: str) -> str:
+        if name_or_id in self._attrs:
+            return name_or_id
+        if name_or_id in self._by_name:
+            return self._by_name[name_or_id]
+        for cid in self._attrs:
+            if cid.startswith(name_or_id):
+                return cid
+        raise docker.errors.NotFound(f"No such container: {name_or_id}")
+
+    def _inspect(self, name_or_id: str, *, copy_attrs: bool = True) -> dict:
+        attrs = self._attrs[self._find(name_or_id)]
+        return copy.deepcopy(attrs) if copy_attrs else attrs
+
+    def _all_attrs(self, all: bool) -> List[dict]:
+        return [copy.deepcopy(a) for a in self._attrs.values() if all or a["State"]["Running"]]
+
+    def _emit(self, action: str, cid: str, *, attrs: dict = None):
+        attrs = attrs or self._attrs[cid]
+        now = time.time()
+        event = {
+            "Type": "container",
+            "Action": action,
+            "status": action,
+            "id": cid,
+            "Actor": { "ID": cid, "Attributes": {
+                **attrs["Config"]["Labels"],
+                "name": attrs["Name"].lstrip("/"),
+                "image": "fake",
+            } },
+            "time": int(now),
+            "timeNano": int(now * 1e9),
+        }
+        for q in self._streams:
+            q.put(event)
@@ -0,0 +1,74 @@
+
+import itertools
+import time
+from dataclasses import dataclass
+from typing import List
+
+from .churn import _percentile, _quiet, fresh_environment
+
+
+@dataclass
+class IPManagerBenchResult:
+    ips: int
+    publish_time: float
+    die_time: float
+    lookup_time: float
+
+    def __str__(self):
+        return (
+            f"{self.ips:>7} IPs  publish {self.publish_time * 1e6:8.1f}us"
+            f"  die {self.die_time * 1e6:8.1f}us  list_container_ips {self.lookup_time * 1e6:8.1f}us"
+        )
+
+
+def _ip(n: int) -> str:
+    return f"10.{(n >> 16) & 255}.{(n >> 8) & 255}.{n & 255}"
+
+def bench_local_manager(ips: int, *, events: int = 500, ips_per_container: int = 2, services: int = 50) -> IPManagerBenchResult:
+    """
+    Median per-event cost of the local manager with `ips` IPs published: a container starting (publishing its IPs),
+    one dying (removing them) and a `list_container_ips` lookup. Every service is subscribed, so set updates
+    are committed to the in-memory NFTables too.
+    """
+    from ..base import initialize_core_chains
+
+    env = fresh_environment()
+    manager = env.ipmanager
+    counter = itertools.count(1)
+
+    def container_entries(cid: str, n: int):
+        service = f"svc{n % services}.net"
+        return [(service, _ip(next(counter)), cid) for _ in range(ips_per_container)]
+
+    publish, die, lookup = [], [], []
+    with _quiet():
+        initialize_core_chains()
+        for s in range(services):
+            manager.subscribe_service(f"svc{s}.net", "peer")
+
+        live = [f"c{i}" for i in range(ips // ips_per_container)]
+        manager.add_service_ips(e for n, cid in enumerate(live) for e in container_entries(cid, n))
+
+        # Replace the oldest container each round, so the number of IPs stays the same
+        for i in range(events):
+            cid = f"n{i}"
+            entries = container_entries(cid, i)
+            start = time.perf_counter()
+            manager.add_service_ips(entries)
+            publish.append(time.perf_counter() - start)
+            live.append(cid)
+
+            oldest = live.pop(0)
+            start = time.perf_counter()
+            manager.list_container_ips(oldest)
+            lookup.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            manager.del_container_ips(oldest)
+            die.append(time.perf_counter() - start)
+
+    return IPManagerBenchResult(len(manager.ips), _percentile(publish, 50), _percentile(die, 50), _percentile(lookup, 50))
+
+def run_ipmanager_benchmark(sizes: List[int] = (100, 1000, 10000), *, events: int = 500) -> List[IPManagerBenchResult]:
+    """ Per-event cost should stay flat as the number of published IPs grows """
+    return [bench_local_manager(ips, events=events) for ips in sizes]
@@ -0,0 +1,111 @@
+
+import time
+from dataclasses import dataclass
+from typing import List
+
+from ..nfbackends import wire
+
+
+@dataclass
+class WireBenchResult:
+    containers: int
+    encoding: str
+    bytes: int
+    encode_time: float
+    decode_time: float
+
+    def __str__(self):
+        return (
+            f"{self.containers:>6} containers  {self.encoding:<13} {self.bytes:>11,} bytes"
+            f"  encode {self.encode_time * 1000:8.2f}ms  decode {self.decode_time * 1000:8.2f}ms"
+        )
+
+
+def synthetic_listing(containers: int, rules_per_chain: int = 8) -> dict:
+    """
+    A `list table ip filter` response shaped like a busy Docker host running Firewhale:
+    Docker's own chains, an inbound and outbound chain per container and both verdict maps.
+    """
+    ruleset = [
+        { "metainfo": { "version": "1.0.9", "release_name": "Old Doc Yak #3", "json_schema_version": 1 } },
+        { "table": { "family": "ip", "name": "filter", "handle": 1 } },
+    ]
+    handle = 2
+
+    def chain(name, **kwargs):
+        nonlocal handle
+        handle += 1
+        ruleset.append({ "chain": { "family": "ip", "table": "filter", "name": name, "handle": handle, **kwargs } })
+
+    def rule(chain_name, expr, comment=None):
+        nonlocal handle
+        handle += 1
+        r = { "family": "ip", "table": "filter", "chain": chain_name, "handle": handle, "expr": expr }
+        if comment:
+            r["comment"] = comment
+        ruleset.append({ "rule": r })
+
+    chain("FORWARD", type="filter", hook="forward", prio=0, policy="drop")
+    chain("DOCKER")
+    chain("DOCKER-USER")
+    chain("firewhale")
+
+    maps = { "outbound": [], "inbound": [] }
+    for i in range(containers):
+        ip = f"10.{(i >> 16) & 255}.{(i >> 8) & 255}.{i & 255}"
+        cid = f"{i:012x}"
+
+        rule("DOCKER", [
+            { "match": { "op": "!=", "left": { "meta": { "key": "iifname" } }, "right": "docker0" } },
+            { "match": { "op": "==", "left": { "payload": { "protocol": "ip", "field": "daddr" } }, "right": ip } },
+            { "match": { "op": "==", "left": { "payload": { "protocol": "tcp", "field": "dport" } }, "right": 8000 + i % 1000 } },
+            { "counter": { "packets": i * 7, "bytes": i * 1500 } },
+            { "accept": None },
+        ])
+
+        for direction, field in (("outbound", "daddr"), ("inbound", "saddr")):
+            name = f"firewhale-container-{cid}-{direction}"
+            chain(name)
+            for r in range(rules_per_chain):
+                rule(name, [
+                    { "match": { "op": "==", "left": { "payload": { "protocol": "ip", "field": "protocol" } }, "right": { "set": ["tcp", "udp"] } } },
+                    { "match": { "op": "==", "left": { "payload": { "protocol": "ip", "field": field } }, "right": { "prefix": { "addr": f"172.{16 + r}.0.0", "len": 16 } } } },
+                    { "match": { "op": "==", "left": { "payload": { "protocol": "th", "field": "dport" } }, "right": 1000 + r } },
+                    { "return": None },
+                ], comment=f"[fw:{(i * 31 + r):012x}] allow {r}")
+            rule(name, [{ "drop": None }])
+            maps[direction].append([ip, { "goto": { "target": name } }])
+
+    for direction, elems in maps.items():
+        handle += 1
+        ruleset.append({ "map": {
+            "family": "ip", "table": "filter", "name": f"firewhale-{direction}", "handle": handle,
+            "type": "ipv4_addr", "map": "verdict", "elem": elems,
+        } })
+
+    return { "nftables": ruleset }
+
+
+def bench_encoding(obj, encoding: str, *, containers: int, rounds: int = 5) -> WireBenchResult:
+    """ Best-of-`rounds` time to encode and decode one message """
+    encode_time = decode_time = float("inf")
+    for _ in range(rounds):
+        start = time.perf_counter()
+        message = wire.encode(obj, encoding)
+        encode_time = min(encode_time, time.perf_counter() - start)
+
+        start = time.perf_counter()
+        wire.decode(message)
+        decode_time = min(decode_time, time.perf_counter() - start)
+
+    size = len(message.encode() if isinstance(message, str) else message)
+    return WireBenchResult(containers, encoding, size, encode_time, decode_time)
+
+def run_wire_benchmark(sizes: List[int] = (50, 500, 2000), *, rules_per_chain: int = 8, rounds: int = 5) -> List[WireBenchResult]:
+    """ Compares every encoding available here on `list` responses for hosts with `sizes` containers """
+    results = []
+    for containers in sizes:
+        response = { "id": 1, "status": "ok", "data": synthetic_listing(containers, rules_per_chain)["nftables"] }
+        for encoding in wire.available_encodings():
+            results.append(bench_encoding(response, encoding, containers=containers, rounds=rounds))
+    return results
@@ -0,0 +1,53 @@
+
+import hashlib
+from threading import RLock
+from typing import Dict, Iterable, List, Set
+
+from .nf import rule_identity
+from .base import CONTAINER_CHAIN_SPECS, TABLE_FILTER
+from .shadow import nf_shadow, CONTAINER_CHAIN_PREFIX
+
+SHARED_CHAIN_PREFIX = "firewhale-shared-"
+
+# Held while deciding whether a shared chain is still referenced and committing the result,
+#   so that one container can't start using a chain that another container's teardown is deleting
+chain_lock = RLock()
+
+
+def shared_chain_name(spec_name: str, rules: List[dict]) -> str:
+    """ Content-addressed chain name: containers with identical compiled rules get the same chain """
+    digest = hashlib.sha1("\n".join(rule_identity(r) for r in rules).encode()).hexdigest()[:16]
+    return f"{SHARED_CHAIN_PREFIX}{digest}-{spec_name}"
+
+def is_container_chain(name: str) -> bool:
+    return name.startswith(CONTAINER_CHAIN_PREFIX) or name.startswith(SHARED_CHAIN_PREFIX)
+
+def chain_references(name: str, *, removed: Dict[str, Set[str]] = {}, added: Dict[str, Dict[str, str]] = {}) -> int:
+    """
+    Number of verdict map elements that jump to the chain.
+    `removed` (map -> IPs) and `added` (map -> IP -> target chain) account for changes that are about to be committed.
+    """
+    count = 0
+    for cdef in CONTAINER_CHAIN_SPECS:
+        ips = nf_shadow.map_ips_for_chain(cdef.map_name, name) - removed.get(cdef.map_name, set())
+        ips |= set(ip for ip, target in added.get(cdef.map_name, {}).items() if target == name)
+        count += len(ips)
+    return count
+
+def unreferenced_chains(candidates: Iterable[str] = None, **kwargs) -> List[dict]:
+    """ Container/shared chains (of `candidates`, or all known) that no map element jumps to """
+    if candidates is None:
+        candidates = [name for name in nf_shadow.chain_names() if is_container_chain(name)]
+
+    chains = []
+    for name in set(candidates):
+        if not is_container_chain(name) or not nf_shadow.has_chain(name): continue
+        if chain_references(name, **kwargs) == 0:
+            chains.append({ "family": "ip", "table": TABLE_FILTER, "name": name })
+    return chains
+
+def delete_chain_commands(chains: List[dict]) -> List[dict]:
+    return [
+        *( { "flush": { "chain": chain } } for chain in chains ),
+        *( { "delete": { "chain": chain } } for chain in chains ),
+    ]
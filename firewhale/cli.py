@@ -2,23 +2,70 @@ import typer
 from typing_extensions import Annotated
 
 app = typer.Typer(no_args_is_help=True, add_completion=False)
+bench_app = typer.Typer(no_args_is_help=True, help="Benchmarks for tuning Firewhale")
+app.add_typer(bench_app, name="bench")
 
 @app.command()
 def run(
     nfagent: Annotated[bool, typer.Option(show_default="If Swarm")] = None,
     redis: Annotated[bool, typer.Option(show_default="If Swarm")] = None,
+    reconcile: Annotated[bool, typer.Option(help="Build the whole ruleset in memory and commit it atomically on startup/reconnect")] = True,
+    reconcile_chunk: Annotated[int, typer.Option(help="Max commands per reconcile transaction", show_default="Unlimited")] = None,
+    event_window: Annotated[float, typer.Option(help="Seconds to wait for further Docker events for a container before handling them. 0 disables coalescing")] = 0.25,
+    use_asyncio: Annotated[bool, typer.Option("--asyncio/--threaded", help="Handle events for different containers concurrently on an asyncio loop")] = False,
+    concurrency: Annotated[int, typer.Option(help="Max containers handled at once in asyncio mode")] = 8,
+    shadow_verify_interval: Annotated[float, typer.Option(help="Seconds between checks of the in-memory NFTables mirror against the kernel. 0 disables")] = 300,
+    shared_chains: Annotated[bool, typer.Option("--shared-chains/--per-container-chains", help="Share one chain between containers with identical rules")] = True,
+    compact_rules: Annotated[bool, typer.Option("--compact-rules/--linear-rules", help="Compile rules with the same verdict into one concatenated set lookup (needs kernel 5.6+)")] = False,
+    netlink: Annotated[bool, typer.Option(help="Send element, chain and simple rule updates as raw netlink batches instead of through libnftables (local mode)")] = False,
+    metrics_listen: Annotated[str, typer.Option(help="Serve Prometheus metrics on `[host]:port` or `unix:/path/to/socket`", show_default="Disabled")] = None,
+    trace_export: Annotated[str, typer.Option(help="Export tracing spans to `file:/path` or an OTLP/HTTP collector URL (needs firewhale[tracing])", show_default="Disabled")] = None,
+    redis_pattern_subscribe: Annotated[bool, typer.Option(help="Listen for service IP changes with one `changes:service:*` pattern subscription instead of one channel per service. Better with many subscribed services")] = False,
+    set_batch_window: Annotated[float, typer.Option(help="Seconds to collect service IP changes from other nodes before committing them as one transaction. 0 commits each change on its own")] = 0.05,
+    redis_cache_size: Annotated[int, typer.Option(help="Service membership lists to cache from Redis. 0 disables the cache")] = 1024,
+    gc_interval: Annotated[int, typer.Option(help="Seconds between sweeps for stale chains, map elements and service sets. 0 disables")] = 60,
+    gc_budget: Annotated[int, typer.Option(help="Max commands in a sweep's transaction - larger backlogs are spread over several sweeps")] = 500,
 ):
     """ Start Firewhale """
     from .serve import serve
-    serve(nfagent=nfagent, redis_url=redis)
+    serve(
+        nfagent=nfagent, redis_url=redis,
+        reconcile=reconcile, reconcile_chunk=reconcile_chunk,
+        event_window=event_window,
+        use_asyncio=use_asyncio, concurrency=concurrency,
+        shadow_verify_interval=shadow_verify_interval,
+        shared_chains=shared_chains,
+        compact_rules=compact_rules,
+        netlink=netlink,
+        metrics_listen=metrics_listen,
+        trace_export=trace_export,
+        redis_pattern_subscribe=redis_pattern_subscribe,
+        set_batch_window=set_batch_window,
+        redis_cache_size=redis_cache_size,
+        gc_interval=gc_interval,
+        gc_budget=gc_budget,
+    )
     pass
 
 @app.command()
-def nfagent():
+def nfagent(
+    group_commit: Annotated[bool, typer.Option(help="Join commands that arrive close together into one NFTables transaction")] = True,
+    group_window: Annotated[float, typer.Option(help="Seconds to wait for further commands to join a transaction. 0 only joins commands that are already queued")] = 0.005,
+    max_batch: Annotated[int, typer.Option(help="Max commands joined into one transaction")] = 1000,
+    stats_interval: Annotated[float, typer.Option(help="Seconds between commit stats reports. 0 disables")] = 60,
+    netlink: Annotated[bool, typer.Option(help="Send element, chain and simple rule updates as raw netlink batches instead of through libnftables")] = False,
+    metrics_listen: Annotated[str, typer.Option(help="Serve Prometheus metrics on `[host]:port` or `unix:/path/to/socket`", show_default="Disabled")] = None,
+    trace_export: Annotated[str, typer.Option(help="Export tracing spans to `file:/path` or an OTLP/HTTP collector URL (needs firewhale[tracing])", show_default="Disabled")] = None,
+):
     """ Run Firewhale's NFAgent - a small service to handle proxying NFTables commands from inside to outside Swarm """
     from .serve import serve_nfagent
     import asyncio
-    asyncio.run(serve_nfagent())
+    asyncio.run(serve_nfagent(
+        group_commit=group_commit, group_window=group_window,
+        max_batch=max_batch, stats_interval=stats_interval,
+        netlink=netlink, metrics_listen=metrics_listen,
+        trace_export=trace_export,
+    ))
 
 @app.command("full-cleanup")
 def full_cleanup():
@@ -33,5 +80,58 @@ def full_cleanup():
 
     full_cleanup()
 
+@bench_app.command("wire")
+def bench_wire(
+    containers: Annotated[list[int], typer.Option("--containers", "-c", help="Container counts to simulate (repeatable)")] = [50, 500, 2000],
+    rules_per_chain: Annotated[int, typer.Option(help="Rules in each simulated container chain")] = 8,
+    rounds: Annotated[int, typer.Option(help="Runs per measurement (best is reported)")] = 5,
+):
+    """ Compare the size and encode/decode time of agent wire encodings for `list` responses """
+    from .bench.wire import run_wire_benchmark
+    from .nfbackends import wire
+    print(f"Available encodings: {', '.join(wire.available_encodings())}")
+    for result in run_wire_benchmark(containers, rules_per_chain=rules_per_chain, rounds=rounds):
+        print(result)
+
+@bench_app.command("churn")
+def bench_churn(
+    sizes: Annotated[list[int], typer.Option("--size", "-s", help="Container counts for the cold start benchmark (repeatable)")] = [100, 1000, 5000],
+    containers: Annotated[int, typer.Option(help="Running containers during the churn benchmarks")] = 200,
+    cycles: Annotated[int, typer.Option(help="Container replacements in the churn benchmark")] = 500,
+    memory_cycles: Annotated[int, typer.Option(help="Container replacements in the memory growth benchmark. 0 skips it")] = 2000,
+    baseline: Annotated[str, typer.Option(help="JSON baseline to compare against (or to write with --save-baseline)")] = None,
+    save_baseline: Annotated[bool, typer.Option(help="Write the results to --baseline instead of comparing")] = False,
+    threshold: Annotated[float, typer.Option(help="Allowed relative regression against the baseline")] = 0.25,
+):
+    """ Benchmark event handling and cold starts against a fake Docker host and in-memory NFTables """
+    from .bench import churn
+    metrics = churn.run_suite(
+        cold_start_sizes=sizes, churn_containers=containers,
+        churn_cycles=cycles, memory_cycles=memory_cycles,
+    )
+    for m in metrics:
+        print(m)
+
+    if baseline and save_baseline:
+        churn.save_baseline(baseline, metrics)
+        print(f"Saved baseline to {baseline}")
+    elif baseline:
+        regressions = churn.find_regressions(metrics, churn.load_baseline(baseline), threshold=threshold)
+        for r in regressions:
+            print(f"REGRESSION {r}")
+        if regressions:
+            raise typer.Exit(1)
+        print("No regressions against baseline")
+
+@bench_app.command("ipmanager")
+def bench_ipmanager(
+    ips: Annotated[list[int], typer.Option("--ips", "-n", help="Published IP counts to benchmark (repeatable)")] = [100, 1000, 10000],
+    events: Annotated[int, typer.Option(help="Container replacements measured per size")] = 500,
+):
+    """ Measure the local IP manager's per-event cost as the number of published IPs grows """
+    from .bench.ipmanager import run_ipmanager_benchmark
+    for result in run_ipmanager_benchmark(ips, events=events):
+        print(result)
+
 if __name__ == "__main__":
     app()
@@ -5,16 +5,29 @@ import docker.models.containers
 
 import yaml
 from functools import cached_property
+from typing import Dict, List, Set, Tuple
 
 from .nf import *
 from .nfbackends.base import NftError
 from .base import TABLE_FILTER, CONTAINER_CHAIN_SPECS
-from .rule import make_nft_rule, normalize_rule
+from .rule import make_nft_rule, normalize_rule, compact_nft_rules
 from .ipmanager import IPSetManager
 from .util import protected
+from .dockercache import container_cache
+from .shadow import nf_shadow
+from .chains import chain_lock, shared_chain_name, unreferenced_chains, delete_chain_commands
 
 
 class Container:
+    # Point containers with identical rules at one content-addressed chain instead of a chain pair each
+    shared_chains = True
+    # Fold runs of rules with the same verdict into concatenated set lookups (needs kernel 5.6+)
+    compact_rules = False
+    # Container ID -> IPs mapped at the last successful apply
+    applied_ips: Dict[str, Set[str]] = {}
+    # Container ID -> chains its IPs were pointed at by the last successful apply
+    applied_chains: Dict[str, Set[str]] = {}
+
     def __init__(self, container_id: str | docker.models.containers.Container) -> None:
         if isinstance(container_id, docker.models.containers.Container):
             self.docker_container = container_id
@@ -23,24 +36,52 @@ class Container:
         self.container_id = container_id
 
     def handle_event(self, event: str):
-        print(f"Container {self.id} ({self.service_name}) {event}")
         if event == "create" or event == "start":
+            print(f"Container {self.id} ({self.service_name}) {event}")
             self.apply_rules()
             self.publish_ips()
         elif event == "die":
+            # The container may be gone already - tearing down only needs the ID
+            print(f"Container {self.id} {event}")
             self.destroy_rules()
             self.unpublish_ips()
 
-    def publish_ips(self):
+    async def handle_event_async(self, event: str):
+        """ Like handle_event, but runs blocking work in threads so other containers can progress meanwhile """
+        import asyncio
+
+        if event == "create" or event == "start":
+            # Inspect (or read from cache) off the event loop
+            await asyncio.to_thread(lambda: self.docker_container)
+            print(f"Container {self.id} ({self.service_name}) {event}")
+            # Publishing to Redis doesn't depend on the NFTables transaction, so run them side-by-side
+            await asyncio.gather(
+                asyncio.to_thread(self.apply_rules),
+                asyncio.to_thread(self.publish_ips),
+            )
+        elif event == "die":
+            print(f"Container {self.id} {event}")
+            # IPs must still be known while the rules are destroyed
+            await asyncio.to_thread(self.destroy_rules)
+            await asyncio.to_thread(self.unpublish_ips)
+
+    def published_ips(self) -> List[Tuple[str, str, str]]:
+        """ `(service, ip, cid)` for each network this container's IPs are published on """
         if not self.firewhale_config.get("publish_ips", True):
-            return
+            return []
 
+        entries = []
         docker_nets = self.docker_container.attrs["NetworkSettings"]["Networks"]
         for net_name, net_cfg in docker_nets.items():
             ip = net_cfg["IPAddress"]
             if not ip: continue
-            service = f"{self.service_name}.{net_name}"
-            self.service_manager.add_service_ip(service, ip, self.id)
+            entries.append((f"{self.service_name}.{net_name}", ip, self.id))
+        return entries
+
+    def publish_ips(self):
+        entries = self.published_ips()
+        if entries:
+            self.service_manager.add_service_ips(entries)
 
     def unpublish_ips(self):
         self.service_manager.del_container_ips(self.id)
@@ -52,68 +93,142 @@ class Container:
         if "host" in self.docker_container.attrs["NetworkSettings"]["Networks"]:
             raise ValueError("Container is running in host network mode")
 
-        print(f"Applying rules for container {self.id} ({self.service_name})")
-
-        addrs = self.container_ips()
+        addrs = [addr for addr in self.container_ips() if addr]
         watched_services = set()
         commands = []
 
         if not any(addrs): return
 
-        for cdef in CONTAINER_CHAIN_SPECS:
-            cname = f"{self.chain_prefix}-{cdef.name}"
+        with chain_lock:
+            nf_shadow.ensure_loaded(nfc)
 
-            nfchain = {
-                "family": "ip",
-                "table": TABLE_FILTER,
-                "name": cname,
-            }
+            # Map -> IPs being removed / IP -> new target, for reference counting shared chains
+            removed: Dict[str, Set[str]] = {}
+            added: Dict[str, Dict[str, str]] = {}
+            released = set()
 
-            commands.extend([
-                # Create Container-specific Chains
-                { "add": { "chain": nfchain }},
-                { "flush": { "chain": nfchain }},
-
-                # Add Chains to Maps
-                { "add": { "element": {
+            for cdef in CONTAINER_CHAIN_SPECS:
+                nfchain = {
                     "family": "ip",
                     "table": TABLE_FILTER,
-                    "name": cdef.map_name,
-                    "elem": [
-                        [ addr, { "jump": { "target": cname } } ] for addr in addrs
-                    ],
-                }}}
-            ])
-
-            cfg_rules = self.firewhale_config.get(f"{cdef.config_entry}-rules", [])
-            if isinstance(cfg_rules, str):
-                cfg_rules = [cfg_rules]
-            norm_rules = [normalize_rule(rule) for rule in cfg_rules]
-
-            nft_rules = [
-                make_nft_rule(
-                    rule, self,
-                    addr_type=cdef.rel_addr,
-                    chain=nfchain,
-                    force_counter=False,
-                    referenced_services=watched_services,
-                ) for rule in norm_rules
-            ]
-
-            # Add the default drop rule
-            nft_rules.append(rule_for_chain(nfchain, {
-                "expr": [
-                    { "drop": None },
-                ],
-            }))
-
-            for nfr in nft_rules:
-                commands.append({ "add": { "rule": nfr } })
-
-        for svc in watched_services:
-            self.service_manager.subscribe_service(svc, self.id)
-
-        nfc(commands)
+                    "name": f"{self.chain_prefix}-{cdef.name}",
+                }
+
+                nft_rules = self._compile_chain_rules(cdef, nfchain, watched_services)
+
+                if Container.shared_chains:
+                    nfchain = { **nfchain, "name": shared_chain_name(cdef.name, nft_rules) }
+                    nft_rules = [{ **r, "chain": nfchain["name"] } for r in nft_rules]
+
+                if not nf_shadow.has_chain(nfchain["name"]):
+                    # Create the Chain
+                    commands.append({ "add": { "chain": nfchain }})
+                    commands.extend({ "add": { "rule": nfr } } for nfr in nft_rules)
+                elif not Container.shared_chains:
+                    # Shared chains are content-addressed, so an existing one already has these rules
+                    commands.extend(self._diff_chain(nfchain, nft_rules))
+
+                elem_commands, to_delete, old_targets = self._diff_map_elements(cdef, nfchain["name"], addrs)
+                commands.extend(elem_commands)
+                removed[cdef.map_name] = to_delete
+                added[cdef.map_name] = { addr: nfchain["name"] for addr in addrs }
+                released |= old_targets
+
+            # Chains this container moved away from that nothing else uses any more
+            commands.extend(delete_chain_commands(unreferenced_chains(released, removed=removed, added=added)))
+
+            for svc in watched_services:
+                self.service_manager.subscribe_service(svc, self.id)
+
+            if commands:
+                print(f"Applying rules for container {self.id} ({self.service_name}): {len(commands)} change(s)")
+                nfc(commands)
+
+            # Docker may have handed one of these IPs to us before the previous owner's die was handled
+            for cid, ips in Container.applied_ips.items():
+                if cid != self.id: ips -= set(addrs)
+            Container.applied_ips[self.id] = set(addrs)
+            Container.applied_chains[self.id] = set(target for targets in added.values() for target in targets.values())
+
+    def _compile_chain_rules(self, cdef, nfchain, watched_services):
+        cfg_rules = self.firewhale_config.get(f"{cdef.config_entry}-rules", [])
+        if isinstance(cfg_rules, str):
+            cfg_rules = [cfg_rules]
+        norm_rules = [normalize_rule(rule) for rule in cfg_rules]
+
+        nft_rules = [
+            make_nft_rule(
+                rule, self,
+                addr_type=cdef.rel_addr,
+                chain=nfchain,
+                force_counter=False,
+                referenced_services=watched_services,
+            ) for rule in norm_rules
+        ]
+
+        if Container.compact_rules:
+            nft_rules = compact_nft_rules(nft_rules, addr_type=cdef.rel_addr)
+
+        # Add the default drop rule
+        nft_rules.append(rule_for_chain(nfchain, {
+            "expr": [
+                { "drop": None },
+            ],
+        }))
+
+        return [with_rule_identity(nfr) for nfr in nft_rules]
+
+    def _diff_chain(self, nfchain, nft_rules):
+        """ Commands to bring an existing chain in line with the compiled rules, matching rules by identity """
+        installed = nf_shadow.rules_for_chain(nfchain["name"])
+        if installed is not None and [rule_identity(r) for r in installed] == [rule_identity(r) for r in nft_rules]:
+            return []
+
+        if installed is None or any("handle" not in r for r in installed):
+            # Handles are needed to edit the chain in place - list just this chain
+            installed = list_chain_rules(nfchain)
+            nf_shadow.set_chain_rules(nfchain["name"], installed)
+
+        return diff_chain_rules(nfchain, installed, nft_rules)
+
+    def _previous_ips(self, cdef) -> Set[str]:
+        """ IPs this container had mapped at the last apply """
+        return (
+            Container.applied_ips.get(self.id, set()) |
+            nf_shadow.map_ips_for_chain(cdef.map_name, f"{self.chain_prefix}-{cdef.name}")
+        )
+
+    def _owned_ips(self, cdef, current) -> Set[str]:
+        """ Previous IPs that are still mapped and still jump to a chain this container installed """
+        owned = Container.applied_chains.get(self.id, set()) | { f"{self.chain_prefix}-{cdef.name}" }
+        return set(
+            ip for ip in self._previous_ips(cdef)
+            if ip in current and current[ip].get("jump", {}).get("target") in owned
+        )
+
+    def _diff_map_elements(self, cdef, target, addrs):
+        """
+        Commands to point exactly this container's IPs at `target` in the verdict map.
+        Also returns the IPs being removed and the chains they pointed to.
+        """
+        current = nf_shadow.get_map_elements(cdef.map_name)
+        current_target = lambda ip: (current.get(ip) or {}).get("jump", {}).get("target")
+
+        # IPs that are no longer ours, and our IPs that point at another chain (rules changed, or a reused IP)
+        to_delete = self._owned_ips(cdef, current) - set(addrs)
+        to_delete |= set(a for a in addrs if a in current and current_target(a) != target)
+        to_add = [a for a in addrs if current_target(a) != target]
+
+        commands = []
+        elem_spec = { "family": "ip", "table": TABLE_FILTER, "name": cdef.map_name }
+        if to_delete:
+            commands.append({ "delete": { "element": { **elem_spec, "elem": list(to_delete) } } })
+        if to_add:
+            commands.append({ "add": { "element": {
+                **elem_spec,
+                "elem": [ [ addr, { "jump": { "target": target } } ] for addr in to_add ],
+            }}})
+        return commands, to_delete, set(current_target(ip) for ip in to_delete) - { None }
 
     @protected("Failed to destroy rules")
     def destroy_rules(self):
@@ -121,31 +236,37 @@ class Container:
 
         commands = []
 
-        # TODO Make this more efficient rather than listing all chains
-        cont_chains = [ch for ch in list_table_chains("ip", "filter") if ch["name"].startswith(self.chain_prefix)]
+        with chain_lock:
+            nf_shadow.ensure_loaded(nfc)
 
-        if cont_chains:
-            print(f"Removing rules for container {self.id}")
-
-            addrs = list(self.service_manager.list_container_ips(self.id))
-            if any(addrs):
-                for cdef in CONTAINER_CHAIN_SPECS:
-                    # Remove Container-specific Chains from Maps
+            removed: Dict[str, Set[str]] = {}
+            released = set()
+            for cdef in CONTAINER_CHAIN_SPECS:
+                current = nf_shadow.get_map_elements(cdef.map_name)
+                # An IP that was re-pointed at another container's chain isn't ours to delete any more
+                addrs = self._owned_ips(cdef, current)
+                if any(addrs):
+                    # Remove the Container's IPs from the Maps
                     commands.append({ "delete": { "element": {
                         "family": "ip",
                         "table": TABLE_FILTER,
                         "name": cdef.map_name,
-                        "elem": addrs,
+                        "elem": list(addrs),
                     }}})
+                    removed[cdef.map_name] = addrs
+                    released |= set(current[ip].get("jump", {}).get("target") for ip in addrs) - { None }
+
+            # Container-specific Chains, plus any shared Chains that were only used by this Container
+            chains = { ch["name"]: ch for ch in nf_shadow.chains_for_container(self.id) }
+            chains.update((ch["name"], ch) for ch in unreferenced_chains(released, removed=removed))
+            commands.extend(delete_chain_commands(list(chains.values())))
 
-            # Remove Container-specific Chains
-            for chain in cont_chains:
-                # Remove all Rules from the Chain
-                commands.append({ "flush": { "chain": chain }})
-                # Delete the Chain
-                commands.append({ "delete": { "chain": chain }})
+            if commands:
+                print(f"Removing rules for container {self.id}")
+                nfc(commands)
 
-            nfc(commands)
+            Container.applied_ips.pop(self.id, None)
+            Container.applied_chains.pop(self.id, None)
 
         self.service_manager.unsubscribe_all_services(self.id)
 
@@ -182,7 +303,7 @@ class Container:
 
     @cached_property
     def docker_container(self):
-        return docker.from_env().containers.get(self.container_id)
+        return container_cache().get(self.container_id)
 
     @cached_property
     def firewhale_config(self):
@@ -203,72 +324,17 @@ class Container:
 
 def sync_all_containers(rules = True, ips = True):
     """ Applies NFTables Rules for all Containers """
-    active_containers = [Container(c) for c in docker.from_env().containers.list(
-        all=True,
-    )]
+    active_containers = [Container(c) for c in container_cache().list()]
     for container in active_containers:
         if rules: container.apply_rules() # TODO Ensure container is running
-        if ips: container.publish_ips()
+    if ips:
+        # Published in bulk rather than one round-trip per container and network
+        IPSetManager.instance.add_service_ips(e for c in active_containers for e in c.published_ips())
 
 def cleanup_unknown_containers():
     """ Cleans up NFTables Rules, Chains and Maps for Containers that no longer exist """
-    MAPS_REMOVE_BY_IP = True
-
-    active_containers = [Container(c) for c in docker.from_env().containers.list(
-        all=True, filters={ "label": "firewhale.enabled=true" },
-    )]
-
-    if MAPS_REMOVE_BY_IP:
-        mapped_ips = set(ip for ip, v in get_map_elements("ip", "filter", CONTAINER_CHAIN_SPECS[0].map_name).items())
-        running_ips = set(ip for c in active_containers for ip in c.container_ips())
-        dead_ips = mapped_ips - running_ips
-        if dead_ips:
-            for cdef in CONTAINER_CHAIN_SPECS:
-                nfc({ "delete": { "element": {
-                    "family": "ip",
-                    "table": TABLE_FILTER,
-                    "name": cdef.map_name,
-                    "elem": list(dead_ips),
-                }}})
-
-    else:
-        map_cache = None
-        def find_container_ips(cid):
-            nonlocal map_cache
-            if not map_cache:
-                map_cache = {}
-                by_ip = { k: v["jump"]["target"] for k, v in get_map_elements("ip", "filter", CONTAINER_CHAIN_SPECS[0].map_name).items() }
-                by_container_id = {}
-                for ip, chain in by_ip.items():
-                    cid = chain.split("-")[2]
-                    if cid not in by_container_id:
-                        by_container_id[cid] = []
-                    by_container_id[cid].append(ip)
-            return map_cache.get(cid, [])
-
-    running_container_ids = set(c.id for c in active_containers)
-
-    # List Chains with container prefix
-    container_chains = [ch for ch in list_table_chains("ip", "filter") if ch["name"].startswith("firewhale-container-")]
-    for cchain in container_chains:
-        # Extract the container ID
-        cid = cchain["name"].split("-")[2]
-
-        # Check if the container exists
-        if cid not in running_container_ids:
-            if not MAPS_REMOVE_BY_IP:
-                # Remove Container-specific Chains from Maps. This is not an ideal approach.
-                container_ips = find_container_ips(cid)
-                if container_ips:
-                    for cdef in CONTAINER_CHAIN_SPECS:
-                        nfc({ "delete": { "element": {
-                            "family": "ip",
-                            "table": TABLE_FILTER,
-                            "name": cdef.map_name,
-                            "elem": container_ips,
-                        }}})
-
-            # Remove all Rules from the Chain
-            nfc({ "flush": { "chain": cchain }})
-            # Delete the Chain
-            nfc({ "delete": { "chain": cchain }})
+    from .sweep import garbage_collector
+    # One transaction for everything, instead of a flush and a delete per stale chain
+    collected = garbage_collector.sweep(full=True)
+    if collected:
+        print(f"Removed {collected} stale object(s): {garbage_collector.stats}")
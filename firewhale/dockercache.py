@@ -0,0 +1,172 @@
+
+import time
+from dataclasses import dataclass
+from threading import Lock
+from typing import Dict, List
+
+import docker
+import docker.errors
+import docker.models.containers
+
+from . import metrics, tracing
+
+
+_client: docker.DockerClient = None
+_client_lock = Lock()
+
+def docker_client() -> docker.DockerClient:
+    """ Process-wide Docker client, so that every caller shares one connection pool """
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = docker.from_env()
+        return _client
+
+def set_docker_client(client: docker.DockerClient):
+    """ Replaces the shared client (eg with a fake for benchmarks) and drops the cache built from the old one """
+    global _client, _cache
+    with _client_lock:
+        _client = client
+    with _cache_lock:
+        _cache = None
+
+
+@dataclass
+class _Entry:
+    container: docker.models.containers.Container
+    fetched_at: float
+    stale: bool = False
+    # Tombstone of a destroyed container, kept until the events queued before the `destroy` have been handled
+    removed: bool = False
+
+
+def _attrs_from_summary(summary: dict) -> dict:
+    """ Reshapes a `containers.list(sparse=True)` summary into the subset of `inspect` attrs that Firewhale reads """
+    names = summary.get("Names") or [""]
+    return {
+        "Id": summary["Id"],
+        "Name": names[0],
+        "Config": { "Labels": summary.get("Labels") or {} },
+        "State": { "Status": summary.get("State") },
+        "NetworkSettings": { "Networks": (summary.get("NetworkSettings") or {}).get("Networks") or {} },
+    }
+
+
+class ContainerCache:
+    """
+    Snapshot of container attributes keyed by container ID.
+    Filled with a single list call and kept current from the Docker event stream; a container is only
+    re-inspected when its entry is missing, marked stale by an event, or older than `max_age` seconds.
+    A destroyed container's last snapshot stays readable until the event consumer calls `forget`.
+    """
+
+    def __init__(self, client: docker.DockerClient = None, *, max_age: float = 300):
+        self.client = client or docker_client()
+        self.max_age = max_age
+        self._entries: Dict[str, _Entry] = {}
+        self._lock = Lock()
+
+    def load_all(self) -> List[docker.models.containers.Container]:
+        """ Replaces the cache contents with the current list of containers (one API call, no inspects) """
+        with metrics.docker_api_seconds.time(call="list"):
+            summaries = self.client.api.containers(all=True)
+        now = time.monotonic()
+        entries = {}
+        for s in summaries:
+            model = self.client.containers.prepare_model(_attrs_from_summary(s))
+            entries[model.id] = _Entry(model, now)
+        with self._lock:
+            tombstones = { cid: e for cid, e in self._entries.items() if e.removed and cid not in entries }
+            self._entries = { **entries, **tombstones }
+        return [e.container for e in entries.values()]
+
+    def list(self, *, refresh: bool = True, enabled_only: bool = False) -> List[docker.models.containers.Container]:
+        if refresh:
+            containers = self.load_all()
+        else:
+            with self._lock:
+                containers = [e.container for e in self._entries.values() if not e.removed]
+
+        if enabled_only:
+            containers = [c for c in containers if str(c.labels.get("firewhale.enabled", "")).lower() == "true"]
+        return containers
+
+    def get(self, container_id: str) -> docker.models.containers.Container:
+        with self._lock:
+            entry = self._find(container_id)
+
+        if entry is not None and entry.removed:
+            return entry.container
+
+        if entry is not None and not entry.stale and time.monotonic() - entry.fetched_at < self.max_age:
+            return entry.container
+
+        try:
+            with metrics.docker_api_seconds.time(call="inspect"), tracing.span("docker_inspect"):
+                container = self.client.containers.get(container_id)
+        except docker.errors.NotFound:
+            # The container is gone (eg `die` with auto-remove) - the last snapshot is the best we have
+            if entry is not None:
+                return entry.container
+            raise
+
+        with self._lock:
+            self._entries[container.id] = _Entry(container, time.monotonic())
+        return container
+
+    def handle_event(self, event: dict):
+        """ Updates the cache from a Docker container event """
+        cid = event.get("id")
+        action = event.get("Action")
+        if not cid: return
+
+        with self._lock:
+            if action == "destroy":
+                # Events handled after this one (eg the container's `die`) may still need its attributes
+                entry = self._entries.get(cid)
+                if entry is not None:
+                    entry.removed = True
+                return
+
+            entry = self._entries.get(cid)
+            if entry is None and action == "create":
+                # Labels and name are included in the event, networks are filled in by a later inspect
+                attributes = dict((event.get("Actor") or {}).get("Attributes") or {})
+                name = attributes.pop("name", "")
+                attributes.pop("image", None)
+                model = self.client.containers.prepare_model({
+                    "Id": cid,
+                    "Name": f"/{name}",
+                    "Config": { "Labels": attributes },
+                    "NetworkSettings": { "Networks": {} },
+                })
+                self._entries[cid] = _Entry(model, time.monotonic(), stale=True)
+            elif entry is not None:
+                # Network attachments and IPs change on start/die
+                entry.stale = True
+
+    def forget(self, container_id: str):
+        """ Drops the tombstone of a destroyed container, once every event queued for it has been handled """
+        with self._lock:
+            entry = self._entries.get(container_id)
+            if entry is not None and entry.removed:
+                del self._entries[container_id]
+
+    def _find(self, container_id: str) -> _Entry:
+        entry = self._entries.get(container_id)
+        if entry is None and len(container_id) < 64:
+            for cid, e in self._entries.items():
+                if cid.startswith(container_id):
+                    return e
+        return entry
+
+
+_cache: ContainerCache = None
+_cache_lock = Lock()
+
+def container_cache() -> ContainerCache:
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = ContainerCache()
+        return _cache
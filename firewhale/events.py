@@ -0,0 +1,149 @@
+
+import time
+from dataclasses import dataclass, field
+from threading import Condition, Thread
+from typing import Any, Callable, Dict, List
+
+
+@dataclass
+class CoalescedEvent:
+    container_id: str
+    # Effective actions to run, in order (die and/or start)
+    actions: List[str]
+    # Raw Docker actions that were merged into this event
+    events: List[str]
+    # When the first of `events` was received (time.monotonic)
+    received_at: float = 0
+    # Tracing spans of the raw events, to be ended once the event is handled (see tracing.start_span)
+    traces: List[Any] = field(default_factory=list)
+    # The container was destroyed - its cache entry can go once the actions have run
+    destroyed: bool = False
+
+
+@dataclass
+class CoalescerStats:
+    received: int = 0
+    dispatched: int = 0
+    # Events folded into another event for the same container
+    merged: int = 0
+    # Events whose work was superseded entirely (eg create followed by die)
+    dropped: int = 0
+
+    def __str__(self):
+        return f"received={self.received} dispatched={self.dispatched} merged={self.merged} dropped={self.dropped}"
+
+
+@dataclass
+class _Pending:
+    events: List[str] = field(default_factory=list)
+    traces: List[Any] = field(default_factory=list)
+    first_seen: float = 0
+    deadline: float = 0
+
+
+def effective_actions(events: List[str]) -> List[str]:
+    """ Reduces a sequence of Docker container actions to the minimal list of actions that reaches the same state """
+    # Everything is torn down on `die` already
+    events = [e for e in events if e != "destroy"]
+    if not events:
+        return []
+
+    # A create at the start means there is nothing from before this sequence to tear down
+    fresh = events[0] == "create"
+
+    if events[-1] == "die":
+        return [] if fresh else ["die"]
+
+    # Networks only get their IPs on start, so a container that was just created has nothing to apply or publish yet
+    up_actions = ["start"] if "start" in events else []
+    if "die" in events and not fresh:
+        return ["die", *up_actions]
+    return up_actions
+
+
+class EventCoalescer:
+    """
+    Per-container debounce in front of the event handler.
+    Events for a container are held until no new event has arrived for `window` seconds (but never longer
+    than `max_delay`) and then reduced to the minimal set of actions before being passed to `emit`.
+    """
+
+    def __init__(self, emit: Callable[[CoalescedEvent], None], *, window: float = 0.25, max_delay: float = 2.0):
+        self.emit = emit
+        self.window = window
+        self.max_delay = max(max_delay, window)
+        self.stats = CoalescerStats()
+
+        self._pending: Dict[str, _Pending] = {}
+        self._cond = Condition()
+        self._stopped = False
+        self._thread = None
+
+        if self.window > 0:
+            self._thread = Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def push(self, container_id: str, action: str, *, trace=None):
+        traces = [trace] if trace is not None else []
+        with self._cond:
+            self.stats.received += 1
+
+            if self.window <= 0:
+                self._dispatch(container_id, [action], time.monotonic(), traces)
+                return
+
+            now = time.monotonic()
+            pending = self._pending.get(container_id)
+            if pending is None:
+                pending = self._pending[container_id] = _Pending(first_seen=now)
+            pending.events.append(action)
+            pending.traces.extend(traces)
+            pending.deadline = min(now + self.window, pending.first_seen + self.max_delay)
+            self._cond.notify()
+
+    def close(self):
+        """ Stops the flusher, dispatching anything still pending """
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        with self._cond:
+            while True:
+                if self._stopped:
+                    for cid in list(self._pending.keys()):
+                        self._flush(cid)
+                    return
+
+                now = time.monotonic()
+                due = [cid for cid, p in self._pending.items() if p.deadline <= now]
+                for cid in due:
+                    self._flush(cid)
+
+                if self._pending:
+                    self._cond.wait(min(p.deadline for p in self._pending.values()) - now)
+                else:
+                    self._cond.wait()
+
+    def _flush(self, container_id: str):
+        pending = self._pending.pop(container_id)
+        self._dispatch(container_id, pending.events, pending.first_seen, pending.traces)
+
+    def _dispatch(self, container_id: str, events: List[str], received_at: float, traces: List[Any]):
+        actions = effective_actions(events)
+        destroyed = "destroy" in events
+
+        if not actions:
+            self.stats.dropped += len(events)
+            if not destroyed:
+                for span in traces:
+                    span.end()
+                return
+        else:
+            self.stats.merged += len(events) - len(actions)
+
+        # A destroy is passed on even without actions, so that the consumer evicts the cache entry in order
+        self.stats.dispatched += 1
+        self.emit(CoalescedEvent(container_id, actions, events, received_at, traces, destroyed=destroyed))
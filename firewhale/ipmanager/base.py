@@ -1,33 +1,50 @@
-from typing import Dict, Set
+from threading import RLock
+from typing import Dict, Iterable, List, Set, Tuple
 
 from ..nf import nfc
 from ..rule import nft_service_set_name
-from ..util import BiMultiMap, MultiMap
+from ..tracing import traced
+from ..util import BiMultiMap, MultiMap, synchronized
+from .batch import SetUpdateBatcher
 
 
 class IPSetManager:
     instance: "IPSetManager" = None
 
-    def __init__(self) -> None:
+    def __init__(self, *, set_batch_window: float = 0) -> None:
         self.node_id = "LOCAL"
         # Service <-> Container
         self.service_subscriptions: BiMultiMap[str, str] = BiMultiMap()
+        # IP -> subscribed service whose set it is in
         self.ip_service_cache: Dict[str, str] = {}
+        # Events may be handled from several threads (asyncio mode, pub/sub listener)
+        self._lock = RLock()
+        # Element updates of subscribed service sets
+        self.set_updates = SetUpdateBatcher(self._lock, window=set_batch_window)
 
     def close(self):
-        pass
+        self.set_updates.close()
 
     # === Service IP Publishing ===
 
     def add_service_ip(self, service: str, ip: str, cid: str):
         raise NotImplementedError()
 
+    def add_service_ips(self, entries: Iterable[Tuple[str, str, str]]) -> List[bool]:
+        """ Bulk `add_service_ip` for `(service, ip, cid)` tuples. Returns whether each IP changed """
+        return [bool(self.add_service_ip(service, ip, cid)) for service, ip, cid in entries]
+
     def del_service_ip(self, service: str, ip: str, cid: str):
         raise NotImplementedError()
 
     def del_container_ips(self, cid: str):
         raise NotImplementedError()
 
+    def del_containers_ips(self, cids: Iterable[str]):
+        """ Bulk `del_container_ips` """
+        for cid in cids:
+            self.del_container_ips(cid)
+
     def list_container_ips(self, cid: str) -> Set[str]:
         raise NotImplementedError()
 
@@ -40,6 +57,8 @@ class IPSetManager:
     def list_service_ips(self, service: str) -> Set[str]:
         raise NotImplementedError()
 
+    @traced("IPSetManager.subscribe_service")
+    @synchronized
     def subscribe_service(self, service: str, cid: str):
         """ Returns True if the Service was not already subscribed """
         print(f"Subscribing to service {service} for container {cid}")
@@ -57,18 +76,26 @@ class IPSetManager:
                     **self._service_set(service),
                     "type": "ipv4_addr",
                 }}})
+            for ip in ips:
+                self.ip_service_cache[ip] = service
             return True
 
+    @traced("IPSetManager.unsubscribe_service")
+    @synchronized
     def unsubscribe_service(self, service: str, cid: str):
         """ Returns True if the service has no remaining Subscribers """
         print(f"Unsubscribing from service {service} for container {cid}")
         if self.service_subscriptions.remove(service, cid):
             print(f"Subscription is empty - unsubscribing")
+            self.set_updates.drop_set(nft_service_set_name(service))
             nfc({ "delete": { "set": {
                 **self._service_set(service),
             }}})
+            for ip in [ip for ip, svc in self.ip_service_cache.items() if svc == service]:
+                del self.ip_service_cache[ip]
             return True
 
+    @synchronized
     def unsubscribe_all_services(self, cid: str):
         if not self.service_subscriptions.has_value(cid):
             return
@@ -77,25 +104,54 @@ class IPSetManager:
         for svc in services:
             self.unsubscribe_service(svc, cid)
 
-    def _update_ip_service(self, service: str, ip: str):
+    @synchronized
+    def resync_service_sets(self):
+        """ Rebuilds every subscribed service set from `list_service_ips`, eg after updates may have been missed """
+        self.set_updates.clear()
+        self.ip_service_cache.clear()
+        commands = []
+        for service in self.service_subscriptions.keys():
+            ips = list(self.list_service_ips(service))
+            commands.append({ "flush": { "set": self._service_set(service) }})
+            if ips:
+                commands.append({ "add": { "element": {
+                    **self._service_set(service),
+                    "elem": ips,
+                }}})
+            for ip in ips:
+                self.ip_service_cache[ip] = service
+        if commands:
+            print(f"Resyncing {len(self.service_subscriptions.keys())} service set(s)")
+            nfc(commands)
+        self.set_updates.behind = False
+
+    def catch_up(self):
+        """ Makes up for service set updates that were lost while disconnected (from Redis or the NFTables backend) """
+        if self.set_updates.behind:
+            self.resync_service_sets()
+
+    @traced("IPSetManager.update_ip_service")
+    @synchronized
+    def _update_ip_service(self, service: str, ip: str, *, version: int = None):
+        """
+        Moves `ip` into the set of `service` (None if the IP is gone), for whichever of the two sets are subscribed.
+        `version` is the version of the change, if it came from the change stream
+        """
         if not ip or ip == "": return
-        if not self.service_subscriptions.has_key(service): return
 
         # Remove the IP from the old service (if applicable)
-        if ip in self.ip_service_cache:
-            old_service = self.ip_service_cache[ip]
-            if old_service != service:
-                nfc({ "delete": { "set": {
-                    **self._service_set(service),
-                }}})
+        old_service = self.ip_service_cache.get(ip)
+        if old_service is not None and old_service != service:
+            del self.ip_service_cache[ip]
+            self.set_updates.delete(self._service_set(old_service), ip)
 
         # Add the IP to the new service
-        if service:
+        if service and self.service_subscriptions.has_key(service):
             self.ip_service_cache[ip] = service
-            nfc({ "add": { "element": {
-                **self._service_set(service),
-                "elem": ip,
-            }}})
+            self.set_updates.add(self._service_set(service), ip)
+
+        if version is not None:
+            self.set_updates.advance(version)
 
     # === Helpers ===
 
@@ -0,0 +1,197 @@
+
+import time
+import traceback
+from contextlib import contextmanager
+from dataclasses import dataclass
+from threading import Condition, Thread
+from typing import Dict
+
+from .. import metrics
+from ..nf import nfc
+from ..nfbackends.base import NftError
+from ..shadow import nf_shadow
+
+
+@dataclass
+class SetBatchStats:
+    commits: int = 0
+    added: int = 0
+    deleted: int = 0
+    # Updates that were undone within the same tick, or that already matched the set
+    cancelled: int = 0
+    # Commits that failed as a whole and were re-run command by command
+    fallbacks: int = 0
+
+    def __str__(self):
+        return f"commits={self.commits} added={self.added} deleted={self.deleted} cancelled={self.cancelled} fallbacks={self.fallbacks}"
+
+
+class SetUpdateBatcher:
+    """
+    Collects element adds and deletes for service sets and commits them as one transaction every `window` seconds.
+    Only the last update of an element within a tick counts, and it is dropped if the set (per the shadow state)
+    already looks like that - so an add followed by a delete of a new element sends nothing.
+    With `window` <= 0 every update is committed straight away.
+    Commits hold `lock` (the owning IPSetManager's) so they never interleave with set creation or deletion.
+
+    Updates can be tagged with the version of the change that caused them (see `advance`). `version` is the last
+    one whose updates are known to be committed; after a failed commit it stops moving (`behind`) until the
+    owner has made up for the lost updates.
+    """
+
+    def __init__(self, lock, *, window: float = 0.05):
+        self.lock = lock
+        self.window = window
+        self.stats = SetBatchStats()
+
+        # Set -> element -> present after the tick
+        self._pending: Dict[str, Dict[str, bool]] = {}
+        self._sets: Dict[str, dict] = {}
+        self.version = 0
+        self.behind = False
+        self._pending_version = None
+        self._deferred = 0
+        self._cond = Condition()
+        self._stopped = False
+        self._thread = None
+
+        if self.window > 0:
+            self._thread = Thread(target=self._run, name="set-batcher", daemon=True)
+            self._thread.start()
+
+    def add(self, set_spec: dict, elem: str):
+        self._push(set_spec, elem, True)
+
+    def delete(self, set_spec: dict, elem: str):
+        self._push(set_spec, elem, False)
+
+    def advance(self, version: int):
+        """ Marks the updates pushed so far as belonging to change `version`, which is reached once they are committed """
+        with self._cond:
+            if self._pending:
+                self._pending_version = max(self._pending_version or 0, version)
+            elif not self.behind:
+                self.version = max(self.version, version)
+
+    def reset_version(self, version: int):
+        """ The sets were rebuilt as of change `version` """
+        with self._cond:
+            self.version = version
+            self.behind = False
+            self._pending_version = None
+
+    @contextmanager
+    def deferred(self):
+        """
+        Holds back the immediate commits of `window` <= 0 until the block ends, so that a bulk operation's updates
+        go out as one transaction. Must be used while holding `lock`
+        """
+        self._deferred += 1
+        try:
+            yield
+        finally:
+            self._deferred -= 1
+            if not self._deferred and self.window <= 0:
+                self.flush()
+
+    def drop_set(self, set_name: str):
+        """ Forgets pending updates of a set that is about to be deleted """
+        with self._cond:
+            dropped = self._pending.pop(set_name, None)
+            self._sets.pop(set_name, None)
+            if dropped:
+                self.stats.cancelled += len(dropped)
+
+    def clear(self):
+        """ Forgets all pending updates (eg before rebuilding the sets from scratch) """
+        with self._cond:
+            self.stats.cancelled += sum(len(p) for p in self._pending.values())
+            self._pending.clear()
+            self._sets.clear()
+            self._pending_version = None
+
+    def flush(self):
+        """ Commits pending updates now """
+        with self.lock:
+            with self._cond:
+                pending, self._pending = self._pending, {}
+                sets, self._sets = self._sets, {}
+                version, self._pending_version = self._pending_version, None
+            if pending:
+                try:
+                    self._commit(pending, sets)
+                except Exception:
+                    self.behind = True
+                    raise
+            if version is not None and not self.behind:
+                self.version = max(self.version, version)
+
+    def close(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+
+    def _push(self, set_spec: dict, elem: str, present: bool):
+        name = set_spec["name"]
+        with self._cond:
+            pending = self._pending.get(name)
+            if pending is None:
+                pending = self._pending[name] = {}
+                self._sets[name] = set_spec
+                self._cond.notify()
+            elif elem in pending:
+                self.stats.cancelled += 1
+            pending[elem] = present
+
+        if self.window <= 0 and not self._deferred:
+            self.flush()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._stopped:
+                    self._cond.wait()
+                if self._stopped:
+                    return
+            # Let the rest of the tick's updates arrive
+            time.sleep(self.window)
+            try:
+                self.flush()
+            except Exception:
+                print("Error committing service set updates:")
+                traceback.print_exc()
+
+    def _commit(self, pending: Dict[str, Dict[str, bool]], sets: Dict[str, dict]):
+        commands = []
+        for name, elems in pending.items():
+            # Only trust the shadow's view of the set when it is in sync with the kernel
+            current = nf_shadow.service_sets.get(name) if nf_shadow.loaded and not nf_shadow.dirty else None
+            added = [e for e, present in elems.items() if present and (current is None or e not in current)]
+            deleted = [e for e, present in elems.items() if not present and (current is None or e in current)]
+            cancelled = len(elems) - len(added) - len(deleted)
+            self.stats.cancelled += cancelled
+            self.stats.added += len(added)
+            self.stats.deleted += len(deleted)
+            metrics.set_updates.inc(len(added), result="added")
+            metrics.set_updates.inc(len(deleted), result="deleted")
+            metrics.set_updates.inc(cancelled, result="cancelled")
+
+            if added:
+                commands.append({ "add": { "element": { **sets[name], "elem": added }}})
+            # Deleting a missing element fails the transaction, so deletes go one element per command (see below)
+            commands.extend({ "delete": { "element": { **sets[name], "elem": e }}} for e in deleted)
+
+        if not commands:
+            return
+
+        self.stats.commits += 1
+        try:
+            nfc(commands)
+        except NftError as e:
+            # Eg an element that was already gone - apply everything that still can be
+            print(f"Batched service set update failed ({e}) - retrying command by command")
+            self.stats.fallbacks += 1
+            nfc(commands, throw="continue")
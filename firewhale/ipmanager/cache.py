@@ -0,0 +1,114 @@
+
+from collections import OrderedDict
+from dataclasses import dataclass
+from threading import Lock
+from typing import Callable, Dict, Iterable, Set
+
+from .. import metrics
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    # Entries dropped to stay within the size limit
+    evictions: int = 0
+    # Entries dropped because they may be stale
+    invalidations: int = 0
+
+    def __str__(self):
+        return f"hits={self.hits} misses={self.misses} evictions={self.evictions} invalidations={self.invalidations}"
+
+
+class MembershipCache:
+    """
+    Bounded LRU cache of key -> members (eg service -> IPs), kept current by `move` from the change messages
+    instead of being re-read from Redis. A member (IP) belongs to at most one key at a time.
+    `on_evict(key)` is called for entries dropped to stay within `max_entries`. 0 disables the cache.
+    """
+
+    def __init__(self, name: str, max_entries: int, *, on_evict: Callable[[str], None] = None):
+        self.name = name
+        self.max_entries = max_entries
+        self.on_evict = on_evict
+        self.stats = CacheStats()
+
+        self._entries: OrderedDict[str, Set[str]] = OrderedDict()
+        # Member -> key of the cached entry it is in
+        self._owners: Dict[str, str] = {}
+        self._lock = Lock()
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: str) -> Set[str] | None:
+        """ The cached members of `key`, or None on a miss """
+        with self._lock:
+            members = self._entries.get(key)
+            if members is None:
+                self.stats.misses += 1
+            else:
+                self.stats.hits += 1
+                self._entries.move_to_end(key)
+                members = set(members)
+        metrics.redis_cache_lookups.inc(cache=self.name, result="miss" if members is None else "hit")
+        return members
+
+    def fill(self, key: str, members: Iterable[str]):
+        """ Caches the members of `key`, as just read from Redis """
+        if self.max_entries <= 0:
+            return
+
+        evicted = []
+        with self._lock:
+            self._drop(key)
+            self._entries[key] = set()
+            for member in members:
+                self._move(member, key)
+
+            while len(self._entries) > self.max_entries:
+                oldest = next(iter(self._entries))
+                self._drop(oldest)
+                self.stats.evictions += 1
+                evicted.append(oldest)
+
+        if self.on_evict is not None:
+            for oldest in evicted:
+                self.on_evict(oldest)
+
+    def move(self, member: str, key: str | None):
+        """ Records that `member` now belongs to `key` (None: to no key) """
+        with self._lock:
+            self._move(member, key)
+
+    def invalidate(self, key: str):
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+                self.stats.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self.stats.invalidations += len(self._entries)
+            self._entries.clear()
+            self._owners.clear()
+
+    def keys(self) -> Set[str]:
+        with self._lock:
+            return set(self._entries.keys())
+
+    def _move(self, member: str, key: str | None):
+        old = self._owners.pop(member, None)
+        if old is not None:
+            self._entries[old].discard(member)
+        if key is not None and key in self._entries:
+            self._entries[key].add(member)
+            self._owners[member] = key
+
+    def _drop(self, key: str):
+        members = self._entries.pop(key, None)
+        for member in members or ():
+            del self._owners[member]
@@ -1,44 +1,116 @@
-from typing import Dict, Set
+from typing import Dict, Iterable, List, Set, Tuple
 
-from ..util import MultiMap
+from ..util import MultiMap, synchronized
 from .base import IPSetManager
 
 
+class IPIndex:
+    """
+    Published IPs, indexed by IP, container and service so that every lookup costs O(result) instead of a scan.
+    All changes go through `set` and `remove`, which keep the indexes consistent with each other.
+    """
+
+    def __init__(self) -> None:
+        # IP -> (service, container)
+        self._ips: Dict[str, Tuple[str, str]] = {}
+        self._by_container = MultiMap[str, str]()
+        self._by_service = MultiMap[str, str]()
+
+    def __len__(self) -> int:
+        return len(self._ips)
+
+    def __contains__(self, ip: str) -> bool:
+        return ip in self._ips
+
+    def get(self, ip: str) -> Tuple[str, str] | None:
+        """ `(service, container)` of the IP """
+        return self._ips.get(ip)
+
+    def by_container(self, cid: str) -> Set[str]:
+        return set(self._by_container.get(cid))
+
+    def by_service(self, service: str) -> Set[str]:
+        return set(self._by_service.get(service))
+
+    def containers(self) -> Set[str]:
+        return self._by_container.keys()
+
+    def set(self, ip: str, service: str, cid: str) -> Tuple[str, str] | None:
+        """ Returns the IP's previous `(service, container)` """
+        old = self._ips.get(ip)
+        if old == (service, cid):
+            return old
+        if old is not None:
+            self._unlink(ip, *old)
+        self._ips[ip] = (service, cid)
+        self._by_service.add(service, ip)
+        self._by_container.add(cid, ip)
+        return old
+
+    def remove(self, ip: str) -> Tuple[str, str] | None:
+        """ Returns the removed IP's `(service, container)` """
+        old = self._ips.pop(ip, None)
+        if old is not None:
+            self._unlink(ip, *old)
+        return old
+
+    def _unlink(self, ip: str, service: str, cid: str):
+        self._by_service.remove(service, ip)
+        self._by_container.remove(cid, ip)
+
+
 class LocalSubscriptionManager(IPSetManager):
     def __init__(self) -> None:
         super().__init__()
 
-        self.service_published_ips = MultiMap[str, str]()
-        self.ip_to_service: Dict[str, str] = {}
-        self.ip_to_container: Dict[str, str] = {}
+        self.ips = IPIndex()
 
+    @synchronized
     def add_service_ip(self, service: str, ip: str, cid: str):
-        needs_update = ip not in self.ip_to_service or self.ip_to_service.get(ip) != service
-
-        self.ip_to_service[ip] = service
-        self.ip_to_container[ip] = cid
-        self.service_published_ips.add(service, ip)
-
-        if needs_update:
+        old = self.ips.set(ip, service, cid)
+        if old is None or old[0] != service:
             self._update_ip_service(service, ip)
+        return old != (service, cid)
 
-    def del_service_ip(self, service: str, ip: str, cid: str):
-        if ip in self.ip_to_container and self.ip_to_container[ip] == cid:
-            del self.ip_to_service[ip]
-            del self.ip_to_container[ip]
-            self.service_published_ips.remove(service, ip)
+    @synchronized
+    def add_service_ips(self, entries: Iterable[Tuple[str, str, str]]) -> List[bool]:
+        # One set transaction for the lot
+        with self.set_updates.deferred():
+            return super().add_service_ips(entries)
 
+    @synchronized
+    def del_service_ip(self, service: str, ip: str, cid: str):
+        current = self.ips.get(ip)
+        if current is not None and current[1] == cid:
+            self.ips.remove(ip)
             self._update_ip_service(None, ip)
 
+    @synchronized
     def del_container_ips(self, cid: str):
-        for ip in self.list_container_ips(cid):
-            self.del_service_ip(self.ip_to_service[ip], ip, cid)
+        with self.set_updates.deferred():
+            for ip in self.ips.by_container(cid):
+                self.ips.remove(ip)
+                self._update_ip_service(None, ip)
+
+    @synchronized
+    def del_containers_ips(self, cids: Iterable[str]):
+        with self.set_updates.deferred():
+            for cid in cids:
+                self.del_container_ips(cid)
 
     def list_container_ips(self, cid: str) -> Set[str]:
-        return [ip for ip, c in self.ip_to_container.items() if c == cid]
+        return self.ips.by_container(cid)
 
+    @synchronized
     def del_unknown_ips(self):
-        pass # TODO Remove any IPs if they aren't associated with a container. May not be needed on the local manager.
+        from ..container import Container
+        from ..dockercache import container_cache
+        local_containers = set(Container(c).id for c in container_cache().list(refresh=False))
+
+        stale = [cid for cid in self.ips.containers() if cid not in local_containers]
+        if stale:
+            print(f"Removing IPs of {len(stale)} unknown container(s)")
+            self.del_containers_ips(stale)
 
     def list_service_ips(self, service: str) -> Set[str]:
-        return list(self.service_published_ips[service])
+        return list(self.ips.by_service(service))
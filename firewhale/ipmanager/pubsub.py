@@ -0,0 +1,92 @@
+
+import time
+import traceback
+from threading import Thread
+from typing import Callable
+
+import redis
+
+# Max seconds the listener blocks without traffic before pinging, so that a dead connection is noticed
+KEEPALIVE_INTERVAL = 30
+RECONNECT_DELAY_MIN = 0.5
+RECONNECT_DELAY_MAX = 30
+
+
+class PubSubListener:
+    """
+    Delivers Redis pub/sub messages to their handlers from a thread that blocks until a message arrives
+    (instead of polling). If the connection is lost, it reconnects with backoff, subscribes to everything again
+    and then calls `on_reconnect` so that updates published while disconnected can be made up for.
+    """
+
+    def __init__(self, r: redis.Redis, *, wake_channel: str, on_reconnect: Callable[[], None] = None):
+        self.redis = r
+        self.wake_channel = wake_channel
+        self.on_reconnect = on_reconnect
+
+        self.pubsub = r.pubsub(ignore_subscribe_messages=True)
+        self._stopped = False
+        self._reconnected = False
+
+        # redis-py re-subscribes from its on_connect callback - wrap it to learn about reconnects.
+        #   The callback is registered after the first connect, so every call is a reconnect.
+        #   (Connections only keep a weak reference to it, so it has to be a bound method)
+        self._resubscribe = self.pubsub.on_connect
+        self.pubsub.on_connect = self._on_connect
+
+        # Something to block on before the first real subscription, and a way to wake the thread on close
+        self.pubsub.subscribe(**{ wake_channel: lambda msg: None })
+
+        self.thread = Thread(target=self._run, name="redis-pubsub", daemon=True)
+        self.thread.start()
+
+    def subscribe(self, channel: str, handler: Callable[[dict], None]):
+        self.pubsub.subscribe(**{ channel: handler })
+
+    def unsubscribe(self, channel: str):
+        self.pubsub.unsubscribe(channel)
+
+    def psubscribe(self, pattern: str, handler: Callable[[dict], None]):
+        self.pubsub.psubscribe(**{ pattern: handler })
+
+    def close(self):
+        self._stopped = True
+        try:
+            self.redis.publish(self.wake_channel, "stop")
+        except redis.ConnectionError:
+            pass
+        self.thread.join(timeout=KEEPALIVE_INTERVAL)
+        self.pubsub.close()
+
+    def _on_connect(self, connection):
+        self._resubscribe(connection)
+        self._reconnected = True
+
+    def _run(self):
+        delay = RECONNECT_DELAY_MIN
+        while not self._stopped:
+            try:
+                # Messages with a handler are dispatched inside get_message
+                message = self.pubsub.get_message(timeout=KEEPALIVE_INTERVAL)
+                if message is None and not self._stopped and not self._reconnected:
+                    self.pubsub.ping()
+                delay = RECONNECT_DELAY_MIN
+            except (redis.ConnectionError, redis.TimeoutError) as e:
+                if self._stopped: break
+                print(f"Lost Redis pub/sub connection ({e}) - reconnecting in {delay:.1f}s")
+                time.sleep(delay)
+                delay = min(delay * 2, RECONNECT_DELAY_MAX)
+                continue
+            except Exception:
+                print("Error handling Redis message:")
+                traceback.print_exc()
+
+            if self._reconnected and not self._stopped:
+                self._reconnected = False
+                print("Reconnected to Redis pub/sub")
+                if self.on_reconnect is not None:
+                    try:
+                        self.on_reconnect()
+                    except Exception:
+                        print("Error resyncing after Redis reconnect:")
+                        traceback.print_exc()
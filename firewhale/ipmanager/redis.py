@@ -1,20 +1,40 @@
 
-import docker
-import docker.models.containers
 import redis
-from typing import Dict, Set
+from typing import Iterable, List, Set, Tuple
 
-from ..nf import nfc
-from ..rule import nft_service_set_name
-from ..util import BiMultiMap, MultiMap
+from .. import metrics
+from ..tracing import traced
+from ..util import synchronized
 from .base import IPSetManager
+from .cache import MembershipCache
+from .pubsub import PubSubListener
+
+# IPs per `set_ips` call - keeps each script run short, since Redis blocks other clients while it runs
+SET_IPS_CHUNK = 500
+
+# Written by ips.lua - every IP change gets the next version and is appended to the (capped) change stream
+VERSION_KEY = "firewhale:version"
+CHANGES_KEY = "firewhale:changes"
+# A node further behind than this rebuilds its sets instead of replaying the changes one by one
+REPLAY_LIMIT = 10000
+# Pub/sub channels written by ips.lua. `service:<service>` (the bare IP) is only still published for older nodes
+CHANGES_CHANNEL_PREFIX = "changes:service:"
+VERSION_CHANNEL = "firewhale:version-checkpoint"
 
 class RedisSubscriptionManager(IPSetManager):
-    def __init__(self, r, node_id) -> None:
-        super().__init__()
+    def __init__(self, r, node_id, *, pattern_subscribe: bool = False, set_batch_window: float = 0.05, cache_size: int = 1024) -> None:
+        super().__init__(set_batch_window=set_batch_window)
 
         self.node_id = node_id
         self.redis: redis.Redis = r
+        # One `changes:service:*` subscription filtered locally, instead of a channel per subscribed service
+        self.pattern_subscribe = pattern_subscribe
+
+        # Service membership read from Redis, kept current by the change messages.
+        #   A cached service's channel stays subscribed (after it is unsubscribed from) until the entry is evicted
+        self.service_ips_cache = MembershipCache("service", cache_size, on_evict=self._service_evicted)
+        # Services with a channel subscription
+        self._listening: Set[str] = set()
 
         # TODO Make this not every container boot?
         from importlib import resources as impresources
@@ -22,72 +42,218 @@ class RedisSubscriptionManager(IPSetManager):
         with inp_file.open('r') as f:
             r.function_load(f.read(), True)
 
-        self.pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        # Sets are built from the current state of Redis from here on
+        self.set_updates.reset_version(self._current_version())
 
-        # def on_reconnect(conn):
-        #     for container in docker.from_env().containers.list(all=True):
-        #         container.publish_ips()
-        #     self.del_unknown_ips()
-        # r.connection.register_connect_callback(on_reconnect)
+        self.listener = PubSubListener(r, wake_channel=f"firewhale:node:{node_id}:wake", on_reconnect=self._handle_reconnect)
+        self.listener.subscribe(VERSION_CHANNEL, self._handle_version_message)
+        if pattern_subscribe:
+            self.listener.psubscribe(f"{CHANGES_CHANNEL_PREFIX}*", self._handle_service_message)
 
         print("Firewhale is subscribed to Swarm events via Redis")
-        self.thread = self.pubsub.run_in_thread(sleep_time=0.1)
 
     def close(self):
-        self.thread.stop()
-        self.thread.join()
+        self.listener.close()
+        super().close()
+        print(f"Service set batch stats: {self.set_updates.stats}")
+        print(f"Service membership cache stats: {self.service_ips_cache.stats}")
 
     # === Service IP Publishing ===
+    # These hold the lock across the function call, so that a change message handled meanwhile
+    #   can't be overwritten in the cache by the older state the call returns
 
+    @traced("RedisSubscriptionManager.add_service_ip")
+    @synchronized
     def add_service_ip(self, service: str, ip: str, cid: str):
         print(f"Adding IP {ip} to service {service} for container {cid}")
-        return bool(self.redis.fcall("set_ip", 1, ip, service, cid, self.node_id))
+        changed = bool(self._fcall("set_ip", 1, ip, service, cid, self.node_id))
+        self.service_ips_cache.move(ip, service)
+        return changed
+
+    @traced("RedisSubscriptionManager.add_service_ips")
+    @synchronized
+    def add_service_ips(self, entries: Iterable[Tuple[str, str, str]]) -> List[bool]:
+        entries = list(entries)
+        if len(entries) <= 1:
+            return super().add_service_ips(entries)
+
+        print(f"Adding {len(entries)} IPs to services")
+        # All chunks go out in one round-trip
+        pipe = self.redis.pipeline(transaction=False)
+        for i in range(0, len(entries), SET_IPS_CHUNK):
+            chunk = entries[i:i + SET_IPS_CHUNK]
+            args = [ip for _, ip, _ in chunk] + [self.node_id]
+            for service, _, cid in chunk:
+                args.extend((service, cid))
+            pipe.fcall("set_ips", len(chunk), *args)
+
+        with metrics.redis_fcall_seconds.time(function="set_ips"):
+            results = pipe.execute()
+        for service, ip, _ in entries:
+            self.service_ips_cache.move(ip, service)
+        return [bool(changed) for chunk in results for changed in chunk]
 
+    @traced("RedisSubscriptionManager.del_service_ip")
+    @synchronized
     def del_service_ip(self, service: str, ip: str, cid: str):
         print(f"Deleting IP {ip} from service {service} for container {cid}")
-        self.redis.fcall("rm_ip", 1, ip, "container", cid)
+        if self._fcall("rm_ip", 1, ip, "container", cid):
+            self.service_ips_cache.move(ip, None)
 
+    @traced("RedisSubscriptionManager.del_container_ips")
+    @synchronized
     def del_container_ips(self, cid: str):
         print(f"Deleting IPs for container {cid}")
-        self.redis.fcall("rm_ips_by", 1, cid, "container")
+        for ip in self._fcall("rm_ips_by", 1, cid, "container"):
+            self.service_ips_cache.move(ip, None)
 
     def list_container_ips(self, cid: str) -> Set[str]:
         return set(self.redis.smembers(f"container:{cid}:ips"))
 
+    @traced("RedisSubscriptionManager.del_unknown_ips")
+    @synchronized
     def del_unknown_ips(self):
-        redis_state = self.redis.smembers(f"node:{self.node_id}:ips")
-
         from ..container import Container
-        local_containers = set(Container(c).id for c in docker.from_env().containers.list(all=True))
+        from ..dockercache import container_cache
+        local_containers = set(Container(c).id for c in container_cache().list(refresh=False))
 
-        for ip in redis_state:
-            state = self.redis.hgetall(f"ip:{ip}")
-            if state and state["node"] == self.node_id:
-                if state["container"] not in local_containers:
-                    self.del_service_ip(state["service"], ip, state["container"])
-            else:
-                self.redis.srem(f"node:{self.node_id}:ips", ip)
+        # Runs atomically in Redis - one round-trip regardless of how many IPs the node has
+        removed, repaired = self._fcall("reconcile_node", 1, self.node_id, *local_containers)
+        if removed or repaired:
+            print(f"Removed {len(removed)} stale IP(s) and {len(repaired)} stale node index entries")
+            for ip in removed:
+                self.service_ips_cache.move(ip, None)
 
     # === Service Subscription ===
 
+    @traced("RedisSubscriptionManager.list_service_ips")
+    @synchronized
     def list_service_ips(self, service: str) -> Set[str]:
-        return self.redis.smembers(f"service:{service}:ips")
+        ips = self.service_ips_cache.get(service)
+        if ips is None:
+            ips = self.redis.smembers(f"service:{service}:ips")
+            # Only cache what the change messages will keep current
+            if self.pattern_subscribe or service in self._listening:
+                self.service_ips_cache.fill(service, ips)
+        return ips
 
+    @synchronized
     def subscribe_service(self, service: str, cid: str):
-        if super().subscribe_service(service, cid):
-            self.pubsub.subscribe(**{f"service:{service}": self._handle_service_message})
+        # Listen before the members are listed, so that no change falls in between
+        if not self.pattern_subscribe:
+            self._listen(service)
+        return super().subscribe_service(service, cid)
 
+    @synchronized
     def unsubscribe_service(self, service: str, cid: str):
         if super().unsubscribe_service(service, cid):
-            self.pubsub.unsubscribe(f"service:{service}")
+            if service not in self.service_ips_cache:
+                self._unlisten(service)
+            return True
+
+    @synchronized
+    def resync_service_sets(self):
+        # Read first - the sets listed afterwards are at least this new
+        version = self._current_version()
+        self.service_ips_cache.clear()
+        super().resync_service_sets()
+        self.set_updates.reset_version(version)
+
+    @traced("RedisSubscriptionManager.catch_up")
+    @synchronized
+    def catch_up(self):
+        """
+        Replays the changes since the last version applied to NFTables from the change stream.
+        Rebuilds the sets instead if the node is too far behind (or the stream no longer goes back far enough)
+        """
+        since = self.set_updates.version
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.get(VERSION_KEY)
+        pipe.xrange(CHANGES_KEY, min=f"0-{since + 1}", count=REPLAY_LIMIT + 1)
+        latest, changes = pipe.execute()
+        latest = int(latest or 0)
+
+        if latest == since:
+            if self.set_updates.behind:
+                # Lost updates that aren't in the stream
+                self.resync_service_sets()
+            return
+
+        # Versions are consecutive, so a stream that doesn't start right after `since` has been trimmed.
+        #   A lower version than ours means Redis lost its data
+        first = self._change_version(changes[0]) if changes else None
+        if latest < since or first != since + 1 or len(changes) > REPLAY_LIMIT:
+            print(f"Too far behind to replay changes (at version {since}, Redis at {latest}) - resyncing service sets")
+            self.resync_service_sets()
+            return
 
+        print(f"Replaying {len(changes)} change(s) since version {since}")
+        self.set_updates.behind = False
+        for change in changes:
+            _, fields = change
+            service, old_service = fields["service"] or None, fields["old"] or None
+            # After a failed commit the cache may not match the set anymore - remove from the old set explicitly
+            if old_service and old_service != service and self.service_subscriptions.has_key(old_service):
+                if self.ip_service_cache.get(fields["ip"]) == old_service:
+                    del self.ip_service_cache[fields["ip"]]
+                self.set_updates.delete(self._service_set(old_service), fields["ip"])
+            self._update_ip_service(service, fields["ip"], version=self._change_version(change))
+        self.set_updates.flush()
+
+    @synchronized
+    def _handle_reconnect(self):
+        # Updates published while disconnected are lost - forget what may be stale and replay them from the change stream
+        self.service_ips_cache.clear()
+        for service in list(self._listening):
+            if not self.service_subscriptions.has_key(service):
+                self._unlisten(service)
+        self.catch_up()
+
+    @synchronized
     def _handle_service_message(self, msg):
-        # {'channel': b'my-channel', 'data': b'my data', 'pattern': None, 'type': 'message'}
+        # {'channel': 'changes:service:<service>', 'data': '<version> <ip> <container> <service>', 'pattern': None, 'type': 'message'}
         channel = msg["channel"]
-        ip = msg["data"]
+        version, ip, _, service = msg["data"].split(" ", 3)
+        service = service or None
+        self.service_ips_cache.move(ip, service)
+
+        if self.pattern_subscribe and not self.service_subscriptions.has_key(channel[len(CHANGES_CHANNEL_PREFIX):]):
+            # Nothing to update, but every change before this one has been seen
+            self.set_updates.advance(int(version))
+            return
+
+        self._update_ip_service(service, ip, version=int(version))
+
+    @synchronized
+    def _handle_version_message(self, msg):
+        # Changes are published in version order, so the messages of every earlier change have been handled
+        self.set_updates.advance(int(msg["data"]))
+
+    def _listen(self, service: str):
+        if service not in self._listening:
+            self._listening.add(service)
+            self.listener.subscribe(f"{CHANGES_CHANNEL_PREFIX}{service}", self._handle_service_message)
+
+    def _unlisten(self, service: str):
+        if service in self._listening:
+            self._listening.discard(service)
+            self.listener.unsubscribe(f"{CHANGES_CHANNEL_PREFIX}{service}")
+
+    @synchronized
+    def _service_evicted(self, service: str):
+        if not self.service_subscriptions.has_key(service):
+            self._unlisten(service)
+
+    # === Helpers ===
+
+    def _current_version(self) -> int:
+        return int(self.redis.get(VERSION_KEY) or 0)
+
+    @staticmethod
+    def _change_version(change) -> int:
+        # Stream entry IDs are 0-<version>
+        return int(change[0].split("-")[1])
 
-        state = self.redis.hgetall(f"ip:{ip}")
-        if state:
-            self._update_ip_service(state["service"], ip)
-        else:
-            self._update_ip_service(None, ip)
+    def _fcall(self, function: str, *args):
+        with metrics.redis_fcall_seconds.time(function=function):
+            return self.redis.fcall(function, *args)
@@ -0,0 +1,260 @@
+
+import bisect
+import os
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingMixIn, UnixStreamServer
+from threading import Lock, Thread
+from typing import Callable, Dict, List, Tuple
+
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+SIZE_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = None) -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric:
+    type = "untyped"
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labels)
+        self._lock = Lock()
+        self._values: Dict[tuple, object] = {}
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(n, "")) for n in self.labelnames)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in values:
+            lines.extend(self._render_value(key, value))
+        return lines
+
+    def _render_value(self, key: tuple, value) -> List[str]:
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"]
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    type = "gauge"
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def set_function(self, fn: Callable[[], float], **labels):
+        """ Reads the value from `fn` at scrape time """
+        with self._lock:
+            self._values[self._key(labels)] = fn
+
+    def _render_value(self, key, value):
+        if callable(value):
+            try:
+                value = value()
+            except Exception:
+                return []
+        return super()._render_value(key, value)
+
+
+class _HistogramValue:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self, buckets: int):
+        self.counts = [0] * buckets
+        self.sum = 0.0
+        self.count = 0
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = (), *, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            v = self._values.get(key)
+            if v is None:
+                v = self._values[key] = _HistogramValue(len(self.buckets))
+            if idx < len(self.buckets):
+                v.counts[idx] += 1
+            v.sum += value
+            v.count += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _render_value(self, key, v: _HistogramValue):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, v.counts):
+            cumulative += count
+            le = 'le="%s"' % _format_value(bound)
+            lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+        le = 'le="+Inf"'
+        lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {v.count}")
+        lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(v.sum)}")
+        lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {v.count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+
+    def register(self, metric: _Metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """ All metrics in the Prometheus text exposition format """
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+registry = Registry()
+
+
+# === Firewhale ===
+
+queue_depth = registry.register(Gauge(
+    "firewhale_queue_depth", "Items waiting in the main work queue"))
+queue_wait_seconds = registry.register(Histogram(
+    "firewhale_queue_wait_seconds", "Time items spent in the main work queue", ("type",)))
+event_seconds = registry.register(Histogram(
+    "firewhale_event_seconds", "Time to handle one container action", ("action",)))
+event_lag_seconds = registry.register(Histogram(
+    "firewhale_event_lag_seconds", "Time from receiving a Docker event to its rules being applied"))
+docker_api_seconds = registry.register(Histogram(
+    "firewhale_docker_api_seconds", "Docker API call latency", ("call",)))
+redis_fcall_seconds = registry.register(Histogram(
+    "firewhale_redis_fcall_seconds", "Redis function call latency", ("function",)))
+redis_cache_lookups = registry.register(Counter(
+    "firewhale_redis_cache_lookups_total", "Lookups in the Redis membership caches, by cache and result", ("cache", "result")))
+set_updates = registry.register(Counter(
+    "firewhale_service_set_updates_total", "Batched service set element updates, by outcome", ("result",)))
+
+gc_collected = registry.register(Counter(
+    "firewhale_gc_collected_total", "Stale NFTables objects removed by the garbage collector", ("kind",)))
+gc_backlog = registry.register(Gauge(
+    "firewhale_gc_backlog", "Collectable objects the last garbage collection sweep left for later ones"))
+
+# === NFTables (both Firewhale and the NFAgent) ===
+
+nft_command_seconds = registry.register(Histogram(
+    "firewhale_nft_command_seconds", "NFTables command latency", ("backend",)))
+nft_command_errors = registry.register(Counter(
+    "firewhale_nft_command_errors_total", "NFTables commands that failed", ("backend",)))
+nft_transaction_commands = registry.register(Histogram(
+    "firewhale_nft_transaction_commands", "Commands per NFTables transaction", ("backend",), buckets=SIZE_BUCKETS))
+
+# === NFAgent ===
+
+agent_queue_depth = registry.register(Gauge(
+    "firewhale_agent_queue_depth", "Commands waiting to be committed by the NFAgent"))
+agent_wait_seconds = registry.register(Histogram(
+    "firewhale_agent_wait_seconds", "Time commands waited in the NFAgent before their transaction started"))
+agent_batch_commands = registry.register(Histogram(
+    "firewhale_agent_batch_commands", "Requests joined into one NFAgent transaction", buckets=SIZE_BUCKETS))
+agent_fallbacks = registry.register(Counter(
+    "firewhale_agent_fallbacks_total", "Joint NFAgent transactions that failed and were re-run command by command"))
+
+
+def observe_nft_command(backend, cmd, seconds: float, *, ok: bool = True):
+    """ Records one NFTables call made through `backend` """
+    name = getattr(backend, "name", type(backend).__name__)
+    nft_command_seconds.observe(seconds, backend=name)
+    if not ok:
+        nft_command_errors.inc(backend=name)
+    if isinstance(cmd, dict):
+        cmd = cmd["nftables"] if "nftables" in cmd else [cmd]
+    if isinstance(cmd, list):
+        nft_transaction_commands.observe(len(cmd), backend=name)
+
+
+# === Exporter ===
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = registry.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _UnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        # BaseHTTPRequestHandler expects an (address, port) client address
+        request, _ = super().get_request()
+        return request, ("local", 0)
+
+
+def start_metrics_server(listen: str):
+    """ Serves `/metrics` on a background thread. `listen` is `[host]:port` or `unix:/path/to/socket` """
+    if listen.startswith("unix:"):
+        path = listen[len("unix:"):]
+        if os.path.exists(path):
+            os.remove(path)
+        server = _UnixHTTPServer(path, _Handler)
+    else:
+        host, _, port = listen.rpartition(":")
+        server = ThreadingHTTPServer((host or "0.0.0.0", int(port)), _Handler)
+        server.daemon_threads = True
+
+    Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Serving metrics on {listen}")
+    return server
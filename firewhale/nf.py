@@ -1,9 +1,28 @@
 
-from typing import Literal
+import re
+import json
+import hashlib
+import time
+from difflib import SequenceMatcher
+from typing import List, Literal
 from .nfbackends import nf_backend_store
+from .metrics import observe_nft_command
+from .shadow import nf_shadow
 
 def nfc(cmd, *, throw: bool | Literal["continue"] = True):
-    return nf_backend_store.current_backend.cmd(cmd, throw=throw)
+    backend = nf_backend_store.current_backend
+    start = time.perf_counter()
+    try:
+        result = backend.cmd(cmd, throw=throw)
+    except Exception:
+        if backend.timed:
+            observe_nft_command(backend, cmd, time.perf_counter() - start, ok=False)
+        raise
+    if backend.timed:
+        observe_nft_command(backend, cmd, time.perf_counter() - start)
+    if backend.commits:
+        nf_shadow.observe(cmd, ok=throw is True)
+    return result
 
 
 def _extract_fq_table(*args):
@@ -124,6 +143,56 @@ def rulesEqual(rule1, rule2, *, by_comment=False):
         return False
     return True
 
+RULE_IDENTITY_RE = re.compile(r"^\[fw:([0-9a-f]+)\]")
+
+def rule_identity(rule) -> str:
+    """ Content hash of a rule, read back from its comment tag if it has one """
+    comment = rule.get("comment") or ""
+    m = RULE_IDENTITY_RE.match(comment)
+    if m: return m.group(1)
+    return hashlib.sha1(json.dumps([rule.get("expr"), comment], sort_keys=True).encode()).hexdigest()[:12]
+
+def with_rule_identity(rule):
+    """ Tags the rule's comment with its content hash, so it can be matched against rules listed from the kernel """
+    comment = rule.get("comment")
+    if comment and RULE_IDENTITY_RE.match(comment):
+        return rule
+    ident = rule_identity(rule)
+    return { **rule, "comment": f"[fw:{ident}] {comment}" if comment else f"[fw:{ident}]" }
+
+def diff_chain_rules(chain, installed: List[dict], desired: List[dict]) -> List[dict]:
+    """
+    Commands that turn the `installed` rules of a chain (which must have handles) into the `desired` rules.
+    Rules are matched by identity, so unchanged rules (and their counters) are left in place.
+    """
+    old_keys = [rule_identity(r) for r in installed]
+    new_keys = [rule_identity(r) for r in desired]
+
+    commands = []
+    matcher = SequenceMatcher(a=old_keys, b=new_keys, autojunk=False)
+    for op, i1, i2, j1, j2 in matcher.get_opcodes():
+        if op == "equal": continue
+
+        olds = installed[i1:i2]
+        news = desired[j1:j2]
+        n = min(len(olds), len(news))
+
+        for old, new in zip(olds[:n], news[:n]):
+            commands.append({ "replace": { "rule": { **new, "handle": old["handle"] } } })
+
+        for old in olds[n:]:
+            commands.append({ "delete": { "rule": rule_for_chain(chain, { "handle": old["handle"] }) } })
+
+        extra = news[n:]
+        if extra and i2 < len(installed):
+            # Inserting before the next installed rule keeps the new rules in order
+            anchor = installed[i2]["handle"]
+            commands.extend({ "insert": { "rule": { **r, "handle": anchor } } } for r in extra)
+        elif extra:
+            commands.extend({ "add": { "rule": r } } for r in extra)
+
+    return commands
+
 def rule_for_chain(chain, rule):
     return { "family": chain["family"], "table": chain["table"], "chain": chain["name"], **rule }
 
@@ -40,6 +40,11 @@ class NFTBackendStore:
 
     @contextmanager
     def with_backend(self, backend: NFTBackend):
+        previous = getattr(self._local, "current_backend", None)
         self._local.current_backend = backend
+        try:
+            yield backend
+        finally:
+            self._local.current_backend = previous
 
 nf_backend_store = NFTBackendStore()
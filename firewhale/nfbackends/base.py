@@ -1,5 +1,5 @@
 
-from threading import Lock
+from threading import RLock
 from typing import Literal
 
 
@@ -8,8 +8,15 @@ class NftError(Exception):
 
 
 class NFTBackend:
+    # False for backends that don't actually apply commands to the kernel
+    commits = True
+    # Label for this backend's metrics
+    name = "unknown"
+    # False for backends whose calls aren't NFTables commands, to keep them out of the command latency metrics
+    timed = True
+
     def __init__(self):
-        self._lock = Lock()
+        self._lock = RLock()
         self.on_connect = None
 
     def connect(self):
@@ -0,0 +1,76 @@
+
+import time
+from typing import List, Literal
+
+from .base import NFTBackend
+from ..metrics import observe_nft_command
+from ..shadow import nf_shadow
+
+
+class CollectingNFTBackend(NFTBackend):
+    """
+    Records write commands instead of executing them so they can be committed later as one transaction.
+    Read-only (`list ...`) commands are passed through to the upstream backend.
+    Recorded commands are applied to the shadow state straight away, so later steps of the same build see
+    the staged state; the shadow is marked for reload if the commit fails.
+    """
+    name = "collect"
+    # Recording is next to free - the commit observes the upstream calls instead
+    timed = False
+
+    def __init__(self, upstream: NFTBackend):
+        super().__init__()
+        self.upstream = upstream
+        # Each nfc() call is kept as its own group so that chunked commits never split a call
+        self.groups: List[List[dict]] = []
+
+    def cmd(self, cmd, *, throw: bool | Literal["continue"] = True):
+        if isinstance(cmd, str):
+            if cmd.startswith("list "):
+                return self.upstream.cmd(cmd, throw=throw)
+            raise ValueError(f"Cannot collect non-JSON command: {cmd}")
+
+        if isinstance(cmd, dict):
+            cmd = cmd["nftables"] if "nftables" in cmd else [cmd]
+
+        if cmd:
+            self.groups.append(list(cmd))
+
+    @property
+    def command_count(self):
+        return sum(len(g) for g in self.groups)
+
+    def chunks(self, chunk_size: int = None) -> List[List[dict]]:
+        """ Packs the recorded groups into transactions of at most `chunk_size` commands (a single transaction if None) """
+        if not chunk_size:
+            return [[c for g in self.groups for c in g]] if self.groups else []
+
+        chunks = []
+        current = []
+        for group in self.groups:
+            if current and len(current) + len(group) > chunk_size:
+                chunks.append(current)
+                current = []
+            current.extend(group)
+        if current:
+            chunks.append(current)
+        return chunks
+
+    def commit(self, *, chunk_size: int = None) -> int:
+        """ Sends the recorded commands to the upstream backend. Returns the number of transactions used """
+        chunks = self.chunks(chunk_size)
+        try:
+            for chunk in chunks:
+                start = time.perf_counter()
+                try:
+                    self.upstream.cmd(chunk)
+                except Exception:
+                    observe_nft_command(self.upstream, chunk, time.perf_counter() - start, ok=False)
+                    raise
+                observe_nft_command(self.upstream, chunk, time.perf_counter() - start)
+        except Exception:
+            nf_shadow.dirty = True
+            raise
+        finally:
+            self.groups = []
+        return len(chunks)
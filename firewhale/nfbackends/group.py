@@ -0,0 +1,141 @@
+
+import asyncio
+import time
+from dataclasses import dataclass, field
+from typing import List, Literal
+
+from .base import NFTBackend, NftError
+from .. import metrics, tracing
+
+
+@dataclass
+class GroupCommitStats:
+    batches: int = 0
+    commands: int = 0
+    max_batch: int = 0
+    # Batches that failed as a whole and were re-run command by command
+    fallbacks: int = 0
+    commit_time: float = 0
+
+    def __str__(self):
+        avg_size = self.commands / self.batches if self.batches else 0
+        avg_ms = self.commit_time / self.batches * 1000 if self.batches else 0
+        return (
+            f"batches={self.batches} commands={self.commands} avg_batch={avg_size:.1f} max_batch={self.max_batch}"
+            f" fallbacks={self.fallbacks} avg_commit={avg_ms:.2f}ms"
+        )
+
+
+@dataclass
+class _Pending:
+    cmd: List[dict] | str
+    throw: bool | Literal["continue"]
+    future: asyncio.Future
+    queued_at: float = field(default_factory=time.monotonic)
+    # Span of the request, so that the commit can be traced under it
+    span: object = field(default_factory=tracing.current_span)
+
+    @property
+    def batchable(self):
+        # Only plain JSON write commands can share a transaction - `list`s and non-throwing commands run alone
+        return isinstance(self.cmd, list) and self.throw is True
+
+
+def _as_command_list(cmd):
+    if isinstance(cmd, dict):
+        return cmd["nftables"] if "nftables" in cmd else [cmd]
+    return cmd
+
+
+class GroupCommitter:
+    """
+    Joins commands that arrive within `window` seconds of each other (or queue up while a commit is running)
+    into one nft transaction. If the joint transaction fails, its commands are re-run one by one so that
+    each caller gets the result its own command would have had.
+    """
+
+    def __init__(self, nfb: NFTBackend, *, window: float = 0.005, max_batch: int = 1000):
+        self.nfb = nfb
+        self.window = window
+        self.max_batch = max_batch
+        self.stats = GroupCommitStats()
+        self._queue = asyncio.Queue[_Pending]()
+        metrics.agent_queue_depth.set_function(self._queue.qsize)
+
+    async def submit(self, cmd, *, throw: bool | Literal["continue"] = True):
+        """ Queues a command and waits for its result. Raises NftError like NFTBackend.cmd """
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait(_Pending(_as_command_list(cmd), throw, future))
+        return await future
+
+    async def run(self):
+        held = None
+        while True:
+            first = held or await self._queue.get()
+            held = None
+
+            batch = [first]
+            if first.batchable:
+                deadline = time.monotonic() + self.window
+                while len(batch) < self.max_batch:
+                    if self._queue.empty():
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0: break
+                        try:
+                            item = await asyncio.wait_for(self._queue.get(), remaining)
+                        except TimeoutError:
+                            break
+                    else:
+                        item = self._queue.get_nowait()
+
+                    if not item.batchable:
+                        held = item
+                        break
+                    batch.append(item)
+
+            await self._commit(batch)
+
+    async def _commit(self, batch: List[_Pending]):
+        start = time.monotonic()
+        for p in batch:
+            metrics.agent_wait_seconds.observe(start - p.queued_at)
+        metrics.agent_batch_commands.observe(len(batch))
+
+        # Traced under the first request, linked to the others that joined the transaction
+        with tracing.use_span(batch[0].span), tracing.span("nfb.cmd", links=[p.span for p in batch[1:]], requests=len(batch)):
+            if len(batch) == 1:
+                await self._run_one(batch[0])
+            else:
+                joined = [c for p in batch for c in p.cmd]
+                try:
+                    data = await asyncio.to_thread(self.nfb.cmd, joined)
+                    metrics.observe_nft_command(self.nfb, joined, time.monotonic() - start)
+                    for p in batch:
+                        self._resolve(p, data)
+                except NftError:
+                    metrics.observe_nft_command(self.nfb, joined, time.monotonic() - start, ok=False)
+                    metrics.agent_fallbacks.inc()
+                    self.stats.fallbacks += 1
+                    for p in batch:
+                        await self._run_one(p)
+
+        self.stats.batches += 1
+        self.stats.commands += len(batch)
+        self.stats.max_batch = max(self.stats.max_batch, len(batch))
+        self.stats.commit_time += time.monotonic() - start
+
+    async def _run_one(self, p: _Pending):
+        start = time.monotonic()
+        try:
+            data = await asyncio.to_thread(self.nfb.cmd, p.cmd, throw=p.throw)
+            metrics.observe_nft_command(self.nfb, p.cmd, time.monotonic() - start)
+        except Exception as e:
+            metrics.observe_nft_command(self.nfb, p.cmd, time.monotonic() - start, ok=False)
+            if not p.future.done():
+                p.future.set_exception(e)
+            return
+        self._resolve(p, data)
+
+    def _resolve(self, p: _Pending, data):
+        if not p.future.done():
+            p.future.set_result(data)
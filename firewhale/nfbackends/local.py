@@ -3,17 +3,30 @@ import json
 from .base import NFTBackend, NftError
 from typing import Literal
 
-from nftables import Nftables
+# Created on first use, so that importing Firewhale doesn't need the libnftables bindings
+_nft = None
 
-nft = Nftables()
-nft.set_json_output(True)
+def _nftables():
+    global _nft
+    if _nft is None:
+        from nftables import Nftables
+        _nft = Nftables()
+        _nft.set_json_output(True)
+    return _nft
 
 class LocalNFTBackend(NFTBackend):
+    name = "local"
+
     def cmd(self, cmd, *, throw: bool | Literal["continue"] = True):
+        # libnftables contexts are not thread-safe
+        with self:
+            return self._cmd(cmd, throw=throw)
+
+    def _cmd(self, cmd, *, throw: bool | Literal["continue"] = True):
         if isinstance(cmd, list):
             if throw == "continue":
                 for c in cmd:
-                    self.cmd(c, throw=False)
+                    self._cmd(c, throw=False)
                 return
 
             cmd = { "nftables": cmd }
@@ -21,14 +34,14 @@ class LocalNFTBackend(NFTBackend):
         if isinstance(cmd, dict):
             if "nftables" not in cmd:
                 cmd = { "nftables": [cmd] }
-            rc, output, error = nft.json_cmd(cmd)
+            rc, output, error = _nftables().json_cmd(cmd)
         else:
-            rc, output, error = nft.cmd(cmd)
+            rc, output, error = _nftables().cmd(cmd)
 
         if rc != 0 and throw == True:
             raise NftError(error)
 
-        if nft.get_json_output() and isinstance(output, str) and output != "":
+        if _nftables().get_json_output() and isinstance(output, str) and output != "":
             output = json.loads(output)
 
         if isinstance(output, dict):
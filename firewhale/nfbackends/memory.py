@@ -0,0 +1,450 @@
+
+import copy
+import errno
+import json
+import os
+import re
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Literal, Tuple
+
+from .base import NFTBackend, NftError
+
+
+@dataclass
+class MemoryStats:
+    transactions: int = 0
+    commands: int = 0
+    listings: int = 0
+    errors: int = 0
+
+    def __str__(self):
+        return f"transactions={self.transactions} commands={self.commands} listings={self.listings} errors={self.errors}"
+
+
+@dataclass
+class _Chain:
+    spec: dict
+    rules: List[dict] = field(default_factory=list)
+
+@dataclass
+class _Set:
+    spec: dict
+    # Frozen key -> (key as given, data). Data is None for plain sets
+    elements: Dict[Any, Tuple[Any, Any]] = field(default_factory=dict)
+
+    @property
+    def is_map(self):
+        return "map" in self.spec
+
+@dataclass
+class _Table:
+    family: str
+    name: str
+    handle: int
+    chains: Dict[str, _Chain] = field(default_factory=dict)
+    sets: Dict[str, _Set] = field(default_factory=dict)
+    # ("chain" | "set", name) -> number of rules and map elements referring to it
+    refs: Counter = field(default_factory=Counter)
+    next_handle: int = 1
+
+    def new_handle(self):
+        self.next_handle += 1
+        return self.next_handle
+
+
+def _error(code: int, what: str):
+    return NftError(f"Error: Could not process rule: {os.strerror(code)}\n{what}")
+
+def _elem_key(elem):
+    if isinstance(elem, dict) and "elem" in elem:
+        return elem["elem"]["val"]
+    return elem
+
+def _freeze(v):
+    """ Hashable form of an element key (plain strings stay as they are) """
+    if isinstance(v, (dict, list)):
+        return json.dumps(v, sort_keys=True)
+    return v
+
+def _jump_targets(obj) -> List[str]:
+    """ Chains that an expression tree or verdict jumps/goes to """
+    targets = []
+    if isinstance(obj, dict):
+        for k, v in obj.items():
+            if k in ("jump", "goto") and isinstance(v, dict) and "target" in v:
+                targets.append(v["target"])
+            else:
+                targets.extend(_jump_targets(v))
+    elif isinstance(obj, list):
+        for v in obj:
+            targets.extend(_jump_targets(v))
+    return targets
+
+def _set_references(obj) -> List[str]:
+    """ Named sets/maps (`@name`) that an expression tree refers to """
+    refs = []
+    if isinstance(obj, str) and obj.startswith("@"):
+        refs.append(obj[1:])
+    elif isinstance(obj, dict):
+        for v in obj.values():
+            refs.extend(_set_references(v))
+    elif isinstance(obj, list):
+        for v in obj:
+            refs.extend(_set_references(v))
+    return refs
+
+def _listed_expr(expr):
+    # The kernel reports counter values, so listed rules never have a bare `counter`
+    return [{ "counter": { "packets": 0, "bytes": 0 } } if e == { "counter": None } else e for e in expr]
+
+
+class MemoryNFTBackend(NFTBackend):
+    """
+    In-memory stand-in for the kernel's nf_tables state, for benchmarks and local experiments.
+    Accepts the same JSON commands and `list` strings that `nfc` sends and answers like libnftables:
+    transactions are atomic, objects get handles, and the usual errors (missing objects, deleting chains or sets
+    that are still referenced, conflicting map elements) are raised as NftError.
+    `latency` adds a fixed delay to every call to simulate the cost of a real commit.
+    """
+    name = "memory"
+
+    def __init__(self, *, docker_chains: bool = True, latency: float = 0):
+        super().__init__()
+        self.latency = latency
+        self.stats = MemoryStats()
+        self.tables: Dict[Tuple[str, str], _Table] = {}
+        self._next_table_handle = 0
+
+        if docker_chains:
+            self.cmd([
+                { "add": { "table": { "family": "ip", "name": "filter" } } },
+                { "add": { "chain": { "family": "ip", "table": "filter", "name": "FORWARD", "type": "filter", "hook": "forward", "prio": 0, "policy": "drop" } } },
+                { "add": { "chain": { "family": "ip", "table": "filter", "name": "DOCKER" } } },
+                { "add": { "chain": { "family": "ip", "table": "filter", "name": "DOCKER-USER" } } },
+                { "add": { "rule": { "family": "ip", "table": "filter", "chain": "FORWARD", "expr": [{ "jump": { "target": "DOCKER-USER" } }] } } },
+                { "add": { "rule": { "family": "ip", "table": "filter", "chain": "FORWARD", "expr": [{ "jump": { "target": "DOCKER" } }] } } },
+            ])
+            self.stats = MemoryStats()
+
+    def cmd(self, cmd, *, throw: bool | Literal["continue"] = True):
+        with self:
+            if self.latency:
+                time.sleep(self.latency)
+
+            if isinstance(cmd, str):
+                try:
+                    return self._list(cmd)
+                except NftError:
+                    self.stats.errors += 1
+                    if throw == True: raise
+                    return None
+
+            if isinstance(cmd, dict):
+                cmd = cmd["nftables"] if "nftables" in cmd else [cmd]
+
+            if throw == "continue":
+                for c in cmd:
+                    self._transaction([c], throw=False)
+                return
+
+            return self._transaction(cmd, throw=throw)
+
+    # === Transactions ===
+
+    def _transaction(self, commands: List[dict], *, throw):
+        self.stats.transactions += 1
+        self.stats.commands += len(commands)
+
+        undo: List[Callable] = []
+        try:
+            for c in commands:
+                for verb, body in c.items():
+                    for kind, spec in body.items():
+                        handler = getattr(self, f"_{verb}_{kind}", None)
+                        if handler is None:
+                            raise NftError(f"Error: Unsupported command: {verb} {kind}")
+                        handler(copy.deepcopy(spec), undo)
+        except NftError:
+            self.stats.errors += 1
+            for fn in reversed(undo):
+                fn()
+            if throw == True: raise
+            return None
+        return ""
+
+    def _table(self, spec, *, name_key="table") -> _Table:
+        table = self.tables.get((spec.get("family", "ip"), spec[name_key]))
+        if table is None:
+            raise _error(errno.ENOENT, f"table {spec.get('family', 'ip')} {spec[name_key]}")
+        return table
+
+    def _chain(self, spec, *, name_key="name") -> Tuple[_Table, _Chain]:
+        table = self._table(spec)
+        chain = table.chains.get(spec[name_key])
+        if chain is None:
+            raise _error(errno.ENOENT, f"chain {spec['table']} {spec[name_key]}")
+        return table, chain
+
+    def _set(self, spec) -> Tuple[_Table, _Set]:
+        table = self._table(spec)
+        s = table.sets.get(spec["name"])
+        if s is None:
+            raise _error(errno.ENOENT, f"set {spec['table']} {spec['name']}")
+        return table, s
+
+    def _count_refs(self, table: _Table, obj, delta: int):
+        """ Tracks which chains and sets rules and map elements refer to, so deletes can be refused cheaply """
+        for target in _jump_targets(obj):
+            table.refs[("chain", target)] += delta
+        for name in _set_references(obj):
+            table.refs[("set", name)] += delta
+
+    def _tracked(self, table: _Table, obj, undo):
+        """ Counts the references of a newly stored rule/element, and uncounts them if the transaction is rolled back """
+        self._count_refs(table, obj, 1)
+        undo.append(lambda: self._count_refs(table, obj, -1))
+
+    def _untracked(self, table: _Table, obj, undo):
+        self._count_refs(table, obj, -1)
+        undo.append(lambda: self._count_refs(table, obj, 1))
+
+    # --- Tables ---
+
+    def _add_table(self, spec, undo):
+        key = (spec.get("family", "ip"), spec["name"])
+        if key in self.tables: return
+        self._next_table_handle += 1
+        self.tables[key] = _Table(key[0], key[1], self._next_table_handle)
+        undo.append(lambda: self.tables.pop(key, None))
+
+    def _delete_table(self, spec, undo):
+        table = self._table(spec, name_key="name")
+        key = (table.family, table.name)
+        del self.tables[key]
+        undo.append(lambda: self.tables.__setitem__(key, table))
+
+    # --- Chains ---
+
+    def _add_chain(self, spec, undo, *, exclusive=False):
+        table = self._table(spec)
+        name = spec["name"]
+        if name in table.chains:
+            if exclusive:
+                raise _error(errno.EEXIST, f"chain {spec['table']} {name}")
+            return
+        spec = { k: v for k, v in spec.items() if k != "handle" }
+        table.chains[name] = _Chain({ **spec, "handle": table.new_handle() })
+        undo.append(lambda: table.chains.pop(name, None))
+
+    def _create_chain(self, spec, undo):
+        self._add_chain(spec, undo, exclusive=True)
+
+    def _flush_chain(self, spec, undo):
+        table, chain = self._chain(spec)
+        rules = chain.rules
+        for rule in rules:
+            self._untracked(table, rule["expr"], undo)
+        chain.rules = []
+        undo.append(lambda: setattr(chain, "rules", rules))
+
+    def _delete_chain(self, spec, undo):
+        table, chain = self._chain(spec)
+        name = spec["name"]
+        if chain.rules or table.refs[("chain", name)] > 0:
+            raise _error(errno.EBUSY, f"chain {spec['table']} {name}")
+        del table.chains[name]
+        undo.append(lambda: table.chains.__setitem__(name, chain))
+
+    # --- Rules ---
+
+    def _rule_index(self, chain: _Chain, handle) -> int:
+        for i, r in enumerate(chain.rules):
+            if r["handle"] == handle:
+                return i
+        raise _error(errno.ENOENT, f"rule handle {handle}")
+
+    def _new_rule(self, table: _Table, spec, undo) -> dict:
+        rule = { k: v for k, v in spec.items() if k != "handle" }
+        for target in _jump_targets(rule["expr"]):
+            if target not in table.chains:
+                raise _error(errno.ENOENT, f"jump target {target}")
+        for name in _set_references(rule["expr"]):
+            if name not in table.sets:
+                raise _error(errno.ENOENT, f"set {name}")
+        rule["handle"] = table.new_handle()
+        self._tracked(table, rule["expr"], undo)
+        return rule
+
+    def _insert_at(self, chain: _Chain, idx: int, rule: dict, undo):
+        chain.rules.insert(idx, rule)
+        undo.append(lambda: chain.rules.remove(rule))
+
+    def _add_rule(self, spec, undo):
+        table, chain = self._chain(spec, name_key="chain")
+        idx = self._rule_index(chain, spec["handle"]) + 1 if "handle" in spec else len(chain.rules)
+        self._insert_at(chain, idx, self._new_rule(table, spec, undo), undo)
+
+    def _insert_rule(self, spec, undo):
+        table, chain = self._chain(spec, name_key="chain")
+        idx = self._rule_index(chain, spec["handle"]) if "handle" in spec else 0
+        self._insert_at(chain, idx, self._new_rule(table, spec, undo), undo)
+
+    def _replace_rule(self, spec, undo):
+        table, chain = self._chain(spec, name_key="chain")
+        idx = self._rule_index(chain, spec.get("handle"))
+        old = chain.rules[idx]
+        self._untracked(table, old["expr"], undo)
+        rule = self._new_rule(table, spec, undo)
+        chain.rules[idx] = rule
+        undo.append(lambda: chain.rules.__setitem__(chain.rules.index(rule), old))
+
+    def _delete_rule(self, spec, undo):
+        table, chain = self._chain(spec, name_key="chain")
+        idx = self._rule_index(chain, spec.get("handle"))
+        rule = chain.rules.pop(idx)
+        self._untracked(table, rule["expr"], undo)
+        undo.append(lambda: chain.rules.insert(idx, rule))
+
+    # --- Sets and Maps ---
+
+    def _add_set(self, spec, undo, *, exclusive=False):
+        table = self._table(spec)
+        name = spec["name"]
+        elems = spec.pop("elem", None)
+        if name in table.sets:
+            if exclusive:
+                raise _error(errno.EEXIST, f"set {spec['table']} {name}")
+        else:
+            spec = { k: v for k, v in spec.items() if k != "handle" }
+            table.sets[name] = _Set({ **spec, "handle": table.new_handle() })
+            undo.append(lambda: table.sets.pop(name, None))
+        if elems:
+            self._add_element({ "family": table.family, "table": table.name, "name": name, "elem": elems }, undo)
+
+    def _create_set(self, spec, undo):
+        self._add_set(spec, undo, exclusive=True)
+
+    _add_map = _add_set
+    _create_map = _create_set
+
+    def _flush_set(self, spec, undo):
+        table, s = self._set(spec)
+        elements = s.elements
+        for _, data in elements.values():
+            self._untracked(table, data, undo)
+        s.elements = {}
+        undo.append(lambda: setattr(s, "elements", elements))
+
+    _flush_map = _flush_set
+
+    def _delete_set(self, spec, undo):
+        table, s = self._set(spec)
+        name = spec["name"]
+        if table.refs[("set", name)] > 0:
+            raise _error(errno.EBUSY, f"set {spec['table']} {name}")
+        for _, data in s.elements.values():
+            self._untracked(table, data, undo)
+        del table.sets[name]
+        undo.append(lambda: table.sets.__setitem__(name, s))
+
+    _delete_map = _delete_set
+
+    def _element_items(self, s: _Set, spec):
+        elems = spec.get("elem")
+        if not isinstance(elems, list):
+            elems = [elems]
+        for elem in elems:
+            data = None
+            if s.is_map and isinstance(elem, list):
+                # `[key, data]` - deletes may also pass just the key
+                elem, data = elem[0], (elem[1] if len(elem) > 1 else None)
+            raw = _elem_key(elem)
+            yield _freeze(raw), raw, data
+
+    def _add_element(self, spec, undo, *, exclusive=False):
+        table, s = self._set(spec)
+        for key, raw, data in self._element_items(s, spec):
+            if s.is_map:
+                if data is None:
+                    raise _error(errno.EINVAL, f"map element {raw} without data")
+                for target in _jump_targets(data):
+                    if target not in table.chains:
+                        raise _error(errno.ENOENT, f"jump target {target}")
+            if key in s.elements:
+                if exclusive:
+                    raise _error(errno.EEXIST, f"element {raw}")
+                if s.elements[key][1] != data:
+                    raise _error(errno.EBUSY, f"element {raw}")
+                continue
+            s.elements[key] = (raw, data)
+            self._tracked(table, data, undo)
+            undo.append(lambda key=key: s.elements.pop(key, None))
+
+    def _create_element(self, spec, undo):
+        self._add_element(spec, undo, exclusive=True)
+
+    def _delete_element(self, spec, undo):
+        table, s = self._set(spec)
+        for key, raw, _ in self._element_items(s, spec):
+            if key not in s.elements:
+                raise _error(errno.ENOENT, f"element {raw}")
+            old = s.elements.pop(key)
+            self._untracked(table, old[1], undo)
+            undo.append(lambda key=key, old=old: s.elements.__setitem__(key, old))
+
+    # === Listing ===
+
+    def _list(self, cmd: str) -> List[dict]:
+        self.stats.listings += 1
+        words = cmd.split()
+        if words[:2] == ["list", "ruleset"]:
+            tables = list(self.tables.values())
+            return self._listing(tables)
+
+        match = re.match(r"^list (table|chain|map|set) (\S+) (\S+)(?: (\S+))?$", cmd.strip())
+        if not match:
+            raise NftError(f"Error: Unsupported command: {cmd}")
+        kind, family, table_name, name = match.groups()
+        table = self._table({ "family": family, "table": table_name })
+
+        if kind == "table":
+            return self._listing([table])
+        if kind == "chain":
+            _, chain = self._chain({ "family": family, "table": table_name, "name": name })
+            return [self._metainfo(), self._chain_obj(table, chain), *self._rule_objs(table, chain)]
+        _, s = self._set({ "family": family, "table": table_name, "name": name })
+        return [self._metainfo(), self._set_obj(table, s)]
+
+    def _metainfo(self):
+        return { "metainfo": { "version": "memory", "release_name": "Firewhale MemoryNFTBackend", "json_schema_version": 1 } }
+
+    def _listing(self, tables: List[_Table]) -> List[dict]:
+        out = [self._metainfo()]
+        for table in tables:
+            out.append({ "table": { "family": table.family, "name": table.name, "handle": table.handle } })
+            out.extend(self._chain_obj(table, chain) for chain in table.chains.values())
+            out.extend(self._set_obj(table, s) for s in table.sets.values())
+            for chain in table.chains.values():
+                out.extend(self._rule_objs(table, chain))
+        return out
+
+    def _chain_obj(self, table: _Table, chain: _Chain):
+        return { "chain": { **copy.deepcopy(chain.spec), "family": table.family, "table": table.name } }
+
+    def _rule_objs(self, table: _Table, chain: _Chain):
+        for r in chain.rules:
+            rule = { **copy.deepcopy(r), "family": table.family, "table": table.name, "chain": chain.spec["name"] }
+            rule["expr"] = _listed_expr(rule["expr"])
+            yield { "rule": rule }
+
+    def _set_obj(self, table: _Table, s: _Set):
+        kind = "map" if s.is_map else "set"
+        obj = { **copy.deepcopy(s.spec), "family": table.family, "table": table.name }
+        if s.elements:
+            if s.is_map:
+                obj["elem"] = [[copy.deepcopy(raw), copy.deepcopy(data)] for raw, data in s.elements.values()]
+            else:
+                obj["elem"] = [copy.deepcopy(raw) for raw, _ in s.elements.values()]
+        return { kind: obj }
@@ -1,27 +1,148 @@
 
 import json, socket
 import threading
+import itertools
 import websockets as ws
 import os
 import time
+from collections import OrderedDict
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
 from websockets.sync.server import unix_serve
 
 from .base import NFTBackend, NftError
+from . import wire
+from .. import tracing
+
+# Version 1: one bare `{ nfcmd, throw }` message at a time, answered in order
+# Version 2: `hello` handshake, requests and responses carry an `id` and may be pipelined
+# Version 3: `hello` negotiates a compact encoding (see wire.py) for everything sent after it
+PROTOCOL_VERSION = 3
+
+# `list` responses contain the whole ruleset, which easily exceeds the websockets default of 1MiB
+MAX_MESSAGE_SIZE = 64 * 1024 * 1024
+
+HEARTBEAT_INTERVAL = 10
+HEARTBEAT_TIMEOUT = 20
+
+def command_timeout(cmd) -> float:
+    """ Seconds to wait for a command's response, scaled by the size of the transaction """
+    if isinstance(cmd, str):
+        return 30 if cmd.startswith("list ") else 5
+    if isinstance(cmd, dict):
+        cmd = cmd["nftables"] if "nftables" in cmd else [cmd]
+    return 5 + 0.05 * len(cmd)
+
+
+class AgentConnection:
+    """ One connected NFAgent. Responses are matched to requests by ID (or in order for version 1 agents) """
+
+    def __init__(self, sock: ws.server.ServerConnection):
+        self.sock = sock
+        self.protocol = 1
+        self.encoding = "json"
+        self.closed = False
+        self._ids = itertools.count(1)
+        self._pending: OrderedDict[int, Future] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def hello(self):
+        self.sock.send(json.dumps({ "hello": {
+            "protocol": PROTOCOL_VERSION,
+            "encodings": wire.available_encodings(),
+        } }))
+
+    def request(self, cmd, *, throw=True):
+        future = Future()
+        with self._lock:
+            if self.closed:
+                raise NftError("Not connected to agent")
+            rid = next(self._ids)
+            self._pending[rid] = future
+            message = {
+                "id": rid,
+                "nfcmd": cmd,
+                "throw": throw,
+            }
+            trace = tracing.inject()
+            if trace:
+                # Agents that don't trace ignore it
+                message["trace"] = trace
+            # Sent under the lock so that requests go out in ID order (version 1 agents answer in order)
+            self.sock.send(wire.encode(message, self.encoding))
+
+        timeout = command_timeout(cmd)
+        try:
+            result = future.result(timeout=timeout)
+        except FutureTimeoutError:
+            with self._lock:
+                # A version 1 response can't be told apart, so its slot has to stay queued for it
+                if self.protocol >= 2:
+                    self._pending.pop(rid, None)
+            raise NftError(f"Agent did not respond within {timeout:.1f}s")
+
+        if result["status"] == "error":
+            raise NftError(result["data"])
+
+        return result["data"]
+
+    def handle_message(self, message):
+        m = wire.decode(message)
+
+        if "hello" in m:
+            self.protocol = min(PROTOCOL_VERSION, m["hello"].get("protocol", 1))
+            self.encoding = wire.choose_encoding([m["hello"].get("encoding", "json")])
+            print(f"NFAgent speaks protocol version {self.protocol} ({self.encoding})")
+            return
+
+        with self._lock:
+            if "id" in m:
+                future = self._pending.pop(m["id"], None)
+            elif self._pending:
+                _, future = self._pending.popitem(last=False)
+            else:
+                future = None
+
+        if future is None:
+            # Response to a request that already timed out
+            return
+        future.set_result(m)
+
+    def run_heartbeat(self):
+        while not self.closed:
+            time.sleep(HEARTBEAT_INTERVAL)
+            try:
+                pong = self.sock.ping()
+                if not pong.wait(HEARTBEAT_TIMEOUT):
+                    print("NFAgent missed heartbeat - closing connection")
+                    self.sock.close()
+                    break
+            except ws.ConnectionClosed:
+                break
+
+    def close(self):
+        with self._lock:
+            self.closed = True
+            pending = list(self._pending.values())
+            self._pending.clear()
+        for future in pending:
+            future.set_exception(NftError("Agent disconnected"))
+
 
 class SocketNFTBackend(NFTBackend):
+    name = "agent"
+
     def __init__(self, socket_path):
         super().__init__()
         self.socket_path = socket_path
 
-        self.socket_lock = threading.Lock()
-        self.current_connection: ws.server.ServerConnection = None
+        self.current_connection: AgentConnection = None
 
         self.ws_server = None
         self.server_thread = None
 
     def connect(self):
         self.clean_socket()
-        self.ws_server = unix_serve(self.ws_server_handler, self.socket_path)
+        self.ws_server = unix_serve(self.ws_server_handler, self.socket_path, max_size=MAX_MESSAGE_SIZE)
         self.server_thread = threading.Thread(target=lambda: self.ws_server.serve_forever(), daemon=True)
         self.server_thread.start()
 
@@ -40,36 +161,37 @@ class SocketNFTBackend(NFTBackend):
     def ws_server_handler(self, sock: ws.server.ServerConnection):
         if self.current_connection is not None:
             print("Already connected - closing previous connection")
-            self.current_connection.close()
-        self.current_connection = sock
+            self.current_connection.sock.close()
+
+        conn = AgentConnection(sock)
+        conn.hello()
+        self.current_connection = conn
+
+        threading.Thread(target=conn.run_heartbeat, daemon=True).start()
 
         if self.on_connect is not None:
             self.on_connect()
 
         print("NFAgent Connected")
 
-        while True:
-            try:
-                with self.socket_lock:
-                    sock.ping()
-            except ws.ConnectionClosed:
-                print("NFAgent Disconnected")
-                break
-            time.sleep(10)
+        try:
+            for message in sock:
+                try:
+                    conn.handle_message(message)
+                except Exception as e:
+                    print("Invalid message from NFAgent:", e)
+        except ws.ConnectionClosed:
+            pass
+        finally:
+            print("NFAgent Disconnected")
+            conn.close()
+            if self.current_connection is conn:
+                self.current_connection = None
 
     def cmd(self, cmd, *, throw=True):
-        if self.current_connection is None:
+        conn = self.current_connection
+        if conn is None:
             raise NftError("Not connected to agent")
 
-        with self.socket_lock:
-            self.current_connection.send(json.dumps({
-                "nfcmd": cmd,
-                "throw": throw,
-            }))
-
-            result = json.loads(self.current_connection.recv(timeout=1))
-
-            if result["status"] == "error":
-                raise NftError(result["data"])
-
-            return result["data"]
+        with tracing.span("SocketNFTBackend.cmd"):
+            return conn.request(cmd, throw=throw)
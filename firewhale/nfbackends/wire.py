@@ -0,0 +1,80 @@
+
+import gc
+import json
+from contextlib import contextmanager
+from typing import List
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Binary frames start with a tag byte naming their encoding; text frames are always JSON
+TAG_MSGPACK = b"m"
+TAG_MSGPACK_ZSTD = b"z"
+
+# Payloads smaller than this aren't worth compressing
+COMPRESS_THRESHOLD = 4096
+
+# Decoding a full ruleset listing allocates millions of (acyclic) objects, which otherwise
+#   triggers the cyclic GC over and over and roughly triples decode time
+GC_PAUSE_THRESHOLD = 1024 * 1024
+
+
+def available_encodings() -> List[str]:
+    """ Encodings this side can speak, best first """
+    encodings = []
+    if msgpack is not None:
+        if zstandard is not None:
+            encodings.append("msgpack+zstd")
+        encodings.append("msgpack")
+    encodings.append("json")
+    return encodings
+
+def choose_encoding(offered: List[str]) -> str:
+    """ Best encoding out of the ones the peer offered that this side can speak """
+    available = available_encodings()
+    for encoding in offered or []:
+        if encoding in available:
+            return encoding
+    return "json"
+
+def encode(obj, encoding: str = "json") -> str | bytes:
+    if encoding == "json":
+        return json.dumps(obj)
+
+    data = msgpack.packb(obj)
+    if encoding == "msgpack+zstd" and len(data) >= COMPRESS_THRESHOLD:
+        return TAG_MSGPACK_ZSTD + zstandard.ZstdCompressor(level=3).compress(data)
+    return TAG_MSGPACK + data
+
+@contextmanager
+def _gc_paused():
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+def decode(message: str | bytes):
+    if isinstance(message, str):
+        loads, data = json.loads, message
+    else:
+        tag, data = message[:1], message[1:]
+        if tag == TAG_MSGPACK_ZSTD:
+            data = zstandard.ZstdDecompressor().decompress(data)
+        elif tag != TAG_MSGPACK:
+            raise ValueError(f"Unknown frame encoding: {tag!r}")
+        loads = msgpack.unpackb
+
+    if len(data) < GC_PAUSE_THRESHOLD:
+        return loads(data)
+    with _gc_paused():
+        return loads(data)
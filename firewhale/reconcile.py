@@ -0,0 +1,162 @@
+
+import time
+from dataclasses import dataclass, field
+from typing import List, Set
+
+from .nf import *
+from .nfbackends import nf_backend_store
+from .nfbackends.base import NftError
+from .nfbackends.collect import CollectingNFTBackend
+from .base import TABLE_FILTER, CONTAINER_CHAIN_SPECS, initialize_core_chains
+from .container import Container
+from .dockercache import container_cache
+from .ipmanager import IPSetManager
+from .rule import nft_service_set_name
+from .shadow import nf_shadow
+from .chains import unreferenced_chains, delete_chain_commands
+
+
+@dataclass
+class ReconcileStats:
+    containers: int = 0
+    stale_chains: int = 0
+    stale_elements: int = 0
+    commands: int = 0
+    transactions: int = 0
+    compile_time: float = 0
+    commit_time: float = 0
+    # Containers whose rules NFTables rejected
+    failed: List[str] = field(default_factory=list)
+
+    def __str__(self):
+        return (
+            f"{self.containers} containers, {self.stale_chains} stale chains, {self.stale_elements} stale map elements; "
+            f"{self.commands} commands in {self.transactions} transaction(s); "
+            f"compile {self.compile_time:.3f}s, commit {self.commit_time:.3f}s"
+            + (f"; failed: {', '.join(self.failed)}" if self.failed else "")
+        )
+
+
+def reconcile_all(*, chunk_size: int = None) -> ReconcileStats:
+    """
+    Compiles the complete desired state (core chains, verdict maps, container chains and service sets) in memory
+    and commits it as a single NFTables transaction.
+    If `chunk_size` is given, the commands are split into transactions of roughly that many commands,
+    but a single container's commands are never split.
+    If NFTables rejects the transaction, each container is committed on its own instead (see `stats.failed`).
+    """
+    stats = ReconcileStats()
+    started = time.perf_counter()
+
+    collector = CollectingNFTBackend(nf_backend_store.current_backend)
+
+    # The only listing needed - also (re)loads the shadow state
+    ruleset = nf_shadow.resync(nfc)
+
+    containers = [Container(c) for c in container_cache().list()]
+    stats.containers = len(containers)
+
+    # IPs that should be in the verdict maps, per the current Docker state
+    desired_ips = set()
+    for ctr in containers:
+        if not ctr.firewhale_enabled(): continue
+        desired_ips.update(ip for ip in ctr.container_ips() if ip)
+    Container.applied_ips.clear()
+    Container.applied_chains.clear()
+
+    with nf_backend_store.with_backend(collector):
+        _stage_base(stats, ruleset, desired_ips)
+        for ctr in containers:
+            ctr.apply_rules()
+        _stage_stale_chains(stats)
+
+    stats.commands = collector.command_count
+    compiled = time.perf_counter()
+    stats.compile_time = compiled - started
+
+    try:
+        stats.transactions = collector.commit(chunk_size=chunk_size)
+    except NftError as e:
+        print(f"Reconcile transaction was rejected, committing containers one at a time: {e}")
+        _commit_separately(stats, containers, desired_ips)
+    stats.commit_time = time.perf_counter() - compiled
+
+    return stats
+
+def _stage_base(stats: ReconcileStats, ruleset: List[dict], desired_ips: Set[str]):
+    """ Core chains, verdict maps without the elements of vanished IPs, and every subscribed service set """
+    existing_chains = [obj["chain"] for obj in ruleset if "chain" in obj and obj["chain"]["table"] == TABLE_FILTER]
+    initialize_core_chains(existing_chains)
+
+    # Remove map elements for IPs that no live container has.
+    #   Elements of live IPs that point at the wrong chain are re-pointed by apply_rules.
+    stats.stale_elements = 0
+    for cdef in CONTAINER_CHAIN_SPECS:
+        elements = nf_shadow.get_map_elements(cdef.map_name)
+        stale_ips = [ip for ip in elements.keys() if ip not in desired_ips]
+        if stale_ips:
+            stats.stale_elements += len(stale_ips)
+            nfc({ "delete": { "element": {
+                "family": "ip",
+                "table": TABLE_FILTER,
+                "name": cdef.map_name,
+                "elem": stale_ips,
+            }}})
+
+    # Containers only create the sets of services they are the first to subscribe to,
+    #   so after NFTables was flushed their rules would refer to missing sets
+    _add_service_sets()
+    IPSetManager.instance.resync_service_sets()
+
+def _add_service_sets():
+    services = IPSetManager.instance.service_subscriptions.keys()
+    if services:
+        nfc([
+            { "add": { "set": { "family": "ip", "table": TABLE_FILTER, "name": nft_service_set_name(svc), "type": "ipv4_addr" } } }
+            for svc in sorted(services)
+        ])
+
+def _stage_stale_chains(stats: ReconcileStats):
+    # The shadow reflects the staged commands by now, so this sees the final references
+    stale_chains = unreferenced_chains()
+    stats.stale_chains = len(stale_chains)
+    if stale_chains:
+        nfc(delete_chain_commands(stale_chains))
+
+def _commit_separately(stats: ReconcileStats, containers: List[Container], desired_ips: Set[str]):
+    """ Commits the base state and then each container in a transaction of its own, recording the ones that fail """
+    stats.transactions = 0
+    ruleset = nf_shadow.resync(nfc)
+    # Nothing else can be committed without the core chains
+    _commit_step(stats, lambda: _stage_base(stats, ruleset, desired_ips), throw=True)
+
+    for ctr in containers:
+        def step():
+            # A set whose subscription was recorded in a rejected transaction doesn't exist
+            _add_service_sets()
+            ctr.apply_rules()
+
+        if not _commit_step(stats, step):
+            stats.failed.append(ctr.id)
+            Container.applied_ips.pop(ctr.id, None)
+            Container.applied_chains.pop(ctr.id, None)
+
+    def finish():
+        _add_service_sets()
+        IPSetManager.instance.resync_service_sets()
+        _stage_stale_chains(stats)
+    _commit_step(stats, finish)
+
+def _commit_step(stats: ReconcileStats, step, *, throw: bool = False) -> bool:
+    """ Runs `step` against a fresh collector and commits what it staged as one transaction """
+    nf_shadow.ensure_loaded(nfc)
+    collector = CollectingNFTBackend(nf_backend_store.current_backend)
+    with nf_backend_store.with_backend(collector):
+        step()
+    try:
+        stats.transactions += collector.commit()
+    except NftError as e:
+        if throw: raise
+        print(f"Reconcile step was rejected: {e}")
+        return False
+    return True
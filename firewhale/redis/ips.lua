@@ -28,22 +28,50 @@ local sets = {
     'node'
 }
 
-local function set_ip(keys, argv)
-    -- IP, Service, Container, Node
-    local ip = keys[1]
+-- Every change is appended to a capped stream with ID 0-<version>, so nodes can replay what they missed
+local VERSION_KEY = 'firewhale:version'
+local CHANGES_KEY = 'firewhale:changes'
+local CHANGES_MAXLEN = 100000
+
+local function _log_change(ip, service, old_service)
+    -- Services are '' when the IP is removed / new. Returns the change's version
+    local version = redis.call('INCR', VERSION_KEY)
+    redis.call('XADD', CHANGES_KEY, 'MAXLEN', '~', CHANGES_MAXLEN, '0-' .. version,
+        'ip', ip, 'service', service, 'old', old_service)
+    return version
+end
+
+-- Every VERSION_CHECKPOINT-th version is published on its own, so nodes whose services are quiet keep up too
+local VERSION_CHANNEL = 'firewhale:version-checkpoint'
+local VERSION_CHECKPOINT = 1000
+
+local function _publish_change(version, ip, container, service, channels)
+    -- Notifies the services in `channels`. Service is '' when the IP was removed
+    for _, channel_service in ipairs(channels) do
+        -- Nodes that predate the change stream expect the bare IP on service:<service>
+        redis.call('PUBLISH', 'service:' .. channel_service, ip)
+        redis.call('PUBLISH', 'changes:service:' .. channel_service,
+            version .. ' ' .. ip .. ' ' .. container .. ' ' .. service)
+    end
+    if version % VERSION_CHECKPOINT == 0 then
+        redis.call('PUBLISH', VERSION_CHANNEL, version)
+    end
+end
+
+local function _set_ip(ip, service, container, node)
     local ipkey = 'ip:' .. ip
     local existing = hgetall(ipkey)
     local current = {
-        service = argv[1],
-        container = argv[2],
-        node = argv[3]
+        service = service,
+        container = container,
+        node = node
     }
 
     local same = true
     for _, set in ipairs(sets) do
         if not existing then
             same = false
-        elseif existing[set] ~= argv[set] then
+        elseif existing[set] ~= current[set] then
             same = false
             -- If different, remove frome old sets
             redis.call('SREM', set .. ':' .. existing[set] .. ":ips", ip)
@@ -59,16 +87,35 @@ local function set_ip(keys, argv)
 
     hmset(ipkey, current)
 
+    local version = _log_change(ip, current.service, existing and existing.service or '')
+
+    local channels = {}
     if existing and existing.service ~= current.service then
         -- Notify "remove" from old service
-        redis.call('PUBLISH', existing.service, ip)
+        table.insert(channels, existing.service)
     end
-
-    redis.call('PUBLISH', "service:" .. current.service, ip)
+    table.insert(channels, current.service)
+    _publish_change(version, ip, current.container, current.service, channels)
 
     return true
 end
 
+local function set_ip(keys, argv)
+    -- IP, Service, Container, Node
+    return _set_ip(keys[1], argv[1], argv[2], argv[3])
+end
+
+local function set_ips(keys, argv)
+    -- IPs; Node, then Service and Container for each IP
+    -- Returns 1 for each IP that changed, 0 otherwise
+    local node = argv[1]
+    local changed = {}
+    for i, ip in ipairs(keys) do
+        changed[i] = _set_ip(ip, argv[2 * i], argv[2 * i + 1], node) and 1 or 0
+    end
+    return changed
+end
+
 local function _remove_ip(ip, ekey, expectation)
     local ipkey = 'ip:' .. ip
 
@@ -86,7 +133,8 @@ local function _remove_ip(ip, ekey, expectation)
     end
 
     redis.call('DEL', ipkey)
-    redis.call('PUBLISH', "service:" .. iphash.service, ip)
+    local version = _log_change(ip, '', iphash.service)
+    _publish_change(version, ip, iphash.container, '', { iphash.service })
 
     return true
 end
@@ -112,6 +160,37 @@ local function remove_ips_by(keys, argv)
     return removed_ips
 end
 
+local function reconcile_node(keys, argv)
+    -- Node; IDs of the containers that still exist on it
+    -- Removes the node's IPs whose container is gone and drops index entries of IPs now owned by another node
+    -- Returns { removed IPs, repaired index entries }
+    local node = keys[1]
+    local nodekey = 'node:' .. node .. ':ips'
+
+    local live = {}
+    for _, cid in ipairs(argv) do
+        live[cid] = true
+    end
+
+    local removed = {}
+    local repaired = {}
+    for _, ip in ipairs(redis.call('SMEMBERS', nodekey)) do
+        local state = hgetall('ip:' .. ip)
+        if state and state.node == node then
+            if not live[state.container] and _remove_ip(ip, 'node', node) then
+                table.insert(removed, ip)
+            end
+        else
+            redis.call('SREM', nodekey, ip)
+            table.insert(repaired, ip)
+        end
+    end
+
+    return { removed, repaired }
+end
+
 redis.register_function('set_ip', set_ip)
+redis.register_function('set_ips', set_ips)
 redis.register_function('rm_ip', remove_ip)
 redis.register_function('rm_ips_by', remove_ips_by)
+redis.register_function('reconcile_node', reconcile_node)
@@ -1,7 +1,15 @@
 
-from typing import List, Set
+from collections import OrderedDict
+from dataclasses import dataclass
+from functools import lru_cache
+from threading import Lock
+from typing import Any, Dict, List, Set
+import ipaddress
+import json
 import re
 
+from .tracing import traced
+
 from typing import TYPE_CHECKING
 if TYPE_CHECKING:
     from .container import Container
@@ -15,9 +23,82 @@ ALIASES = {
 def nft_service_set_name(service: str):
     return f"firewhale-service:{service}:ip"
 
+
+@dataclass
+class CompileCacheStats:
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    invalidations: int = 0
+
+    def __str__(self):
+        return f"hits={self.hits} misses={self.misses} evictions={self.evictions} invalidations={self.invalidations}"
+
+
+class CompileCache:
+    """
+    Bounded LRU of compiled rules.
+    Keys include everything compilation reads from the container (namespace labels and network names/subnets),
+    so replicas of a service share entries. Entries can be dropped per network when its definition changes.
+    """
+
+    def __init__(self, maxsize: int = 4096):
+        self.maxsize = maxsize
+        self.stats = CompileCacheStats()
+        self._entries: OrderedDict[Any, Any] = OrderedDict()
+        # Network name -> keys of entries compiled against it
+        self._by_network: Dict[str, Set[Any]] = {}
+        self._lock = Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.stats.hits += 1
+                return self._entries[key]
+            self.stats.misses += 1
+            return None
+
+    def put(self, key, value, *, networks=()):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            for net in networks:
+                self._by_network.setdefault(net, set()).add(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.stats.evictions += 1
+
+    def invalidate_network(self, network: str):
+        with self._lock:
+            for key in self._by_network.pop(network, set()):
+                if self._entries.pop(key, None) is not None:
+                    self.stats.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self.stats.invalidations += len(self._entries)
+            self._entries.clear()
+            self._by_network.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+rule_cache = CompileCache()
+
 # Rule: { peer, src_port, dst_port, proto, jump }
 #   tcp; caddy.caddy; 80; srcport:8000-9000; jump:xyz-chain
 def normalize_rule(rule):
+    if isinstance(rule, str):
+        # Label strings are shared by every replica of a service - only parse each once
+        return dict(_normalize_rule_str(rule))
+    return _normalize_rule(rule)
+
+@lru_cache(maxsize=4096)
+def _normalize_rule_str(rule: str):
+    return tuple(_normalize_rule(rule).items())
+
+def _normalize_rule(rule):
     if isinstance(rule, str):
         bits: List[str] = rule.split(";")
         bits = [bit.strip() for bit in bits]
@@ -68,11 +149,54 @@ def full_network_name(container: 'Container', net_name: str):
 
     return net_name
 
+def _network_context(container: 'Container'):
+    """ The parts of a container that rule compilation depends on """
+    namespace = None
+    for k in ["com.docker.compose.project", "com.docker.stack.namespace"]:
+        if k in container.labels:
+            namespace = container.labels[k]
+            break
+
+    networks = []
+    for name, net in container.attrs["NetworkSettings"]["Networks"].items():
+        subnet = None
+        if net.get("IPAddress"):
+            subnet = str(ipaddress.ip_network(f"{net['IPAddress']}/{net.get('IPPrefixLen') or 32}", strict=False))
+        networks.append((name, subnet))
+
+    return (namespace, container.stack_namespace, tuple(sorted(networks)))
+
+@traced("make_nft_rule")
 def make_nft_rule(rule, container: 'Container', *,
     chain=None,
     addr_type: str,
     force_counter: bool = False,
     referenced_services: Set[str] = set(),
+):
+    context = _network_context(container)
+    key = (json.dumps(rule, sort_keys=True, default=str), addr_type, force_counter, context)
+
+    cached = rule_cache.get(key)
+    if cached is None:
+        services = set()
+        compiled = _compile_nft_rule(rule, container, addr_type=addr_type, force_counter=force_counter, referenced_services=services)
+        cached = (compiled, frozenset(services))
+        rule_cache.put(key, cached, networks=[name for name, _ in context[2]])
+
+    compiled, services = cached
+    referenced_services.update(services)
+
+    nfrule = dict(compiled)
+    if chain:
+        nfrule["family"] = chain["family"]
+        nfrule["table"] = chain["table"]
+        nfrule["chain"] = chain["name"]
+    return nfrule
+
+def _compile_nft_rule(rule, container: 'Container', *,
+    addr_type: str,
+    force_counter: bool,
+    referenced_services: Set[str],
 ):
     nfexprs = []
 
@@ -116,12 +240,13 @@ def make_nft_rule(rule, container: 'Container', *,
             # Local Networks
             if peer == "local-networks":
                 nets = ['10.0.0.0/8', '192.168.0.0/16', '172.16.0.0/12']
+                prefixes = []
                 for n in nets:
                     addr, prefix = n.split("/")
-                    nfexprs.append({ "match": {
-                        **m,
-                        "right": { "prefix": { "addr": addr, "len": int(prefix) } }
-                    } })
+                    prefixes.append({ "prefix": { "addr": addr, "len": int(prefix) } })
+                m["right"] = { "set": prefixes }
+
+                nfexprs.append({ "match": m })
                 return
 
             # Network
@@ -132,8 +257,9 @@ def make_nft_rule(rule, container: 'Container', *,
                 nets = container.attrs["NetworkSettings"]["Networks"]
                 if net_name not in nets:
                     raise ValueError(f"Network {net_name} not found")
-                net = net[net_name]
-                m["right"] = { "prefix": { "addr": net["IPAddress"], "len": net["IPPrefixLen"] } }
+                net = nets[net_name]
+                subnet = ipaddress.ip_network(f"{net['IPAddress']}/{net['IPPrefixLen']}", strict=False)
+                m["right"] = { "prefix": { "addr": str(subnet.network_address), "len": subnet.prefixlen } }
 
                 nfexprs.append({ "match": m })
                 return
@@ -157,7 +283,7 @@ def make_nft_rule(rule, container: 'Container', *,
                 return
 
             # IP/CIDR
-            match = re.match(r"^(\d+\.\d+\.\d+\.\d+)(?:\/(\d+))$", peer)
+            match = re.match(r"^(\d+\.\d+\.\d+\.\d+)(?:\/(\d+))?$", peer)
             if match:
                 ip, prefix = match.groups()
                 if prefix:
@@ -171,24 +297,26 @@ def make_nft_rule(rule, container: 'Container', *,
             # IP Range
             match = re.match(r"^(\d+\.\d+\.\d+\.\d+)\s*\-\s*(\d+\.\d+\.\d+\.\d+)$", peer)
             if match:
-                m["right"] = { "range": peer.split("-") }
+                m["right"] = { "range": list(match.groups()) }
 
                 nfexprs.append({ "match": m })
                 return
 
+            raise ValueError(f"Invalid peer: {peer}")
+
         build_host_matchers()
 
     if "src_port" in rule:
         nfexprs.append({ "match": {
             "op": "==",
-            "left": { "payload": { "protocol": "tcp", "field": "sport" } },
+            "left": { "payload": { "protocol": "th", "field": "sport" } },
             "right": parse_port(rule["src_port"]),
         }})
 
     if "dst_port" in rule:
         nfexprs.append({ "match": {
             "op": "==",
-            "left": { "payload": { "protocol": "tcp", "field": "sport" } },
+            "left": { "payload": { "protocol": "th", "field": "dport" } },
             "right": parse_port(rule["dst_port"]),
         }})
 
@@ -204,26 +332,162 @@ def make_nft_rule(rule, container: 'Container', *,
         # "Accept" Rules should actually be "Return" Rules)
         nfexprs.append({ "return": None })
 
-    rule = {
+    nfrule = {
         "expr": nfexprs,
     }
 
-    if chain:
-        rule["family"] = chain["family"]
-        rule["table"] = chain["table"]
-        rule["chain"] = chain["name"]
-
     if "comment" in rule:
-        rule["comment"] = rule["comment"]
+        nfrule["comment"] = rule["comment"]
 
-    return rule
+    return nfrule
 
 def parse_port(port):
+    port = str(port).strip()
     if port.isdigit():
         return int(port)
     elif re.match(r"^\d+\s*\-\s*\d+$", port):
-        return { "range": port.split("-") }
+        return { "range": [int(p) for p in port.split("-")] }
     elif "," in port:
-        return { "set": port.split(",") }
+        return { "set": [parse_port(p) for p in port.split(",")] }
     else:
         raise ValueError(f"Invalid port: {port}")
+
+
+# === Set Lookup Compaction ===
+
+LOOKUP_ANY_PEER = { "prefix": { "addr": "0.0.0.0", "len": 0 } }
+LOOKUP_ANY_PORT = { "range": [0, 65535] }
+
+def compact_nft_rules(nft_rules: List[dict], *, addr_type: str) -> List[dict]:
+    """
+    Folds consecutive compiled rules that end in the same statements (counter, log, verdict) into a single
+    `ip <addr> . meta l4proto . th dport` lookup in an anonymous interval set.
+    Rules that can't be expressed as set elements (service set peers, negated peers, source ports) are kept as-is,
+    and since only neighbouring rules are merged, rule order and therefore first-match semantics are preserved.
+    """
+    compacted = []
+    run = []
+    run_tail = None
+
+    def flush_run():
+        merged = _merge_lookup_rules(run, addr_type) if len(run) > 1 else None
+        if merged is not None:
+            compacted.append(merged)
+        else:
+            compacted.extend(nfr for nfr, _ in run)
+        run.clear()
+
+    for nfrule in nft_rules:
+        parts = _lookup_parts(nfrule, addr_type)
+        tail = json.dumps(parts[3], sort_keys=True) if parts else None
+        if run and (parts is None or tail != run_tail):
+            flush_run()
+        if parts is None:
+            compacted.append(nfrule)
+            continue
+        run.append((nfrule, parts))
+        run_tail = tail
+
+    if run:
+        flush_run()
+    return compacted
+
+def _as_items(right):
+    if isinstance(right, dict) and "set" in right:
+        return list(right["set"])
+    return [right]
+
+def _lookup_parts(nfrule: dict, addr_type: str):
+    """ Splits a compiled rule into (peers, protocols, ports, tail statements), or None if it can't become a lookup """
+    peers, protos, ports = [LOOKUP_ANY_PEER], ["tcp", "udp"], [LOOKUP_ANY_PORT]
+    seen = set()
+
+    exprs = nfrule["expr"]
+    i = 0
+    while i < len(exprs) and "match" in exprs[i]:
+        m = exprs[i]["match"]
+        payload = m["left"].get("payload", {}) if isinstance(m["left"], dict) else {}
+        field = (payload.get("protocol"), payload.get("field"))
+        if m["op"] != "==" or field in seen:
+            return None
+        seen.add(field)
+
+        if field == ("ip", "protocol"):
+            protos = _as_items(m["right"])
+        elif field == ("ip", addr_type):
+            if isinstance(m["right"], str) and m["right"].startswith("@"):
+                return None
+            peers = _as_items(m["right"])
+        elif field == ("th", "dport"):
+            ports = _as_items(m["right"])
+        else:
+            return None
+        i += 1
+
+    tail = exprs[i:]
+    if not tail:
+        return None
+    return peers, protos, ports, tail
+
+def _addr_bounds(addr):
+    if isinstance(addr, str):
+        ip = int(ipaddress.ip_address(addr))
+        return ip, ip
+    if "prefix" in addr:
+        net = ipaddress.ip_network(f"{addr['prefix']['addr']}/{addr['prefix']['len']}", strict=False)
+        return int(net.network_address), int(net.broadcast_address)
+    lo, hi = addr["range"]
+    return int(ipaddress.ip_address(lo)), int(ipaddress.ip_address(hi))
+
+def _port_bounds(port):
+    if isinstance(port, dict):
+        lo, hi = port["range"]
+        return int(lo), int(hi)
+    return int(port), int(port)
+
+def _merge_lookup_rules(run, addr_type: str) -> dict:
+    """ Builds the lookup rule for a run of rules, or None if their elements would overlap """
+    # (element, (addr bounds, protocol, port bounds))
+    elements = []
+    for _, (peers, protos, ports, _) in run:
+        for peer in peers:
+            for proto in protos:
+                for port in ports:
+                    elements.append(({ "concat": [peer, proto, port] }, (_addr_bounds(peer), proto, _port_bounds(port))))
+
+    def contains(a, b):
+        return a[1] == b[1] and a[0][0] <= b[0][0] and b[0][1] <= a[0][1] and a[2][0] <= b[2][0] and b[2][1] <= a[2][1]
+
+    def overlaps(a, b):
+        return a[1] == b[1] and a[0][0] <= b[0][1] and b[0][0] <= a[0][1] and a[2][0] <= b[2][1] and b[2][0] <= a[2][1]
+
+    # Elements covered by another one are redundant (the verdict is the same), partial overlaps are rejected by the kernel
+    kept = []
+    for i, (elem, box) in enumerate(elements):
+        if any(
+            contains(other, box) and (other != box or j < i)
+            for j, (_, other) in enumerate(elements) if j != i
+        ):
+            continue
+        kept.append((elem, box))
+
+    for i, (_, a) in enumerate(kept):
+        for _, b in kept[i + 1:]:
+            if overlaps(a, b):
+                return None
+
+    first, (_, _, _, tail) = run[0]
+    nfrule = { k: v for k, v in first.items() if k in ("family", "table", "chain") }
+    nfrule["expr"] = [
+        { "match": {
+            "op": "==",
+            "left": { "concat": [
+                { "payload": { "protocol": "ip", "field": addr_type } },
+                { "meta": { "key": "l4proto" } },
+                { "payload": { "protocol": "th", "field": "dport" } },
+            ] },
+            "right": { "set": [elem for elem, _ in kept] },
+        }},
+        *tail,
+    ]
+    return nfrule
@@ -1,26 +1,35 @@
 
 import os
 import signal
+import time
 import traceback
-from threading import Thread
+from threading import Event, Thread
 from queue import Queue
-from dataclasses import dataclass
-from typing import Literal, Any
+from dataclasses import dataclass, field
+from typing import Literal, Any, TYPE_CHECKING
 
+from . import metrics, tracing
 from .ipmanager.base import IPSetManager
 from .nfbackends import nf_backend_store
 
+if TYPE_CHECKING:
+    from .events import CoalescedEvent
+
 
 @dataclass
 class QItem:
-    type: Literal["docker"] | Literal["nfbackend"] | Literal["stop"]
+    type: Literal["docker"] | Literal["nfbackend"] | Literal["shadow"] | Literal["gc"] | Literal["stop"]
     data: Any
+    queued_at: float = field(default_factory=time.monotonic)
+
+    def dequeued(self):
+        metrics.queue_wait_seconds.observe(time.monotonic() - self.queued_at, type=self.type)
 
 def is_in_swarm():
-    import docker
-    return docker.from_env().info().get("Swarm", {}).get("LocalNodeState") == "active"
+    from .dockercache import docker_client
+    return docker_client().info().get("Swarm", {}).get("LocalNodeState") == "active"
 
-async def serve_nfagent():
+async def serve_nfagent(group_commit=True, group_window=0.005, max_batch=1000, stats_interval=60, netlink=False, metrics_listen=None, trace_export=None):
     import json
     import asyncio
     import websockets as ws
@@ -28,12 +37,24 @@ async def serve_nfagent():
 
     from .nfbackends.base import NftError
     from .nfbackends.local import LocalNFTBackend
+    from .nfbackends.group import GroupCommitter
+    from .nfbackends.socket import PROTOCOL_VERSION, MAX_MESSAGE_SIZE
+    from .nfbackends import wire
 
     print("Starting NFAgent and connecting to Firewhale")
 
+    if metrics_listen:
+        metrics.start_metrics_server(metrics_listen)
+    if trace_export:
+        tracing.setup_tracing(trace_export, service_name="firewhale-nfagent")
+
     conns: set[ws.client.ClientConnection] = set()
 
-    nfb = LocalNFTBackend()
+    if netlink:
+        from .nfbackends.netlink import NetlinkNFTBackend
+        nfb = NetlinkNFTBackend()
+    else:
+        nfb = LocalNFTBackend()
 
     do_quit = False
     def handle_exit_signal(self,signum, frame=None):
@@ -46,29 +67,70 @@ async def serve_nfagent():
     signal.signal(signal.SIGTERM, handle_exit_signal)
 
     async def handle_socket(socket: ws.client.ClientConnection):
-        while True:
+        # Commands are committed in arrival order, off the event loop so that heartbeats
+        #   and further requests are still received while a large transaction is applied
+        encoding = "json"
+        committer = GroupCommitter(nfb, window=group_window, max_batch=max_batch if group_commit else 1)
+
+        async def run_command(m):
             try:
-                message = await socket.recv()
-                m = json.loads(message)
-                if "nfcmd" in m:
-                    try:
-                        print(json.dumps(m["nfcmd"]))
-                        result = nfb.cmd(m["nfcmd"], throw=m.get("throw", True))
-                        result = { "status": "ok", "data": result }
-                    except NftError as e:
-                        result = { "status": "error", "data": str(e) }
-                        print("NFTables Error:", e)
-                    await socket.send(json.dumps(result))
-            except ws.ConnectionClosed as e:
-                print("Disconnected from Firewhale", e)
-                break
+                with tracing.remote_span("nfagent_command", m.get("trace")):
+                    data = await committer.submit(m["nfcmd"], throw=m.get("throw", True))
+                result = { "status": "ok", "data": data }
+            except NftError as e:
+                result = { "status": "error", "data": str(e) }
+                print("NFTables Error:", e)
             except Exception as e:
+                result = { "status": "error", "data": f"NFAgent Error: {e}" }
                 print("NFAgent Error:")
                 print(traceback.format_exc())
+            if "id" in m:
+                result["id"] = m["id"]
+            try:
+                await socket.send(wire.encode(result, encoding))
+            except ws.ConnectionClosed:
+                pass
+
+        async def report_stats():
+            reported = None
+            while True:
+                await asyncio.sleep(stats_interval)
+                if committer.stats.batches != reported:
+                    reported = committer.stats.batches
+                    print(f"Commit stats: {committer.stats}")
+
+        tasks = { asyncio.create_task(committer.run()) }
+        if stats_interval:
+            tasks.add(asyncio.create_task(report_stats()))
+        try:
+            while True:
+                try:
+                    message = await socket.recv()
+                    m = wire.decode(message)
+                    if "hello" in m:
+                        version = min(PROTOCOL_VERSION, m["hello"].get("protocol", 1))
+                        chosen = wire.choose_encoding(m["hello"].get("encodings")) if version >= 3 else "json"
+                        print(f"Using agent protocol version {version} ({chosen})")
+                        await socket.send(json.dumps({ "hello": { "protocol": version, "encoding": chosen } }))
+                        encoding = chosen
+                    elif "nfcmd" in m:
+                        task = asyncio.create_task(run_command(m))
+                        tasks.add(task)
+                        task.add_done_callback(tasks.discard)
+                except ws.ConnectionClosed as e:
+                    print("Disconnected from Firewhale", e)
+                    break
+                except Exception as e:
+                    print("NFAgent Error:")
+                    print(traceback.format_exc())
+        finally:
+            for task in list(tasks):
+                task.cancel()
+            print(f"Commit stats: {committer.stats}")
 
     while True:
         try:
-            async with unix_connect("/tmp/firewhale/agent/socket") as socket:
+            async with unix_connect("/tmp/firewhale/agent/socket", max_size=MAX_MESSAGE_SIZE) as socket:
                 try:
                     print("Connected to Firewhale")
                     conns.add(socket)
@@ -83,12 +145,153 @@ async def serve_nfagent():
             print("Error connecting to Firewhale", e)
             await asyncio.sleep(3)
 
+    tracing.shutdown_tracing()
+
 
-def serve(nfagent=None, redis_url=None):
-    import docker
-    docker_client = docker.from_env()
+async def run_async_loop(q, process_docker_event, handle_control_item, *, concurrency: int = 8):
+    """
+    Asyncio variant of the main loop.
+    Events for different containers are handled concurrently (up to `concurrency` at once),
+    while events for the same container are chained so that they still run in order.
+    """
+    import asyncio
+
+    sem = asyncio.Semaphore(concurrency)
+    inflight: set[asyncio.Task] = set()
+    tails: dict[str, asyncio.Task] = {}
+
+    async def run_container_event(previous: asyncio.Task, event):
+        if previous is not None:
+            await asyncio.wait([previous])
+        async with sem:
+            try:
+                await process_docker_event(event)
+            except Exception:
+                print(f"Error:")
+                traceback.print_exc()
+
+    def task_done(task: asyncio.Task, cid: str):
+        inflight.discard(task)
+        if tails.get(cid) is task:
+            del tails[cid]
+
+    while True:
+        qitem: QItem = await q.get()
+        qitem.dequeued()
+
+        try:
+            if qitem.type == "docker":
+                cid = qitem.data.container_id
+                task = asyncio.create_task(run_container_event(tails.get(cid), qitem.data))
+                tails[cid] = task
+                inflight.add(task)
+                task.add_done_callback(lambda t, cid=cid: task_done(t, cid))
+
+            elif qitem.type == "stop":
+                break
 
-    # TODO Convert to asyncio?
+            else:
+                # Full syncs and checks must not interleave with container updates
+                if inflight:
+                    await asyncio.wait(list(inflight))
+                await asyncio.to_thread(handle_control_item, qitem)
+
+        except Exception as e:
+            print(f"Error:")
+            traceback.print_exc()
+
+    if inflight:
+        await asyncio.wait(list(inflight))
+
+
+def initialize_nftables(ipmanager: IPSetManager, *, reconcile=True, reconcile_chunk=None):
+    """ Brings NFTables in line with the running containers after (re)connecting to the NFTables backend """
+    from .base import initialize_core_chains
+    from .container import sync_all_containers, cleanup_unknown_containers
+
+    if reconcile:
+        from .reconcile import reconcile_all
+        print("Reconciling NFTables state")
+        stats = reconcile_all(chunk_size=reconcile_chunk)
+        print(f"Reconciled: {stats}")
+        print("Cleaning old IPs")
+        ipmanager.del_unknown_ips()
+        # Service set updates may have failed while the backend was away
+        ipmanager.catch_up()
+        print("NFtables initialized")
+        return
+
+    print("Loading NFTables state")
+    from .nf import nfc
+    from .shadow import nf_shadow
+    nf_shadow.resync(nfc)
+    print("Initializing core chains")
+    initialize_core_chains()
+    print("Syncing containers")
+    sync_all_containers(ips=False) # (IPs handled below)
+    print("Cleaning old IPs")
+    ipmanager.del_unknown_ips()
+    print("Cleaning up unknown containers")
+    cleanup_unknown_containers()
+    ipmanager.catch_up()
+    print("NFtables initialized")
+
+def _finish_docker_event(event: 'CoalescedEvent'):
+    if event.destroyed:
+        from .dockercache import container_cache
+        container_cache().forget(event.container_id)
+    if event.received_at:
+        metrics.event_lag_seconds.observe(time.monotonic() - event.received_at)
+    for span in event.traces:
+        span.end()
+
+def process_docker_event(event: 'CoalescedEvent'):
+    from .container import Container
+    # Handling is traced under the first of the (possibly coalesced) raw events
+    with tracing.use_span(event.traces[0] if event.traces else None):
+        try:
+            ctr = Container(event.container_id)
+            if len(event.events) > 1:
+                print(f"Container {ctr.id}: coalesced {event.events} into {event.actions}")
+            for action in event.actions:
+                with metrics.event_seconds.time(action=action), tracing.span("handle_event", action=action):
+                    ctr.handle_event(action)
+        finally:
+            _finish_docker_event(event)
+
+async def process_docker_event_async(event: 'CoalescedEvent'):
+    from .container import Container
+    with tracing.use_span(event.traces[0] if event.traces else None):
+        try:
+            ctr = Container(event.container_id)
+            if len(event.events) > 1:
+                print(f"Container {ctr.id}: coalesced {event.events} into {event.actions}")
+            for action in event.actions:
+                with metrics.event_seconds.time(action=action), tracing.span("handle_event", action=action):
+                    await ctr.handle_event_async(action)
+        finally:
+            _finish_docker_event(event)
+
+
+def serve(
+    nfagent=None, redis_url=None,
+    reconcile=True, reconcile_chunk=None,
+    event_window=0.25,
+    use_asyncio=False, concurrency=8,
+    shadow_verify_interval=300,
+    shared_chains=True,
+    compact_rules=False,
+    netlink=False,
+    metrics_listen=None,
+    trace_export=None,
+    redis_pattern_subscribe=False,
+    set_batch_window=0.05,
+    redis_cache_size=1024,
+    gc_interval=60,
+    gc_budget=500,
+):
+    from .dockercache import docker_client as shared_docker_client, container_cache
+    docker_client = shared_docker_client()
 
     if nfagent is None:
         nfagent = is_in_swarm()
@@ -104,9 +307,22 @@ def serve(nfagent=None, redis_url=None):
         mode = "Redis"
     else:
         mode = "Local"
-    print(f"Starting Firewhale in {mode} mode")
+    print(f"Starting Firewhale in {mode} mode ({'asyncio' if use_asyncio else 'threaded'})")
 
-    q = Queue[QItem]()
+    if use_asyncio:
+        import asyncio
+        loop = asyncio.new_event_loop()
+        q = asyncio.Queue[QItem]()
+        put_qitem = lambda item: loop.call_soon_threadsafe(q.put_nowait, item)
+    else:
+        q = Queue[QItem]()
+        put_qitem = q.put
+    metrics.queue_depth.set_function(q.qsize)
+
+    if metrics_listen:
+        metrics.start_metrics_server(metrics_listen)
+    if trace_export:
+        tracing.setup_tracing(trace_export, service_name="firewhale")
 
     # === IPSetManager Setup ===
 
@@ -116,40 +332,70 @@ def serve(nfagent=None, redis_url=None):
         import redis
         from .ipmanager.redis import RedisSubscriptionManager
         r = redis.from_url(redis_url, decode_responses=True)
-        ipmanager = RedisSubscriptionManager(r, docker_client.info()["ID"])
+        ipmanager = RedisSubscriptionManager(r, docker_client.info()["ID"], pattern_subscribe=redis_pattern_subscribe, set_batch_window=set_batch_window, cache_size=redis_cache_size)
     else:
         from .ipmanager.local import LocalSubscriptionManager
         ipmanager = LocalSubscriptionManager()
 
     IPSetManager.instance = ipmanager
 
+    from .container import Container
+    Container.shared_chains = shared_chains
+    Container.compact_rules = compact_rules
+
     # === NFBackend Setup ===
 
     if nfagent:
         from .nfbackends.socket import SocketNFTBackend
         nf_backend = SocketNFTBackend("/tmp/firewhale/agent/socket")
         nf_backend_store.set_backend(nf_backend)
+    elif netlink:
+        from .nfbackends.netlink import NetlinkNFTBackend
+        nf_backend = NetlinkNFTBackend()
+        nf_backend_store.set_backend(nf_backend)
     else:
         from .nfbackends.local import LocalNFTBackend
         nf_backend = LocalNFTBackend()
         nf_backend_store.set_backend(nf_backend)
 
-    nf_backend.on_connect = lambda: q.put(QItem("nfbackend", "connected"))
+    nf_backend.on_connect = lambda: put_qitem(QItem("nfbackend", "connected"))
 
     def handle_nf_connected():
-        from .base import initialize_core_chains
-        from .container import sync_all_containers, cleanup_unknown_containers
-
-        print("Initializing core chains")
-        initialize_core_chains()
-        print("Syncing containers")
-        sync_all_containers(ips=False) # (IPs handled below)
-        print("Cleaning old IPs")
-        ipmanager.del_unknown_ips()
-        print("Cleaning up unknown containers")
-        cleanup_unknown_containers()
-        print("NFtables initialized")
-
+        initialize_nftables(ipmanager, reconcile=reconcile, reconcile_chunk=reconcile_chunk)
+
+    def handle_control_item(qitem: QItem):
+        if qitem.type == "nfbackend" and qitem.data == "connected":
+            handle_nf_connected()
+
+        elif qitem.type == "shadow" and qitem.data == "verify":
+            from .nf import nfc
+            from .shadow import nf_shadow
+            drift = nf_shadow.verify(nfc)
+            if drift:
+                print(f"NFTables state drifted from shadow by {drift} object(s) - reloaded")
+
+        elif qitem.type == "gc" and qitem.data == "sweep":
+            from .sweep import garbage_collector
+            collected = garbage_collector.sweep()
+            if collected:
+                print(f"Garbage collected {collected} stale object(s) ({garbage_collector.stats.backlog} left for later sweeps)")
+
+    timer_stop = Event()
+    def run_shadow_timer():
+        while not timer_stop.wait(shadow_verify_interval):
+            put_qitem(QItem("shadow", "verify"))
+
+    if shadow_verify_interval:
+        Thread(target=run_shadow_timer, daemon=True).start()
+
+    from .sweep import garbage_collector
+    garbage_collector.budget = gc_budget
+    def run_gc_timer():
+        while not timer_stop.wait(gc_interval):
+            put_qitem(QItem("gc", "sweep"))
+
+    if gc_interval:
+        Thread(target=run_gc_timer, daemon=True).start()
 
     # === Docker Event Handling ===
 
@@ -159,27 +405,37 @@ def serve(nfagent=None, redis_url=None):
     events_handle = docker_client.events(
         decode=True,
         filters={
-            "type": ["container"],
-            "event": ["create", "start", "die"],
+            "type": ["container", "network"],
+            "event": ["create", "start", "die", "destroy"],
         }
     )
 
-    def process_docker_event(event):
-        from .container import Container
-        if event["Type"] == "container":
-            ctr = Container(event["id"])
-            ctr.handle_event(event["Action"])
+    from .events import EventCoalescer
+    coalescer = EventCoalescer(lambda ev: put_qitem(QItem("docker", ev)), window=event_window)
 
     def process_docker_events(events):
         for event in events:
-            q.put(QItem("docker", event))
+            if event["Type"] == "network":
+                # Compiled rules may embed the network's subnet
+                from .rule import rule_cache
+                rule_cache.invalidate_network((event.get("Actor") or {}).get("Attributes", {}).get("name"))
+            elif event["Type"] == "container":
+                container_cache().handle_event(event)
+                span = None
+                if event["Action"] != "destroy":
+                    span = tracing.start_span("docker_event", attributes={
+                        "container.id": event["id"],
+                        "docker.action": event["Action"],
+                    })
+                # Destroys go through the queue too, behind the container's `die`
+                coalescer.push(event["id"], event["Action"], trace=span)
 
     event_thread = Thread(target=process_docker_events, args=(events_handle,))
     print("Firewhale is subscribed to local Docker events")
     event_thread.start()
 
     def handle_exit_signal(self,signum, frame=None):
-        q.put(QItem("stop", None))
+        put_qitem(QItem("stop", None))
     signal.signal(signal.SIGINT, handle_exit_signal)
     signal.signal(signal.SIGTERM, handle_exit_signal)
 
@@ -191,19 +447,24 @@ def serve(nfagent=None, redis_url=None):
 
         nf_backend.connect()
 
+        if use_asyncio:
+            loop.run_until_complete(run_async_loop(q, process_docker_event_async, handle_control_item, concurrency=concurrency))
+            return
+
         while True:
             qitem = q.get()
+            qitem.dequeued()
 
             try:
                 if qitem.type == "docker":
                     process_docker_event(qitem.data)
 
-                elif qitem.type == "nfbackend" and qitem.data == "connected":
-                    handle_nf_connected()
-
                 elif qitem.type == "stop":
                     break
 
+                else:
+                    handle_control_item(qitem)
+
             except Exception as e:
                 import traceback
                 # TODO Better loggering
@@ -216,7 +477,18 @@ def serve(nfagent=None, redis_url=None):
         pass
     finally:
         print("Shutting down Firewhale")
+        timer_stop.set()
         events_handle.close()
+        coalescer.close()
+        print(f"Docker event stats: {coalescer.stats}")
+        from .rule import rule_cache
+        print(f"Rule compile cache stats: {rule_cache.stats}")
+        print(f"Garbage collector stats: {garbage_collector.stats}")
+        if netlink and not nfagent:
+            print(f"Netlink transaction stats: {nf_backend.stats}")
         ipmanager.close()
         nf_backend.stop()
         event_thread.join()
+        tracing.shutdown_tracing()
+        if use_asyncio:
+            loop.close()
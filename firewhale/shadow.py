@@ -0,0 +1,293 @@
+
+from threading import RLock
+from typing import Dict, List, Set
+
+from .util import MultiMap, synchronized
+
+FAMILY = "ip"
+TABLE = "filter"
+CONTAINER_CHAIN_PREFIX = "firewhale-container-"
+SERVICE_SET_PREFIX = "firewhale-service:"
+
+
+def _as_list(v):
+    if v is None: return []
+    return v if isinstance(v, list) else [v]
+
+def _elem_key(elem):
+    # Listings wrap elements with extra attributes (timeouts, counters) in { "elem": { "val": ... } }
+    if isinstance(elem, dict) and "elem" in elem:
+        return elem["elem"]["val"]
+    return elem
+
+def _verdict_target(verdict):
+    if isinstance(verdict, dict):
+        for k in ("jump", "goto"):
+            if k in verdict:
+                return verdict[k]["target"]
+    return None
+
+def container_id_of_chain(name: str) -> str:
+    if not name.startswith(CONTAINER_CHAIN_PREFIX): return None
+    return name.split("-")[2]
+
+
+class NFShadow:
+    """
+    Indexed in-memory mirror of the NFTables objects that Firewhale owns in `ip filter`:
+    container chains, verdict map elements and service sets.
+    Updated from every successfully committed transaction and periodically re-checked against the kernel.
+    """
+
+    def __init__(self):
+        self._lock = RLock()
+        self._reset()
+        self.loaded = False
+        # Set when a command was sent with throw=False/"continue", after which the outcome is unknown
+        self.dirty = False
+
+    def _reset(self):
+        # Chain name -> chain spec
+        self.chains: Dict[str, dict] = {}
+        self.container_chains = MultiMap[str, str]()
+        # Chain name -> rules in order. Handles are only known for rules that were listed from the kernel.
+        #   A chain that is missing here has rules in an unknown state.
+        self.chain_rules: Dict[str, List[dict]] = {}
+        # Map name -> IP -> verdict
+        self.map_elements: Dict[str, Dict[str, dict]] = {}
+        # Map name -> target chain -> IPs
+        self.map_targets: Dict[str, MultiMap[str, str]] = {}
+        # Set name -> elements
+        self.service_sets: Dict[str, Set[str]] = {}
+
+    # === Queries ===
+
+    @synchronized
+    def chains_for_container(self, cid: str) -> List[dict]:
+        if cid not in self.container_chains._store: return []
+        return [self.chains[name] for name in self.container_chains[cid]]
+
+    @synchronized
+    def chain_names(self) -> List[str]:
+        return list(self.chains.keys())
+
+    @synchronized
+    def has_chain(self, name: str) -> bool:
+        return name in self.chains
+
+    @synchronized
+    def rules_for_chain(self, name: str) -> List[dict]:
+        """ Installed rules of an owned chain, or None if they aren't known """
+        rules = self.chain_rules.get(name)
+        return list(rules) if rules is not None else None
+
+    @synchronized
+    def set_chain_rules(self, name: str, rules: List[dict]):
+        if name in self.chains:
+            self.chain_rules[name] = list(rules)
+
+    @synchronized
+    def container_ids(self) -> Set[str]:
+        return set(self.container_chains._store.keys())
+
+    @synchronized
+    def get_map_elements(self, map_name: str) -> Dict[str, dict]:
+        return dict(self.map_elements.get(map_name, {}))
+
+    @synchronized
+    def map_ips_for_chain(self, map_name: str, chain_name: str) -> Set[str]:
+        targets = self.map_targets.get(map_name)
+        if targets is None or chain_name not in targets._store: return set()
+        return set(targets[chain_name])
+
+    @synchronized
+    def has_set(self, set_name: str) -> bool:
+        return set_name in self.service_sets
+
+    # === Loading ===
+
+    @synchronized
+    def load(self, ruleset: List[dict]):
+        """ Replaces the mirror with the objects in a `list table ip filter` listing """
+        self._reset()
+        for obj in ruleset:
+            if "chain" in obj:
+                self._add_chain(obj["chain"])
+            elif "rule" in obj:
+                rule = obj["rule"]
+                if rule["chain"] in self.chain_rules:
+                    self.chain_rules[rule["chain"]].append(rule)
+            elif "map" in obj:
+                m = obj["map"]
+                self._add_map(m["name"])
+                for elem in m.get("elem", []):
+                    self._add_map_elem(m["name"], _elem_key(elem[0]), elem[1])
+            elif "set" in obj:
+                s = obj["set"]
+                if s["name"].startswith(SERVICE_SET_PREFIX):
+                    self.service_sets[s["name"]] = set(_elem_key(e) for e in s.get("elem", []))
+        self.loaded = True
+        self.dirty = False
+
+    def resync(self, nfc) -> List[dict]:
+        """ Reloads from the kernel. Returns the listing so callers can reuse it """
+        ruleset = nfc(f"list table {FAMILY} {TABLE}")
+        self.load(ruleset)
+        return ruleset
+
+    def ensure_loaded(self, nfc):
+        if not self.loaded or self.dirty:
+            self.resync(nfc)
+
+    def verify(self, nfc) -> int:
+        """ Re-reads the kernel state and returns how many objects had drifted from the mirror """
+        with self._lock:
+            before = (
+                set(self.chains.keys()),
+                { (m, ip, _verdict_target(v)) for m, elems in self.map_elements.items() for ip, v in elems.items() },
+                { (s, e) for s, elems in self.service_sets.items() for e in elems } | set((s, None) for s in self.service_sets),
+            )
+            self.resync(nfc)
+            after = (
+                set(self.chains.keys()),
+                { (m, ip, _verdict_target(v)) for m, elems in self.map_elements.items() for ip, v in elems.items() },
+                { (s, e) for s, elems in self.service_sets.items() for e in elems } | set((s, None) for s in self.service_sets),
+            )
+        return sum(len(b ^ a) for b, a in zip(before, after))
+
+    # === Observing Commands ===
+
+    @synchronized
+    def observe(self, cmd, *, ok: bool = True):
+        """ Applies committed JSON commands to the mirror """
+        if isinstance(cmd, str):
+            return
+        if not ok:
+            self.dirty = True
+            return
+
+        if isinstance(cmd, dict):
+            cmd = cmd["nftables"] if "nftables" in cmd else [cmd]
+
+        for c in cmd:
+            for verb, body in c.items():
+                for kind, spec in body.items():
+                    self._observe_one(verb, kind, spec)
+
+    def _observe_one(self, verb: str, kind: str, spec: dict):
+        if not isinstance(spec, dict): return
+        if spec.get("family", FAMILY) != FAMILY or spec.get("table", TABLE) != TABLE: return
+        name = spec.get("name")
+
+        if kind == "chain":
+            if verb in ("add", "create"):
+                self._add_chain(spec)
+            elif verb == "flush" and name in self.chains:
+                self.chain_rules[name] = []
+            elif verb == "delete":
+                self._del_chain(name)
+
+        elif kind == "rule":
+            self._observe_rule(verb, spec)
+
+        elif kind == "map":
+            if verb in ("add", "create"):
+                self._add_map(name)
+                for elem in spec.get("elem", []):
+                    self._add_map_elem(name, elem[0], elem[1])
+            elif verb == "flush":
+                self.map_elements.pop(name, None)
+                self.map_targets.pop(name, None)
+                self._add_map(name)
+            elif verb == "delete":
+                self.map_elements.pop(name, None)
+                self.map_targets.pop(name, None)
+
+        elif kind == "set":
+            if not name or not name.startswith(SERVICE_SET_PREFIX): return
+            if verb in ("add", "create"):
+                self.service_sets.setdefault(name, set()).update(_as_list(spec.get("elem")))
+            elif verb == "flush":
+                self.service_sets[name] = set()
+            elif verb == "delete":
+                self.service_sets.pop(name, None)
+
+        elif kind == "element":
+            elems = _as_list(spec.get("elem"))
+            if name in self.map_elements:
+                for elem in elems:
+                    if verb in ("add", "create"):
+                        self._add_map_elem(name, elem[0], elem[1])
+                    elif verb == "delete":
+                        self._del_map_elem(name, elem)
+            elif name in self.service_sets or (name and name.startswith(SERVICE_SET_PREFIX)):
+                members = self.service_sets.setdefault(name, set())
+                for elem in elems:
+                    if verb in ("add", "create"):
+                        members.add(elem)
+                    elif verb == "delete":
+                        members.discard(elem)
+
+    def _observe_rule(self, verb: str, spec: dict):
+        rules = self.chain_rules.get(spec.get("chain"))
+        if rules is None: return
+
+        handle = spec.get("handle")
+        rule = { k: v for k, v in spec.items() if k != "handle" }
+
+        idx = None
+        if handle is not None:
+            idx = next((i for i, r in enumerate(rules) if r.get("handle") == handle), None)
+            if idx is None:
+                # Refers to a rule we don't know the position of
+                del self.chain_rules[spec["chain"]]
+                return
+
+        if verb == "add":
+            rules.insert(idx + 1, rule) if idx is not None else rules.append(rule)
+        elif verb == "insert":
+            rules.insert(idx if idx is not None else 0, rule)
+        elif verb == "replace" and idx is not None:
+            # The kernel assigns the replacement a new handle
+            rules[idx] = rule
+        elif verb == "delete" and idx is not None:
+            del rules[idx]
+
+    def _add_chain(self, spec: dict):
+        name = spec["name"]
+        if not name.startswith("firewhale"): return
+        if name not in self.chains:
+            self.chain_rules[name] = []
+        self.chains[name] = { "family": spec.get("family", FAMILY), "table": spec.get("table", TABLE), "name": name }
+        cid = container_id_of_chain(name)
+        if cid:
+            self.container_chains.add(cid, name)
+
+    def _del_chain(self, name: str):
+        self.chain_rules.pop(name, None)
+        if self.chains.pop(name, None) is None: return
+        cid = container_id_of_chain(name)
+        if cid:
+            self.container_chains.remove(cid, name)
+
+    def _add_map(self, name: str):
+        if not name.startswith("firewhale"): return
+        self.map_elements.setdefault(name, {})
+        self.map_targets.setdefault(name, MultiMap[str, str]())
+
+    def _add_map_elem(self, map_name: str, ip: str, verdict: dict):
+        if map_name not in self.map_elements: return
+        self._del_map_elem(map_name, ip)
+        self.map_elements[map_name][ip] = verdict
+        target = _verdict_target(verdict)
+        if target:
+            self.map_targets[map_name].add(target, ip)
+
+    def _del_map_elem(self, map_name: str, ip: str):
+        old = self.map_elements[map_name].pop(ip, None)
+        target = _verdict_target(old)
+        if target:
+            self.map_targets[map_name].remove(target, ip)
+
+
+nf_shadow = NFShadow()
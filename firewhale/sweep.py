@@ -0,0 +1,180 @@
+
+from contextlib import nullcontext
+from dataclasses import dataclass
+from typing import Dict, List, Tuple
+
+from . import metrics
+from .base import CONTAINER_CHAIN_SPECS, TABLE_FILTER
+from .chains import chain_lock, delete_chain_commands, unreferenced_chains, SHARED_CHAIN_PREFIX
+from .nf import nfc
+from .nfbackends.base import NftError
+from .shadow import nf_shadow
+
+# Order in which objects of the same generation are collected
+_KIND_ORDER = { "container": 0, "element": 1, "chain": 2, "set": 3 }
+
+
+@dataclass
+class GCStats:
+    sweeps: int = 0
+    transactions: int = 0
+    chains: int = 0
+    elements: int = 0
+    sets: int = 0
+    # Sweeps whose transaction failed and was re-run command by command
+    fallbacks: int = 0
+    # Collectable objects the last sweep left for later ones (budget)
+    backlog: int = 0
+
+    def __str__(self):
+        return (
+            f"sweeps={self.sweeps} transactions={self.transactions} chains={self.chains} elements={self.elements}"
+            f" sets={self.sets} fallbacks={self.fallbacks} backlog={self.backlog}"
+        )
+
+
+class GarbageCollector:
+    """
+    Removes Firewhale objects nothing refers to any more: chains of containers that are gone, verdict map elements
+    of IPs no container has, shared chains no element jumps to and service sets nobody subscribes to.
+
+    Each sweep marks the unreferenced objects (from the shadow state) and stamps new ones with the current
+    generation. An object is only collected once it has stayed unreferenced for `min_age` further sweeps, so that
+    objects of containers that are still being set up are left alone. The oldest generations are collected first,
+    in one transaction of at most `budget` commands - a large backlog is worked off over several sweeps.
+    A container's chains and the map elements jumping to them are never split across sweeps.
+    """
+
+    def __init__(self, *, budget: int = 500, min_age: int = 1):
+        self.budget = budget
+        self.min_age = min_age
+        self.generation = 0
+        self.stats = GCStats()
+        # (kind, name) -> generation it was first seen unreferenced in
+        self._unreferenced: Dict[Tuple[str, str], int] = {}
+
+    def sweep(self, *, full: bool = False) -> int:
+        """
+        Collects ripe unreferenced objects. A `full` sweep (at startup) re-lists the containers
+        and collects everything unreferenced straight away, regardless of budget.
+        Returns the number of objects collected
+        """
+        from .ipmanager.base import IPSetManager
+        ipmanager = IPSetManager.instance
+
+        # Nothing may start using a chain or set while its deletion is decided and committed
+        with chain_lock, (ipmanager._lock if ipmanager is not None else nullcontext()):
+            nf_shadow.ensure_loaded(nfc)
+            self.generation += 1
+            self.stats.sweeps += 1
+
+            candidates = self._mark(refresh=full)
+            for key in list(self._unreferenced):
+                if key not in candidates:
+                    del self._unreferenced[key]
+            for key in candidates:
+                self._unreferenced.setdefault(key, self.generation)
+
+            min_age = 0 if full else self.min_age
+            ripe = [key for key in candidates if self.generation - self._unreferenced[key] >= min_age]
+            ripe.sort(key=lambda key: (self._unreferenced[key], _KIND_ORDER[key[0]]))
+
+            commands = []
+            collected = 0
+            for key in ripe:
+                unit = candidates[key]
+                # At least one unit per sweep, even if it alone is over budget
+                if not full and commands and len(commands) + len(unit) > self.budget:
+                    break
+                commands.extend(unit)
+                collected += 1
+                del self._unreferenced[key]
+
+            self.stats.backlog = len(ripe) - collected
+            metrics.gc_backlog.set(self.stats.backlog)
+            if commands:
+                self._commit(commands)
+            return collected
+
+    def _mark(self, *, refresh: bool) -> Dict[Tuple[str, str], List[dict]]:
+        """ Unreferenced objects -> commands that delete them """
+        from .container import Container
+        from .dockercache import container_cache
+        from .ipmanager.base import IPSetManager
+        from .rule import nft_service_set_name
+
+        live = [Container(c) for c in container_cache().list(refresh=refresh, enabled_only=True)]
+        live_ids = set(c.id for c in live)
+        live_ips = set(ip for c in live for ip in c.container_ips() if ip)
+        map_names = [cdef.map_name for cdef in CONTAINER_CHAIN_SPECS]
+
+        units: Dict[Tuple[str, str], List[dict]] = {}
+        # Elements already covered by a container unit
+        covered = { name: set() for name in map_names }
+
+        # Chains of containers that are gone, with the map elements that still jump to them
+        for cid in nf_shadow.container_ids():
+            if cid in live_ids: continue
+            chains = nf_shadow.chains_for_container(cid)
+            commands = []
+            for name in map_names:
+                ips = set(ip for chain in chains for ip in nf_shadow.map_ips_for_chain(name, chain["name"]))
+                if ips:
+                    commands.append(self._delete_elements(name, ips))
+                    covered[name] |= ips
+            units[("container", cid)] = commands + delete_chain_commands(chains)
+
+        # Elements of IPs that no container has
+        for name in map_names:
+            for ip in nf_shadow.get_map_elements(name):
+                if ip in live_ips or ip in covered[name]: continue
+                units.setdefault(("element", ip), []).append(self._delete_elements(name, [ip]))
+
+        # Shared chains that no element jumps to
+        shared = [name for name in nf_shadow.chain_names() if name.startswith(SHARED_CHAIN_PREFIX)]
+        for chain in unreferenced_chains(shared):
+            units[("chain", chain["name"])] = delete_chain_commands([chain])
+
+        # Service sets nobody subscribes to
+        if IPSetManager.instance is not None:
+            subscribed = set(nft_service_set_name(s) for s in IPSetManager.instance.service_subscriptions.keys())
+            for name in list(nf_shadow.service_sets):
+                if name in subscribed: continue
+                units[("set", name)] = [{ "delete": { "set": { "family": "ip", "table": TABLE_FILTER, "name": name }}}]
+
+        return units
+
+    def _commit(self, commands: List[dict]):
+        self.stats.transactions += 1
+        try:
+            nfc(commands)
+        except NftError as e:
+            # Eg a set that a not yet collected chain still refers to - the rest is collected anyway
+            print(f"Garbage collection transaction failed ({e}) - retrying command by command")
+            self.stats.fallbacks += 1
+            nfc(commands, throw="continue")
+
+        for command in commands:
+            for verb, body in command.items():
+                if verb != "delete": continue
+                if "chain" in body:
+                    self.stats.chains += 1
+                    metrics.gc_collected.inc(kind="chain")
+                elif "element" in body:
+                    self.stats.elements += len(body["element"]["elem"])
+                    metrics.gc_collected.inc(len(body["element"]["elem"]), kind="element")
+                elif "set" in body:
+                    self.stats.sets += 1
+                    metrics.gc_collected.inc(kind="set")
+
+    @staticmethod
+    def _delete_elements(map_name: str, ips) -> dict:
+        return { "delete": { "element": {
+            "family": "ip",
+            "table": TABLE_FILTER,
+            "name": map_name,
+            "elem": sorted(ips),
+        }}}
+
+
+garbage_collector = GarbageCollector()
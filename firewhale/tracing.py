@@ -0,0 +1,111 @@
+
+import functools
+from contextlib import contextmanager, nullcontext
+from typing import Dict, List
+
+try:
+    from opentelemetry import trace, propagate
+    from opentelemetry.context import Context
+except ImportError:
+    trace = None
+    propagate = None
+
+
+# Set by setup_tracing. Until then every helper below is a no-op
+tracer: 'trace.Tracer' = None
+
+
+def setup_tracing(export: str, *, service_name: str = "firewhale"):
+    """
+    Enables tracing with the OpenTelemetry SDK.
+    `export` is `file:/path/to/spans.jsonl` (one JSON span per line) or the URL of an OTLP/HTTP collector
+    (eg `http://localhost:4318/v1/traces`).
+    """
+    global tracer
+
+    try:
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor, ConsoleSpanExporter
+    except ImportError:
+        raise RuntimeError("Tracing needs the OpenTelemetry SDK (pip install firewhale[tracing])")
+
+    if export.startswith("file:"):
+        out = open(export[len("file:"):], "a", buffering=1)
+        exporter = ConsoleSpanExporter(out=out, formatter=lambda span: span.to_json(indent=None) + "\n")
+    else:
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+        exporter = OTLPSpanExporter(endpoint=export)
+
+    provider = TracerProvider(resource=Resource.create({ "service.name": service_name }))
+    provider.add_span_processor(BatchSpanProcessor(exporter))
+    trace.set_tracer_provider(provider)
+    tracer = trace.get_tracer("firewhale")
+    print(f"Exporting traces to {export}")
+
+def shutdown_tracing():
+    """ Flushes spans that are still buffered """
+    if tracer is not None:
+        trace.get_tracer_provider().shutdown()
+
+
+def start_span(name: str, *, attributes: Dict = None):
+    """
+    Starts a root span that isn't made current, for work that is handed to another thread.
+    Returns None when tracing is disabled. Must be finished with `span.end()`
+    """
+    if tracer is None:
+        return None
+    return tracer.start_span(name, context=Context(), attributes=attributes)
+
+def use_span(span):
+    """ Makes a span from `start_span` current in this thread (without ending it afterwards) """
+    if span is None:
+        return nullcontext()
+    return trace.use_span(span, end_on_exit=False)
+
+def span(name: str, *, links: List = (), **attributes):
+    """ Child span of the current span for the duration of a `with` block """
+    if tracer is None:
+        return nullcontext()
+    links = [trace.Link(s.get_span_context()) for s in links if s is not None]
+    return tracer.start_as_current_span(name, attributes=attributes or None, links=links)
+
+def traced(name: str):
+    """ Decorator form of `span` """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if tracer is None:
+                return fn(*args, **kwargs)
+            with tracer.start_as_current_span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def current_span():
+    """ The current span, or None when tracing is disabled """
+    if tracer is None:
+        return None
+    return trace.get_current_span()
+
+
+# === Propagation (NFAgent protocol) ===
+
+def inject() -> Dict[str, str] | None:
+    """ W3C trace context of the current span, to send along with a request """
+    if tracer is None:
+        return None
+    carrier = {}
+    propagate.inject(carrier)
+    return carrier or None
+
+@contextmanager
+def remote_span(name: str, carrier: Dict[str, str] | None, **attributes):
+    """ Span that continues the trace a peer sent with `inject` """
+    if tracer is None:
+        yield None
+        return
+    context = propagate.extract(carrier) if carrier else None
+    with tracer.start_as_current_span(name, context=context, attributes=attributes or None) as s:
+        yield s
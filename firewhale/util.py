@@ -13,6 +13,12 @@ class MultiMap(Generic[T, U]):
     def __getitem__(self, k: T) -> Set[U]:
         return self._store[k]
 
+    def get(self, k: T) -> Set[U]:
+        return self._store.get(k, set())
+
+    def keys(self) -> Set[T]:
+        return set(self._store.keys())
+
     def add(self, key: T, value: U) -> bool:
         """ Returns True if the key was not already in the map """
         ret = False
@@ -63,6 +69,14 @@ class BiMultiMap(Generic[T, U]):
         return self._left.remove(key, value)
 
 
+def synchronized(func):
+    """ Runs the method while holding the instance's `_lock` """
+    @wraps(func)
+    def wrapper(self, *args, **kwargs):
+        with self._lock:
+            return func(self, *args, **kwargs)
+    return wrapper
+
 def protected(message, *, short=[]):
     def decorator(func):
         @wraps(func)
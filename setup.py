@@ -18,6 +18,12 @@ setup(
         'pyyaml',
         'websockets',
     ],
+    extras_require={
+        # Compact encoding for the NFAgent link (falls back to JSON without them)
+        'compact': ['msgpack', 'zstandard'],
+        # Tracing export (--trace-export)
+        'tracing': ['opentelemetry-sdk', 'opentelemetry-exporter-otlp-proto-http'],
+    },
     entry_points={
         'console_scripts': [
             'firewhale = firewhale.cli:app'
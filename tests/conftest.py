@@ -0,0 +1,65 @@
+import re
+
+import pytest
+
+from firewhale.bench.churn import fresh_environment
+
+
+@pytest.fixture
+def env():
+    """ Firewhale's process-wide state on a FakeDockerClient and a MemoryNFTBackend, with the core chains set up """
+    from firewhale.base import initialize_core_chains
+    from firewhale.container import Container
+    from firewhale.ipmanager.base import IPSetManager
+
+    env = fresh_environment()
+    initialize_core_chains()
+    yield env
+
+    env.ipmanager.close()
+    IPSetManager.instance = None
+    Container.shared_chains = True
+    Container.compact_rules = False
+
+
+# === Redis ===
+
+def _function_library(code: str) -> str:
+    """
+    Turns a `#!lua` function library into a script for EVAL that dispatches on its first ARGV,
+    since fakeredis doesn't implement FUNCTION LOAD / FCALL
+    """
+    body = "\n".join(line for line in code.splitlines() if not line.startswith("#!"))
+    functions = re.findall(r"redis\.register_function\('(\w+)', (\w+)\)", body)
+    body = re.sub(r"redis\.register_function\(.*\)\n?", "", body)
+    body += "\nlocal functions = {" + ", ".join(f"['{name}'] = {fn}" for name, fn in functions) + "}\n"
+    body += "local name = table.remove(ARGV, 1)\nreturn functions[name](KEYS, ARGV)\n"
+    return body
+
+@pytest.fixture
+def fake_redis(monkeypatch):
+    """ A fakeredis client whose `function_load` and `fcall` (also in pipelines) run through EVAL """
+    fakeredis = pytest.importorskip("fakeredis")
+    pytest.importorskip("lupa")
+    import redis.commands.core
+
+    library = {}
+
+    def function_load(self, code, replace=False):
+        library["script"] = _function_library(code)
+
+    def fcall(self, function, numkeys, *args):
+        return self.eval(library["script"], numkeys, *args[:numkeys], function, *args[numkeys:])
+
+    monkeypatch.setattr(redis.commands.core.FunctionCommands, "function_load", function_load)
+    monkeypatch.setattr(redis.commands.core.FunctionCommands, "fcall", fcall)
+
+    return fakeredis.FakeRedis(decode_responses=True)
+
+@pytest.fixture
+def ips_lua(fake_redis):
+    """ `fake_redis` with ips.lua loaded """
+    from importlib import resources
+
+    fake_redis.function_load((resources.files("firewhale") / "redis" / "ips.lua").read_text(), True)
+    return fake_redis
@@ -0,0 +1,129 @@
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from firewhale.nfbackends import socket as agent_socket
+from firewhale.nfbackends.base import NftError
+from firewhale.nfbackends.socket import AgentConnection
+
+
+class _StubSocket:
+    """ Records what is sent to the agent """
+
+    def __init__(self):
+        self.sent = []
+        self._cond = threading.Condition()
+
+    def send(self, message):
+        with self._cond:
+            self.sent.append(json.loads(message))
+            self._cond.notify_all()
+
+    def wait_sent(self, count: int):
+        with self._cond:
+            assert self._cond.wait_for(lambda: len(self.sent) >= count, timeout=5)
+        return self.sent[:count]
+
+
+def _connection(protocol: int):
+    sock = _StubSocket()
+    conn = AgentConnection(sock)
+    if protocol >= 2:
+        conn.handle_message(json.dumps({ "hello": { "protocol": protocol } }))
+    return conn, sock
+
+def _ok(data, rid=None):
+    return json.dumps({ **({ "id": rid } if rid is not None else {}), "status": "ok", "data": data })
+
+
+def test_responses_are_matched_by_id():
+    conn, sock = _connection(2)
+    with ThreadPoolExecutor(2) as pool:
+        first = pool.submit(conn.request, "list ruleset")
+        second = pool.submit(conn.request, "list table ip filter")
+        requests = sock.wait_sent(2)
+
+        # The agent answers the second request first
+        by_cmd = { r["nfcmd"]: r["id"] for r in requests }
+        conn.handle_message(_ok("filter", by_cmd["list table ip filter"]))
+        conn.handle_message(_ok("ruleset", by_cmd["list ruleset"]))
+
+        assert first.result(timeout=5) == "ruleset"
+        assert second.result(timeout=5) == "filter"
+
+def test_version_1_agents_are_answered_in_order():
+    conn, sock = _connection(1)
+    assert conn.protocol == 1
+    with ThreadPoolExecutor(1) as pool:
+        first = pool.submit(conn.request, "list ruleset")
+        sock.wait_sent(1)
+        second = pool.submit(conn.request, "list table ip filter")
+        conn.handle_message(_ok("ruleset"))
+        assert first.result(timeout=5) == "ruleset"
+
+        sock.wait_sent(2)
+        conn.handle_message(_ok("filter"))
+        assert second.result(timeout=5) == "filter"
+
+def test_error_responses_raise():
+    conn, sock = _connection(2)
+    with ThreadPoolExecutor(1) as pool:
+        request = pool.submit(conn.request, [{ "add": { "table": { "family": "ip", "name": "filter" } } }])
+        rid = sock.wait_sent(1)[0]["id"]
+        conn.handle_message(json.dumps({ "id": rid, "status": "error", "data": "Error: No such file or directory" }))
+
+        with pytest.raises(NftError, match="No such file"):
+            request.result(timeout=5)
+
+
+# === Timeouts ===
+
+@pytest.fixture
+def short_timeout(monkeypatch):
+    monkeypatch.setattr(agent_socket, "command_timeout", lambda cmd: 0.05)
+
+def test_request_times_out_and_its_late_response_is_dropped(short_timeout):
+    conn, sock = _connection(2)
+
+    with pytest.raises(NftError, match="did not respond"):
+        conn.request("list ruleset")
+    late = sock.sent[0]["id"]
+
+    with ThreadPoolExecutor(1) as pool:
+        request = pool.submit(conn.request, "list table ip filter")
+        rid = sock.wait_sent(2)[1]["id"]
+        conn.handle_message(_ok("late", late))
+        conn.handle_message(_ok("filter", rid))
+        assert request.result(timeout=5) == "filter"
+
+def test_version_1_late_response_goes_to_the_timed_out_request(short_timeout, monkeypatch):
+    conn, sock = _connection(1)
+
+    with pytest.raises(NftError):
+        conn.request("list ruleset")
+
+    monkeypatch.setattr(agent_socket, "command_timeout", lambda cmd: 5)
+    with ThreadPoolExecutor(1) as pool:
+        request = pool.submit(conn.request, "list table ip filter")
+        sock.wait_sent(2)
+        # Without IDs the late response can only be told apart by its position
+        conn.handle_message(_ok("late"))
+        time.sleep(0.05)
+        assert not request.done()
+        conn.handle_message(_ok("filter"))
+        assert request.result(timeout=5) == "filter"
+
+def test_pending_requests_fail_when_the_agent_disconnects():
+    conn, sock = _connection(2)
+    with ThreadPoolExecutor(1) as pool:
+        request = pool.submit(conn.request, "list ruleset")
+        sock.wait_sent(1)
+        conn.close()
+
+        with pytest.raises(NftError, match="disconnected"):
+            request.result(timeout=5)
+    with pytest.raises(NftError):
+        conn.request("list ruleset")
@@ -0,0 +1,128 @@
+import json
+
+import pytest
+
+from firewhale.bench.churn import service_labels
+from firewhale.chains import SHARED_CHAIN_PREFIX
+from firewhale.container import Container
+
+
+def _table(env):
+    return env.backend.tables[("ip", "filter")]
+
+def _map(env, name):
+    return { key: data for key, data in _table(env).sets[f"firewhale-{name}"].elements.values() }
+
+def _chains(env, prefix):
+    return [name for name in _table(env).chains if name.startswith(prefix)]
+
+def _ip(env, cid):
+    return env.docker.containers.get(cid).attrs["NetworkSettings"]["Networks"]["app_default"]["IPAddress"]
+
+def _run(env, name, service):
+    cid = env.docker.run(name, labels=service_labels(service), networks=["app_default"])
+    Container(cid).handle_event("start")
+    return cid
+
+def _stop(env, cid):
+    env.docker.stop(cid)
+    Container(cid).handle_event("die")
+
+
+def test_apply_maps_container_ips_to_its_chains(env):
+    Container.shared_chains = False
+    cid = _run(env, "web", "web")
+    ip = _ip(env, cid)
+    prefix = f"firewhale-container-{cid[:16]}"
+
+    assert sorted(_chains(env, prefix)) == [f"{prefix}-inbound", f"{prefix}-outbound"]
+    assert _map(env, "outbound") == { ip: { "jump": { "target": f"{prefix}-outbound" } } }
+    assert _map(env, "inbound") == { ip: { "jump": { "target": f"{prefix}-inbound" } } }
+    # The service peer in the outbound rules
+    assert "firewhale-service:db.app_default:ip" in _table(env).sets
+
+def test_destroy_removes_chains_elements_and_service_sets(env):
+    Container.shared_chains = False
+    cid = _run(env, "web", "web")
+    _stop(env, cid)
+
+    assert _chains(env, "firewhale-container-") == []
+    assert _map(env, "outbound") == {}
+    assert _map(env, "inbound") == {}
+    assert "firewhale-service:db.app_default:ip" not in _table(env).sets
+    assert cid[:16] not in Container.applied_ips
+
+def test_apply_is_idempotent(env):
+    cid = _run(env, "web", "web")
+    before = env.backend.stats.transactions
+    Container(cid).handle_event("start")
+    assert env.backend.stats.transactions == before
+
+def test_disabled_container_gets_no_rules(env):
+    labels = { **service_labels("web"), "firewhale.enabled": "false" }
+    cid = env.docker.run("web", labels=labels, networks=["app_default"])
+    Container(cid).apply_rules()
+    assert _map(env, "outbound") == {}
+
+
+# === Shared chains ===
+
+def test_identical_rules_share_one_chain_pair(env):
+    a = _run(env, "web-1", "web")
+    b = _run(env, "web-2", "web")
+
+    shared = _chains(env, SHARED_CHAIN_PREFIX)
+    assert len(shared) == 2
+    assert _chains(env, "firewhale-container-") == []
+    outbound = _map(env, "outbound")
+    assert outbound[_ip(env, a)] == outbound[_ip(env, b)]
+
+def test_shared_chain_lives_until_its_last_user_dies(env):
+    a = _run(env, "web-1", "web")
+    b = _run(env, "web-2", "web")
+    shared = sorted(_chains(env, SHARED_CHAIN_PREFIX))
+    ip_b = _ip(env, b)
+
+    _stop(env, a)
+    assert sorted(_chains(env, SHARED_CHAIN_PREFIX)) == shared
+    assert list(_map(env, "outbound")) == [ip_b]
+
+    _stop(env, b)
+    assert _chains(env, SHARED_CHAIN_PREFIX) == []
+    assert _map(env, "outbound") == {}
+
+def test_different_rules_get_different_chains(env):
+    a = _run(env, "web", "web")
+    labels = { **service_labels("api"), "firewhale.outbound-rules": json.dumps(["tcp; 1.1.1.1; 443"]) }
+    b = env.docker.run("api", labels=labels, networks=["app_default"])
+    Container(b).handle_event("start")
+
+    outbound = _map(env, "outbound")
+    assert outbound[_ip(env, a)] != outbound[_ip(env, b)]
+    assert len(_chains(env, SHARED_CHAIN_PREFIX)) == 3
+
+
+# === IP reuse ===
+
+@pytest.mark.parametrize("rules", [
+    # Same rules, so B uses the shared chain A installed
+    None,
+    ["tcp; 1.1.1.1; 443"],
+])
+def test_late_die_leaves_a_reused_ip_alone(env, rules):
+    a = _run(env, "web", "web")
+    ip = _ip(env, a)
+    env.docker.stop(a)
+
+    # Docker hands A's IP to B before A's die has been handled
+    labels = service_labels("api")
+    if rules: labels["firewhale.outbound-rules"] = json.dumps(rules)
+    b = env.docker.run("api", labels=labels, networks=["app_default"])
+    Container(b).handle_event("start")
+    assert _ip(env, b) == ip
+    outbound = _map(env, "outbound")
+    Container(a).handle_event("die")
+
+    assert _map(env, "outbound") == outbound
+    assert outbound[ip]["jump"]["target"] in _table(env).chains
+    assert Container.applied_ips[b[:16]] == { ip }
@@ -0,0 +1,105 @@
+import docker.errors
+import pytest
+
+from firewhale.bench.churn import handle_events, service_labels
+from firewhale.container import Container
+from firewhale.dockercache import container_cache
+from firewhale.events import EventCoalescer, effective_actions
+
+
+# === Coalescing ===
+
+@pytest.mark.parametrize("events, actions", [
+    (["create", "start"], ["start"]),
+    (["create", "start", "die", "destroy"], []),
+    (["die", "destroy"], ["die"]),
+    (["die", "start"], ["die", "start"]),
+    (["destroy"], []),
+    # Nothing to do until the container starts and has IPs
+    (["create"], []),
+])
+def test_effective_actions(events, actions):
+    assert effective_actions(events) == actions
+
+def test_destroy_is_passed_on_without_actions():
+    emitted = []
+    coalescer = EventCoalescer(emitted.append, window=0)
+    coalescer.push("c1", "destroy")
+
+    assert [(e.actions, e.destroyed) for e in emitted] == [([], True)]
+
+
+def test_create_and_start_in_separate_windows_apply_once(env, monkeypatch):
+    handled = []
+    handle_event = Container.handle_event
+    monkeypatch.setattr(Container, "handle_event", lambda self, event: (handled.append(event), handle_event(self, event)))
+    stream = env.docker.events()
+
+    cid = env.docker.create("web", labels=service_labels("web"), networks=["app_default"])
+    handle_events(stream.drain())
+    env.docker.start(cid)
+    handle_events(stream.drain())
+
+    assert handled == ["start"]
+    assert env.ipmanager.list_container_ips(cid[:16])
+
+
+# === Container removal ===
+
+def test_die_handled_after_destroy_tears_everything_down(env):
+    stream = env.docker.events()
+    cid = env.docker.run("web", labels=service_labels("web"), networks=["app_default"])
+    handle_events(stream.drain())
+    table = env.backend.tables[("ip", "filter")]
+    assert table.sets["firewhale-outbound"].elements
+    assert env.ipmanager.list_container_ips(cid[:16])
+
+    env.docker.remove(cid)
+    handle_events(stream.drain())
+
+    assert table.sets["firewhale-outbound"].elements == {}
+    assert table.sets["firewhale-inbound"].elements == {}
+    assert not any(name.startswith("firewhale-shared-") for name in table.chains)
+    assert "firewhale-service:db.app_default:ip" not in table.sets
+    assert env.ipmanager.list_container_ips(cid[:16]) == set()
+    assert cid[:16] not in Container.applied_ips
+    # The tombstone is gone once the destroy has been handled
+    with pytest.raises(docker.errors.NotFound):
+        container_cache().get(cid)
+
+def test_destroyed_container_is_readable_until_forgotten(env):
+    cid = env.docker.run("web", labels=service_labels("web"), networks=["app_default"])
+    cache = container_cache()
+    cache.load_all()
+    stream = env.docker.events()
+    env.docker.remove(cid)
+    for event in stream.drain():
+        cache.handle_event(event)
+
+    assert cache.get(cid).id == cid
+    assert cid not in [c.id for c in cache.list(refresh=False)]
+    # A refresh doesn't drop it either
+    cache.load_all()
+    assert cache.get(cid).id == cid
+
+    cache.forget(cid)
+    with pytest.raises(docker.errors.NotFound):
+        cache.get(cid)
+
+def test_churn_leaves_nothing_behind(env):
+    stream = env.docker.events()
+    for i in range(10):
+        env.docker.run(f"web-{i}", labels=service_labels(f"web{i % 3}"), networks=["app_default"])
+    handle_events(stream.drain())
+
+    for i in range(0, 10, 2):
+        env.docker.remove(f"web-{i}")
+    handle_events(stream.drain())
+
+    running = env.docker.containers.list()
+    ips = set(c.attrs["NetworkSettings"]["Networks"]["app_default"]["IPAddress"] for c in running)
+    outbound = env.backend.tables[("ip", "filter")].sets["firewhale-outbound"].elements
+    assert set(key for key, _ in outbound.values()) == ips
+    assert len(env.ipmanager.ips) == len(ips)
+    assert set(c.id for c in container_cache().list(refresh=False)) == set(c.id for c in running)
+    assert len(container_cache()._entries) == len(running)
@@ -0,0 +1,63 @@
+import asyncio
+
+from firewhale.nfbackends.base import NftError
+from firewhale.nfbackends.group import GroupCommitter
+from firewhale.nfbackends.memory import MemoryNFTBackend
+
+
+def _chain(name, verb="add"):
+    return { verb: { "chain": { "family": "ip", "table": "filter", "name": name } } }
+
+def _submit_all(backend, cmds, **kwargs):
+    """ Submits `cmds` at once; returns each one's result or exception, and the committer """
+    committer = GroupCommitter(backend, **kwargs)
+
+    async def main():
+        runner = asyncio.create_task(committer.run())
+        try:
+            return await asyncio.gather(*(committer.submit(cmd) for cmd in cmds), return_exceptions=True)
+        finally:
+            runner.cancel()
+
+    return asyncio.run(main()), committer
+
+
+def test_concurrent_commands_share_one_transaction():
+    backend = MemoryNFTBackend()
+    before = backend.stats.transactions
+
+    results, committer = _submit_all(backend, [_chain(f"c{i}") for i in range(5)], window=0.05)
+
+    assert not any(isinstance(r, Exception) for r in results)
+    assert backend.stats.transactions == before + 1
+    assert committer.stats.batches == 1
+    assert committer.stats.max_batch == 5
+    assert all(f"c{i}" in backend.tables[("ip", "filter")].chains for i in range(5))
+
+def test_batches_are_capped():
+    backend = MemoryNFTBackend()
+
+    _, committer = _submit_all(backend, [_chain(f"c{i}") for i in range(5)], window=0.05, max_batch=2)
+
+    assert committer.stats.batches == 3
+    assert committer.stats.max_batch == 2
+
+def test_listings_run_alone():
+    backend = MemoryNFTBackend()
+
+    results, committer = _submit_all(backend, [_chain("a"), "list chain ip filter DOCKER", _chain("b")], window=0.05)
+
+    assert results[1][-1]["chain"]["name"] == "DOCKER"
+    assert committer.stats.batches == 3
+
+def test_failed_batch_is_retried_per_command_and_errors_go_to_their_caller():
+    backend = MemoryNFTBackend()
+
+    results, committer = _submit_all(backend, [_chain("a"), _chain("missing", "delete"), _chain("b")], window=0.05)
+
+    assert not isinstance(results[0], Exception)
+    assert isinstance(results[1], NftError)
+    assert not isinstance(results[2], Exception)
+    assert committer.stats.fallbacks == 1
+    # The others were committed despite the failed joint transaction
+    assert { "a", "b" } <= set(backend.tables[("ip", "filter")].chains)
@@ -0,0 +1,157 @@
+from threading import RLock
+
+from firewhale.ipmanager.batch import SetUpdateBatcher
+from firewhale.ipmanager.local import IPIndex
+
+
+SVC_SET = "firewhale-service:svc.net:ip"
+
+def _set(env, name=SVC_SET):
+    table = env.backend.tables[("ip", "filter")]
+    if name not in table.sets: return None
+    return set(key for key, _ in table.sets[name].elements.values())
+
+
+# === IPIndex ===
+
+def test_ip_index_lookups():
+    index = IPIndex()
+    index.set("10.0.0.1", "a", "c1")
+    index.set("10.0.0.2", "a", "c2")
+    index.set("10.0.0.3", "b", "c2")
+
+    assert len(index) == 3
+    assert index.get("10.0.0.3") == ("b", "c2")
+    assert index.by_service("a") == { "10.0.0.1", "10.0.0.2" }
+    assert index.by_container("c2") == { "10.0.0.2", "10.0.0.3" }
+    assert index.containers() == { "c1", "c2" }
+
+def test_ip_index_moves_an_ip():
+    index = IPIndex()
+    index.set("10.0.0.1", "a", "c1")
+
+    assert index.set("10.0.0.1", "b", "c2") == ("a", "c1")
+    assert index.by_service("a") == set()
+    assert index.by_container("c1") == set()
+    assert index.by_service("b") == { "10.0.0.1" }
+    assert "c1" not in index.containers()
+
+def test_ip_index_remove():
+    index = IPIndex()
+    index.set("10.0.0.1", "a", "c1")
+
+    assert index.remove("10.0.0.1") == ("a", "c1")
+    assert index.remove("10.0.0.1") is None
+    assert "10.0.0.1" not in index
+    assert index.by_service("a") == set()
+
+
+# === SetUpdateBatcher ===
+
+def _batcher(env):
+    from firewhale.nf import nfc
+    from firewhale.shadow import nf_shadow
+    env.ipmanager.subscribe_service("svc.net", "peer")
+    # As at startup - the batcher only trusts a loaded shadow
+    nf_shadow.ensure_loaded(nfc)
+    return SetUpdateBatcher(RLock(), window=0)
+
+def test_batcher_commits_a_tick_in_one_transaction(env):
+    batcher = _batcher(env)
+    before = env.backend.stats.transactions
+    with batcher.deferred():
+        for i in range(10):
+            batcher.add({ "family": "ip", "table": "filter", "name": SVC_SET }, f"10.0.0.{i}")
+
+    assert env.backend.stats.transactions == before + 1
+    assert len(_set(env)) == 10
+    assert batcher.stats.added == 10
+
+def test_batcher_cancels_an_add_followed_by_a_delete(env):
+    batcher = _batcher(env)
+    spec = { "family": "ip", "table": "filter", "name": SVC_SET }
+    before = env.backend.stats.transactions
+    with batcher.deferred():
+        batcher.add(spec, "10.0.0.1")
+        batcher.delete(spec, "10.0.0.1")
+
+    assert env.backend.stats.transactions == before
+    assert batcher.stats.cancelled == 2
+    assert _set(env) == set()
+
+def test_batcher_skips_updates_the_set_already_has(env):
+    batcher = _batcher(env)
+    spec = { "family": "ip", "table": "filter", "name": SVC_SET }
+    batcher.add(spec, "10.0.0.1")
+    before = env.backend.stats.transactions
+
+    batcher.add(spec, "10.0.0.1")
+    batcher.delete(spec, "10.0.0.2")
+
+    assert env.backend.stats.transactions == before
+    assert _set(env) == { "10.0.0.1" }
+
+def test_batcher_forgets_updates_of_a_dropped_set(env):
+    batcher = _batcher(env)
+    spec = { "family": "ip", "table": "filter", "name": SVC_SET }
+    with batcher.deferred():
+        batcher.add(spec, "10.0.0.1")
+        batcher.drop_set(SVC_SET)
+
+    assert _set(env) == set()
+    assert batcher.stats.cancelled == 1
+
+def test_batcher_version_waits_for_the_commit(env):
+    batcher = _batcher(env)
+    spec = { "family": "ip", "table": "filter", "name": SVC_SET }
+    with batcher.deferred():
+        batcher.add(spec, "10.0.0.1")
+        batcher.advance(5)
+        assert batcher.version == 0
+    assert batcher.version == 5
+
+def test_batcher_applies_the_rest_when_a_commit_fails(env):
+    batcher = _batcher(env)
+    spec = { "family": "ip", "table": "filter", "name": SVC_SET }
+    missing = { "family": "ip", "table": "filter", "name": "firewhale-service:missing:ip" }
+    with batcher.deferred():
+        batcher.add(missing, "10.0.0.1")
+        batcher.add(spec, "10.0.0.2")
+
+    assert batcher.stats.fallbacks == 1
+    assert _set(env) == { "10.0.0.2" }
+
+
+# === LocalSubscriptionManager ===
+
+def test_subscribed_service_set_follows_published_ips(env):
+    manager = env.ipmanager
+    manager.add_service_ips([("svc.net", "10.0.0.1", "c1"), ("svc.net", "10.0.0.2", "c2")])
+    manager.subscribe_service("svc.net", "peer")
+    assert _set(env) == { "10.0.0.1", "10.0.0.2" }
+
+    manager.add_service_ip("svc.net", "10.0.0.3", "c3")
+    manager.del_container_ips("c1")
+    assert _set(env) == { "10.0.0.2", "10.0.0.3" }
+
+def test_ip_moving_between_services_moves_between_sets(env):
+    manager = env.ipmanager
+    manager.subscribe_service("svc.net", "peer")
+    manager.subscribe_service("other.net", "peer")
+
+    manager.add_service_ip("svc.net", "10.0.0.1", "c1")
+    manager.add_service_ip("other.net", "10.0.0.1", "c2")
+
+    assert _set(env) == set()
+    assert _set(env, "firewhale-service:other.net:ip") == { "10.0.0.1" }
+    assert manager.list_container_ips("c1") == set()
+
+def test_unsubscribing_the_last_subscriber_deletes_the_set(env):
+    manager = env.ipmanager
+    manager.subscribe_service("svc.net", "a")
+    manager.subscribe_service("svc.net", "b")
+
+    manager.unsubscribe_all_services("a")
+    assert _set(env) == set()
+    manager.unsubscribe_all_services("b")
+    assert _set(env) is None
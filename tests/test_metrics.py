@@ -0,0 +1,53 @@
+from firewhale import metrics
+from firewhale.metrics import Counter, Gauge, Histogram, Registry
+from firewhale.nf import nfc
+from firewhale.nfbackends import nf_backend_store
+from firewhale.nfbackends.collect import CollectingNFTBackend
+
+
+def test_registry_renders_the_prometheus_text_format():
+    registry = Registry()
+    events = registry.register(Counter("test_events_total", "Events", ("action",)))
+    depth = registry.register(Gauge("test_depth", "Depth"))
+    latency = registry.register(Histogram("test_seconds", "Latency", buckets=(0.1, 1)))
+
+    events.inc(action="start")
+    events.inc(2, action='die "late"')
+    depth.set_function(lambda: 3)
+    latency.observe(0.05)
+    latency.observe(0.5)
+    latency.observe(5)
+
+    assert registry.render() == "\n".join([
+        "# HELP test_events_total Events",
+        "# TYPE test_events_total counter",
+        'test_events_total{action="start"} 1',
+        'test_events_total{action="die \\"late\\""} 2',
+        "# HELP test_depth Depth",
+        "# TYPE test_depth gauge",
+        "test_depth 3",
+        "# HELP test_seconds Latency",
+        "# TYPE test_seconds histogram",
+        'test_seconds_bucket{le="0.1"} 1',
+        'test_seconds_bucket{le="1"} 2',
+        'test_seconds_bucket{le="+Inf"} 3',
+        "test_seconds_sum 5.55",
+        "test_seconds_count 3",
+    ]) + "\n"
+
+def _command_count(backend: str) -> int:
+    value = metrics.nft_command_seconds._values.get((backend,))
+    return value.count if value else 0
+
+def test_collected_commands_are_timed_when_committed(env):
+    collector = CollectingNFTBackend(env.backend)
+    collected, committed = _command_count("collect"), _command_count("memory")
+
+    with nf_backend_store.with_backend(collector):
+        nfc({ "add": { "table": { "family": "ip", "name": "filter" } } })
+        nfc({ "add": { "table": { "family": "ip", "name": "filter" } } })
+    collector.commit()
+
+    assert _command_count("collect") == collected
+    # One transaction for both
+    assert _command_count("memory") == committed + 1
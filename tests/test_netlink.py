@@ -0,0 +1,56 @@
+import socket
+import struct
+
+from firewhale.nfbackends.netlink import (
+    NFT_MSG_NEWSET, NFT_MSG_NEWSETELEM, NFTA_SET_ID, NFTA_SET_NAME,
+    _recv_datagram, encode_batch,
+)
+
+
+def _attrs(body: bytes):
+    """ Top-level attributes of a message body """
+    attrs = {}
+    offset = 0
+    while offset + 4 <= len(body):
+        length, atype = struct.unpack_from("=HH", body, offset)
+        attrs[atype & 0x3fff] = body[offset + 4:offset + length]
+        offset += (length + 3) & ~3
+    return attrs
+
+def _rule(chain: str):
+    return { "add": { "rule": { "family": "ip", "table": "filter", "chain": chain, "expr": [
+        { "match": {
+            "op": "==",
+            "left": { "payload": { "protocol": "th", "field": "dport" } },
+            "right": { "set": [80, 443] },
+        } },
+        { "accept": None },
+    ] } } }
+
+
+def test_anonymous_sets_let_the_kernel_pick_the_name():
+    batches = [encode_batch([_rule("a"), _rule("b")]), encode_batch([_rule("c")])]
+
+    new_sets = [_attrs(m.body) for batch in batches for m in batch if m.type == NFT_MSG_NEWSET]
+    assert len(new_sets) == 3
+    # Names from separate batches must not collide, so none is chosen here
+    assert all(attrs[NFTA_SET_NAME] == b"__set%d\x00" for attrs in new_sets)
+
+def test_anonymous_set_ids_are_unique_within_a_batch():
+    batch = encode_batch([_rule("a"), _rule("b")])
+
+    set_ids = [_attrs(m.body)[NFTA_SET_ID] for m in batch if m.type == NFT_MSG_NEWSET]
+    assert len(set(set_ids)) == 2
+    # Elements are added to the set by its ID
+    assert sum(1 for m in batch if m.type == NFT_MSG_NEWSETELEM) == 2
+
+def test_large_acks_are_read_whole():
+    a, b = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+    with a, b:
+        a.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1 << 20)
+        b.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+        a.send(b"x" * 200000)
+        a.send(b"next")
+
+        assert len(_recv_datagram(b)) == 200000
+        assert _recv_datagram(b) == b"next"
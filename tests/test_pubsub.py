@@ -0,0 +1,69 @@
+import time
+
+import pytest
+
+from firewhale.ipmanager import pubsub
+
+fakeredis = pytest.importorskip("fakeredis")
+
+
+def _wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+@pytest.fixture
+def server(monkeypatch):
+    monkeypatch.setattr(pubsub, "RECONNECT_DELAY_MIN", 0.01)
+    monkeypatch.setattr(pubsub, "RECONNECT_DELAY_MAX", 0.05)
+    monkeypatch.setattr(pubsub, "KEEPALIVE_INTERVAL", 0.1)
+    return fakeredis.FakeServer()
+
+@pytest.fixture
+def listener(server):
+    reconnects = []
+    listener = pubsub.PubSubListener(
+        fakeredis.FakeRedis(server=server, decode_responses=True),
+        wake_channel="wake",
+        on_reconnect=lambda: reconnects.append(True),
+    )
+    listener.reconnects = reconnects
+    yield listener
+    listener.close()
+
+def _publisher(server):
+    return fakeredis.FakeRedis(server=server, decode_responses=True)
+
+
+def test_messages_are_delivered_to_their_handler(server, listener):
+    received = []
+    listener.subscribe("changes:service:web.net", lambda msg: received.append(msg["data"]))
+
+    _publisher(server).publish("changes:service:web.net", "1 10.0.0.1 c1 web.net")
+
+    _wait_for(lambda: received == ["1 10.0.0.1 c1 web.net"])
+
+def test_listener_resubscribes_after_the_connection_drops(server, listener):
+    received = []
+    listener.subscribe("changes:service:web.net", lambda msg: received.append(msg["data"]))
+    listener.psubscribe("changes:service:api*", lambda msg: received.append(msg["data"]))
+    listener.subscribe("changes:service:gone.net", lambda msg: received.append(msg["data"]))
+    listener.unsubscribe("changes:service:gone.net")
+    publisher = _publisher(server)
+    publisher.publish("changes:service:web.net", "1")
+    _wait_for(lambda: received == ["1"])
+
+    server.connected = False
+    time.sleep(0.1)
+    server.connected = True
+
+    _wait_for(lambda: listener.reconnects == [True])
+    publisher.publish("changes:service:gone.net", "2")
+    publisher.publish("changes:service:web.net", "3")
+    publisher.publish("changes:service:api.net", "4")
+    _wait_for(lambda: received == ["1", "3", "4"])
+
+def test_close_stops_the_thread(listener):
+    listener.close()
+    assert not listener.thread.is_alive()
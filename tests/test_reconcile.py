@@ -0,0 +1,129 @@
+import json
+
+from firewhale.bench.churn import populate, service_labels
+from firewhale.chains import SHARED_CHAIN_PREFIX
+from firewhale.container import Container, sync_all_containers
+from firewhale.nfbackends.memory import MemoryNFTBackend
+from firewhale.reconcile import reconcile_all
+from firewhale.shadow import nf_shadow
+
+
+def _table(env):
+    return env.backend.tables[("ip", "filter")]
+
+def _outbound(env):
+    return set(key for key, _ in _table(env).sets["firewhale-outbound"].elements.values())
+
+def _running_ips(env):
+    return set(
+        net["IPAddress"]
+        for c in env.docker.containers.list()
+        for net in c.attrs["NetworkSettings"]["Networks"].values()
+    )
+
+
+def test_reconcile_applies_running_containers_in_one_transaction(env):
+    populate(env, 10)
+    before = env.backend.stats.transactions
+
+    stats = reconcile_all()
+
+    assert stats.containers == 10
+    assert stats.transactions == 1
+    assert env.backend.stats.transactions == before + 1
+    assert _outbound(env) == _running_ips(env)
+
+def test_reconcile_removes_state_of_vanished_containers(env):
+    populate(env, 3)
+    reconcile_all()
+    Container.shared_chains = False
+    gone = env.docker.run("gone", labels=service_labels("gone"), networks=["app_default"])
+    Container(gone).apply_rules()
+    # Removed while Firewhale wasn't looking
+    env.docker.remove(gone)
+
+    stats = reconcile_all()
+
+    # Its IP in the outbound and the inbound map
+    assert stats.stale_elements == 2
+    assert not any(name.startswith(f"firewhale-container-{gone[:16]}") for name in _table(env).chains)
+    assert _outbound(env) == _running_ips(env)
+
+def test_reconcile_removes_unreferenced_shared_chains(env):
+    populate(env, 3)
+    reconcile_all()
+    labels = { **service_labels("lonely"), "firewhale.outbound-rules": json.dumps(["tcp; 1.1.1.1; 443"]) }
+    lonely = env.docker.run("lonely", labels=labels, networks=["app_default"])
+    reconcile_all()
+    chains = len(nf_shadow.chain_names())
+    env.docker.remove(lonely)
+
+    stats = reconcile_all()
+
+    # Only "lonely" had these outbound rules - the inbound chain is shared with the others
+    assert stats.stale_chains == 1
+    assert len(nf_shadow.chain_names()) == chains - 1
+    assert all(name in _table(env).chains for name in nf_shadow.chain_names() if name.startswith(SHARED_CHAIN_PREFIX))
+
+def test_reconcile_is_a_no_op_when_in_sync(env):
+    populate(env, 5)
+    reconcile_all()
+
+    stats = reconcile_all()
+
+    assert stats.stale_chains == 0
+    assert stats.stale_elements == 0
+    assert _outbound(env) == _running_ips(env)
+
+def test_reconcile_chunks_without_splitting_containers(env):
+    populate(env, 20)
+
+    stats = reconcile_all(chunk_size=10)
+
+    assert stats.transactions > 1
+    assert _outbound(env) == _running_ips(env)
+
+
+def test_reconcile_recreates_service_sets_after_a_flush(env):
+    populate(env, 5)
+    sync_all_containers()
+    db_ip = env.docker.containers.get("db").attrs["NetworkSettings"]["Networks"]["app_default"]["IPAddress"]
+    # NFTables was flushed, but the service subscriptions are still known
+    env.backend.tables = MemoryNFTBackend().tables
+
+    stats = reconcile_all()
+
+    assert stats.transactions == 1
+    assert set(key for key, _ in _table(env).sets["firewhale-service:db.app_default:ip"].elements.values()) == { db_ip }
+    assert _outbound(env) == _running_ips(env)
+
+
+# === Rejected transactions ===
+
+def _broken(env):
+    """ A container whose rules NFTables rejects """
+    labels = { **service_labels("broken"), "firewhale.outbound-rules": json.dumps(["tcp; *; 443; chain:missing"]) }
+    return env.docker.run("broken", labels=labels, networks=["app_default"])
+
+def test_reconcile_applies_the_other_containers_if_one_is_rejected(env):
+    populate(env, 5)
+    broken = _broken(env)
+    broken_ip = env.docker.containers.get(broken).attrs["NetworkSettings"]["Networks"]["app_default"]["IPAddress"]
+
+    stats = reconcile_all()
+
+    assert stats.failed == [broken[:16]]
+    assert _outbound(env) == _running_ips(env) - { broken_ip }
+    assert "firewhale-service:db.app_default:ip" in _table(env).sets
+    assert broken[:16] not in Container.applied_ips
+
+def test_reconcile_fallback_keeps_sets_first_subscribed_by_a_rejected_container(env):
+    # The rejected container is the first to subscribe to db, so its transaction had the set
+    broken = _broken(env)
+    populate(env, 3)
+
+    stats = reconcile_all()
+
+    assert stats.failed == [broken[:16]]
+    assert "firewhale-service:db.app_default:ip" in _table(env).sets
+    assert len(_outbound(env)) == 3
@@ -0,0 +1,159 @@
+from firewhale.ipmanager.redis import CHANGES_KEY, VERSION_CHANNEL, VERSION_KEY
+
+
+def set_ip(r, ip, service, cid, node="node1"):
+    return r.fcall("set_ip", 1, ip, service, cid, node)
+
+def changes(r):
+    return [(entry_id, fields) for entry_id, fields in r.xrange(CHANGES_KEY)]
+
+
+def test_set_ip_indexes_the_ip(ips_lua):
+    r = ips_lua
+    assert set_ip(r, "10.0.0.1", "web.net", "c1") == 1
+
+    assert r.hgetall("ip:10.0.0.1") == { "service": "web.net", "container": "c1", "node": "node1" }
+    assert r.smembers("service:web.net:ips") == { "10.0.0.1" }
+    assert r.smembers("container:c1:ips") == { "10.0.0.1" }
+    assert r.smembers("node:node1:ips") == { "10.0.0.1" }
+
+def test_set_ip_unchanged_is_not_a_change(ips_lua):
+    r = ips_lua
+    set_ip(r, "10.0.0.1", "web.net", "c1")
+    assert not set_ip(r, "10.0.0.1", "web.net", "c1")
+    assert r.get(VERSION_KEY) == "1"
+
+def test_set_ip_moves_the_ip(ips_lua):
+    r = ips_lua
+    set_ip(r, "10.0.0.1", "web.net", "c1")
+    set_ip(r, "10.0.0.1", "api.net", "c2", "node2")
+
+    assert r.smembers("service:web.net:ips") == set()
+    assert r.smembers("container:c1:ips") == set()
+    assert r.smembers("node:node1:ips") == set()
+    assert r.smembers("service:api.net:ips") == { "10.0.0.1" }
+
+def test_set_ips_reports_each_change(ips_lua):
+    r = ips_lua
+    set_ip(r, "10.0.0.1", "web.net", "c1")
+
+    changed = r.fcall("set_ips", 2, "10.0.0.1", "10.0.0.2", "node1", "web.net", "c1", "web.net", "c2")
+
+    assert changed == [0, 1]
+    assert r.smembers("service:web.net:ips") == { "10.0.0.1", "10.0.0.2" }
+
+def test_rm_ip_checks_the_expectation(ips_lua):
+    r = ips_lua
+    set_ip(r, "10.0.0.1", "web.net", "c1")
+
+    assert not r.fcall("rm_ip", 1, "10.0.0.1", "container", "c2")
+    assert r.exists("ip:10.0.0.1")
+    assert r.fcall("rm_ip", 1, "10.0.0.1", "container", "c1")
+    assert not r.exists("ip:10.0.0.1")
+    assert r.smembers("service:web.net:ips") == set()
+    assert not r.fcall("rm_ip", 1, "10.0.0.1", "container", "c1")
+
+def test_rm_ips_by_container(ips_lua):
+    r = ips_lua
+    set_ip(r, "10.0.0.1", "web.net", "c1")
+    set_ip(r, "10.0.0.2", "db.net", "c1")
+    set_ip(r, "10.0.0.3", "web.net", "c2")
+
+    removed = r.fcall("rm_ips_by", 1, "c1", "container")
+
+    assert sorted(removed) == ["10.0.0.1", "10.0.0.2"]
+    assert r.smembers("service:web.net:ips") == { "10.0.0.3" }
+
+def test_reconcile_node_removes_ips_of_gone_containers(ips_lua):
+    r = ips_lua
+    set_ip(r, "10.0.0.1", "web.net", "live")
+    set_ip(r, "10.0.0.2", "web.net", "gone")
+    set_ip(r, "10.0.0.3", "web.net", "other", "node2")
+
+    removed, repaired = r.fcall("reconcile_node", 1, "node1", "live")
+
+    assert removed == ["10.0.0.2"]
+    assert repaired == []
+    assert r.smembers("service:web.net:ips") == { "10.0.0.1", "10.0.0.3" }
+
+def test_reconcile_node_repairs_a_stale_node_index(ips_lua):
+    r = ips_lua
+    set_ip(r, "10.0.0.1", "web.net", "c1")
+    # Left behind by an older version that didn't clean up the node index on moves
+    r.hset("ip:10.0.0.1", "node", "node2")
+    r.sadd("node:node2:ips", "10.0.0.1")
+
+    removed, repaired = r.fcall("reconcile_node", 1, "node1")
+
+    assert removed == []
+    assert repaired == ["10.0.0.1"]
+    assert r.smembers("node:node1:ips") == set()
+    assert r.exists("ip:10.0.0.1")
+
+
+# === Change stream ===
+
+def test_every_change_is_versioned_in_the_stream(ips_lua):
+    r = ips_lua
+    set_ip(r, "10.0.0.1", "web.net", "c1")
+    set_ip(r, "10.0.0.1", "api.net", "c1")
+    r.fcall("rm_ip", 1, "10.0.0.1", "container", "c1")
+
+    assert r.get(VERSION_KEY) == "3"
+    assert changes(r) == [
+        ("0-1", { "ip": "10.0.0.1", "service": "web.net", "old": "" }),
+        ("0-2", { "ip": "10.0.0.1", "service": "api.net", "old": "web.net" }),
+        ("0-3", { "ip": "10.0.0.1", "service": "", "old": "api.net" }),
+    ]
+
+def _published(pubsub):
+    messages = []
+    while (msg := pubsub.get_message(timeout=0.1)) is not None:
+        messages.append((msg["channel"], msg["data"]))
+    return messages
+
+def _subscribed(r, *channels):
+    pubsub = r.pubsub()
+    pubsub.subscribe(*channels)
+    while pubsub.get_message(timeout=0.1): pass
+    return pubsub
+
+def test_changes_are_published_with_their_version(ips_lua):
+    r = ips_lua
+    pubsub = _subscribed(r, "changes:service:web.net", "changes:service:api.net")
+
+    set_ip(r, "10.0.0.1", "web.net", "c1")
+    set_ip(r, "10.0.0.1", "api.net", "c1")
+    r.fcall("rm_ip", 1, "10.0.0.1", "container", "c1")
+
+    assert _published(pubsub) == [
+        ("changes:service:web.net", "1 10.0.0.1 c1 web.net"),
+        # The old service hears about the move too
+        ("changes:service:web.net", "2 10.0.0.1 c1 api.net"),
+        ("changes:service:api.net", "2 10.0.0.1 c1 api.net"),
+        ("changes:service:api.net", "3 10.0.0.1 c1 "),
+    ]
+
+def test_older_nodes_still_get_the_bare_ip(ips_lua):
+    r = ips_lua
+    pubsub = _subscribed(r, "service:web.net", "service:api.net")
+
+    set_ip(r, "10.0.0.1", "web.net", "c1")
+    set_ip(r, "10.0.0.1", "api.net", "c1")
+
+    assert _published(pubsub) == [
+        ("service:web.net", "10.0.0.1"),
+        ("service:web.net", "10.0.0.1"),
+        ("service:api.net", "10.0.0.1"),
+    ]
+
+def test_version_checkpoints_are_published(ips_lua):
+    r = ips_lua
+    r.set(VERSION_KEY, 998)
+    pubsub = _subscribed(r, VERSION_CHANNEL)
+
+    set_ip(r, "10.0.0.1", "web.net", "c1")
+    set_ip(r, "10.0.0.2", "web.net", "c1")
+    set_ip(r, "10.0.0.3", "web.net", "c1")
+
+    assert _published(pubsub) == [(VERSION_CHANNEL, "1000")]
@@ -0,0 +1,67 @@
+import pytest
+
+from firewhale.ipmanager.redis import RedisSubscriptionManager
+
+
+SVC_SET = "firewhale-service:web.net:ip"
+
+@pytest.fixture
+def manager(env, ips_lua):
+    manager = RedisSubscriptionManager(ips_lua, "node1", set_batch_window=0)
+    yield manager
+    manager.close()
+
+def _set(env, name=SVC_SET):
+    return set(key for key, _ in env.backend.tables[("ip", "filter")].sets[name].elements.values())
+
+
+def test_published_ips_are_listed_by_container_and_service(manager):
+    manager.add_service_ips([("web.net", "10.0.0.1", "c1"), ("web.net", "10.0.0.2", "c1")])
+
+    assert manager.list_container_ips("c1") == { "10.0.0.1", "10.0.0.2" }
+    assert manager.list_service_ips("web.net") == { "10.0.0.1", "10.0.0.2" }
+
+    manager.del_container_ips("c1")
+    assert manager.list_container_ips("c1") == set()
+
+def test_service_cache_follows_change_messages(env, manager):
+    manager.subscribe_service("web.net", "peer")
+    assert manager.list_service_ips("web.net") == set()
+
+    manager._handle_service_message({ "channel": "changes:service:web.net", "data": "1 10.0.0.1 c1 web.net" })
+    lookups = manager.service_ips_cache.stats.hits
+    assert manager.list_service_ips("web.net") == { "10.0.0.1" }
+    assert manager.service_ips_cache.stats.hits == lookups + 1
+    assert _set(env) == { "10.0.0.1" }
+
+    manager._handle_service_message({ "channel": "changes:service:web.net", "data": "2 10.0.0.1 c1 " })
+    assert manager.list_service_ips("web.net") == set()
+    assert _set(env) == set()
+
+def test_reconcile_forgets_ips_of_gone_containers(env, manager):
+    env.docker.run("web", networks=["app_default"])
+    manager.add_service_ips([("web.net", "10.0.0.1", "gone"), ("web.net", "10.0.0.2", "gone")])
+
+    manager.del_unknown_ips()
+
+    assert manager.list_service_ips("web.net") == set()
+    assert manager.list_container_ips("gone") == set()
+
+def test_quiet_services_keep_the_version_moving(manager):
+    manager.subscribe_service("web.net", "peer")
+
+    manager._handle_version_message({ "channel": "firewhale:version-checkpoint", "data": "1000" })
+
+    assert manager.set_updates.version == 1000
+
+def test_pattern_subscription_advances_on_unsubscribed_services(env, ips_lua):
+    manager = RedisSubscriptionManager(ips_lua, "node1", pattern_subscribe=True, set_batch_window=0)
+    try:
+        manager.subscribe_service("web.net", "peer")
+
+        manager._handle_service_message({ "channel": "changes:service:api.net", "data": "7 10.0.0.9 c9 api.net" })
+
+        assert manager.set_updates.version == 7
+        assert _set(env) == set()
+    finally:
+        manager.close()
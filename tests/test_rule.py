@@ -0,0 +1,178 @@
+import pytest
+
+from firewhale.container import Container
+from firewhale.rule import compact_nft_rules, make_nft_rule, normalize_rule
+
+
+@pytest.fixture
+def container(env):
+    labels = { "com.docker.compose.project": "app", "com.docker.compose.service": "web" }
+    return Container(env.docker.run("web", labels=labels, networks=["app_default"]))
+
+def compile(container, rule, *, addr_type="daddr", services=None):
+    return make_nft_rule(
+        normalize_rule(rule), container,
+        addr_type=addr_type,
+        referenced_services=services if services is not None else set(),
+    )["expr"]
+
+def match(left, right, op="=="):
+    return { "match": { "op": op, "left": { "payload": left }, "right": right } }
+
+PROTO = { "protocol": "ip", "field": "protocol" }
+DADDR = { "protocol": "ip", "field": "daddr" }
+DPORT = { "protocol": "th", "field": "dport" }
+
+
+# === Parsing ===
+
+def test_normalize_rule_string():
+    assert normalize_rule("tcp; caddy.caddy; 80; src_port:8000-9000; chain:xyz") == {
+        "proto": "tcp",
+        "peer": "caddy.caddy",
+        "dst_port": "80",
+        "src_port": "8000-9000",
+        "chain": "xyz",
+    }
+
+def test_normalize_rule_aliases():
+    assert normalize_rule({ "peer": "*", "dport": 80, "sport": 1000 }) == { "peer": "*", "dst_port": 80, "src_port": 1000 }
+
+def test_normalize_rule_rejects_empty_key_value():
+    with pytest.raises(ValueError):
+        normalize_rule("tcp; *; chain:")
+
+
+# === Linear compilation ===
+
+def test_any_peer_any_protocol(container):
+    assert compile(container, "*") == [
+        match(PROTO, { "set": ["tcp", "udp"] }),
+        { "return": None },
+    ]
+
+def test_cidr_peer_and_port(container):
+    assert compile(container, "tcp; 10.0.0.0/8; 443") == [
+        match(PROTO, "tcp"),
+        match(DADDR, { "prefix": { "addr": "10.0.0.0", "len": 8 } }),
+        match(DPORT, 443),
+        { "return": None },
+    ]
+
+def test_inbound_rules_match_the_source_address(container):
+    expr = compile(container, "tcp; 10.0.0.0/8", addr_type="saddr")
+    assert expr[1] == match({ "protocol": "ip", "field": "saddr" }, { "prefix": { "addr": "10.0.0.0", "len": 8 } })
+
+def test_ip_range_peer(container):
+    assert compile(container, "udp; 10.0.0.1 - 10.0.0.9")[1] == match(DADDR, { "range": ["10.0.0.1", "10.0.0.9"] })
+
+def test_negated_peer(container):
+    assert compile(container, "tcp; !10.0.0.0/8")[1] == match(DADDR, { "prefix": { "addr": "10.0.0.0", "len": 8 } }, op="!=")
+
+def test_network_peer_matches_its_subnet(container):
+    assert compile(container, "tcp; *.default")[1] == match(DADDR, { "prefix": { "addr": "10.1.0.0", "len": 16 } })
+
+def test_unknown_network_peer_raises(container):
+    with pytest.raises(ValueError):
+        compile(container, "tcp; *.nope")
+
+def test_service_peer_references_its_set(container):
+    services = set()
+    expr = compile(container, "tcp; db.default; 5432", services=services)
+    assert expr[1] == match(DADDR, "@firewhale-service:db.app_default:ip")
+    assert services == { "db.app_default" }
+
+def test_service_peer_with_namespace(container):
+    services = set()
+    compile(container, "tcp; other:db.default", services=services)
+    assert services == { "other_db.app_default" }
+
+def test_statements(container):
+    expr = compile(container, { "peer": "*", "src_port": "1000", "counter": True, "log_prefix": "fw ", "chain": "custom" })
+    assert expr[1:] == [
+        match({ "protocol": "th", "field": "sport" }, 1000),
+        { "counter": None },
+        { "log": { "prefix": "fw ", "level": "info" } },
+        { "goto": { "target": "custom" } },
+    ]
+
+def test_compiled_rules_are_cached(container):
+    from firewhale.rule import rule_cache
+    compile(container, "tcp; 10.0.0.0/8; 443")
+    hits = rule_cache.stats.hits
+    compile(container, "tcp; 10.0.0.0/8; 443")
+    assert rule_cache.stats.hits == hits + 1
+
+
+
+# === Regressions ===
+
+def test_dst_port_matches_the_destination_port(container):
+    assert compile(container, { "proto": "tcp", "peer": "*", "dst_port": "443" }) == [
+        match(PROTO, "tcp"),
+        match(DPORT, 443),
+        { "return": None },
+    ]
+
+def test_dst_port_also_matches_udp(container):
+    # Transport header, not tcp - a tcp payload match would never match a udp packet
+    assert compile(container, "udp; *; 53")[1] == match(DPORT, 53)
+
+def test_plain_ip_peer(container):
+    assert compile(container, "udp; 1.1.1.1; 53") == [
+        match(PROTO, "udp"),
+        match(DADDR, "1.1.1.1"),
+        match(DPORT, 53),
+        { "return": None },
+    ]
+
+LOCAL_NETWORKS = { "set": [
+    { "prefix": { "addr": "10.0.0.0", "len": 8 } },
+    { "prefix": { "addr": "192.168.0.0", "len": 16 } },
+    { "prefix": { "addr": "172.16.0.0", "len": 12 } },
+] }
+
+def test_local_networks_is_any_of_the_private_ranges(container):
+    assert compile(container, "tcp; local-networks") == [
+        match(PROTO, "tcp"),
+        match(DADDR, LOCAL_NETWORKS),
+        { "return": None },
+    ]
+
+def test_internet_is_none_of_the_private_ranges(container):
+    assert compile(container, "tcp; internet") == [
+        match(PROTO, "tcp"),
+        match(DADDR, LOCAL_NETWORKS, op="!="),
+        { "return": None },
+    ]
+
+@pytest.mark.parametrize("port, right", [
+    ("8000-9000", { "range": [8000, 9000] }),
+    ("80,443", { "set": [80, 443] }),
+    ("80, 8000-9000", { "set": [80, { "range": [8000, 9000] }] }),
+    (8080, 8080),
+])
+def test_port_ranges_and_lists_are_numeric(container, port, right):
+    assert compile(container, { "proto": "tcp", "peer": "*", "dst_port": port })[1] == match(DPORT, right)
+
+@pytest.mark.parametrize("peer", ["foo", "10.0.0", "10.0.0.0/", "db.default.extra"])
+def test_unknown_peer_raises(container, peer):
+    with pytest.raises(ValueError):
+        compile(container, { "proto": "tcp", "peer": peer })
+
+def test_invalid_port_raises(container):
+    with pytest.raises(ValueError):
+        compile(container, { "proto": "tcp", "peer": "*", "dst_port": "http" })
+
+
+# === Compaction ===
+
+def test_compaction_merges_neighbouring_rules_with_the_same_verdict(container):
+    rules = [make_nft_rule(normalize_rule(r), container, addr_type="daddr") for r in ["tcp; 10.0.0.0/8; 443", "udp; 1.1.1.1; 53"]]
+    compacted = compact_nft_rules(rules, addr_type="daddr")
+    assert len(compacted) == 1
+    assert compacted[0]["expr"][-1] == { "return": None }
+
+def test_compaction_keeps_service_peers_linear(container):
+    rules = [make_nft_rule(normalize_rule(r), container, addr_type="daddr") for r in ["tcp; db.default", "udp; 1.1.1.1; 53"]]
+    assert compact_nft_rules(rules, addr_type="daddr") == rules
@@ -0,0 +1,70 @@
+import asyncio
+from types import SimpleNamespace
+
+from firewhale.serve import QItem, run_async_loop
+
+
+def _run_loop(items, process_docker_event, handle_control_item=lambda qitem: None, **kwargs):
+    async def main():
+        q = asyncio.Queue()
+        for item in items:
+            q.put_nowait(item)
+        await run_async_loop(q, process_docker_event, handle_control_item, **kwargs)
+        return q.qsize()
+    return asyncio.run(main())
+
+def _event(cid, action):
+    return QItem("docker", SimpleNamespace(container_id=cid, action=action))
+
+
+def test_events_of_one_container_run_in_order_and_are_drained_on_stop():
+    handled = []
+
+    async def process(event):
+        # The first event of each container is the slowest
+        await asyncio.sleep(0.02 if event.action == "start" else 0)
+        handled.append((event.container_id, event.action))
+
+    _run_loop([_event("a", "start"), _event("b", "start"), _event("a", "die"), QItem("stop", None)], process)
+
+    assert sorted(handled) == [("a", "die"), ("a", "start"), ("b", "start")]
+    assert handled.index(("a", "start")) < handled.index(("a", "die"))
+
+def test_stop_ends_the_loop():
+    handled = []
+
+    async def process(event):
+        handled.append(event.action)
+
+    left = _run_loop([_event("a", "start"), QItem("stop", None), _event("a", "die")], process)
+
+    assert handled == ["start"]
+    assert left == 1
+
+def test_control_items_wait_for_container_events():
+    handled = []
+
+    async def process(event):
+        await asyncio.sleep(0.02)
+        handled.append(event.action)
+
+    _run_loop([_event("a", "start"), _event("b", "start"), QItem("shadow", "verify"), QItem("stop", None)],
+              process, lambda qitem: handled.append(qitem.data))
+
+    assert handled == ["start", "start", "verify"]
+
+def test_handler_errors_dont_stop_the_loop():
+    handled = []
+
+    async def process(event):
+        if event.action == "start":
+            raise RuntimeError("boom")
+        handled.append(event.action)
+
+    def control(qitem):
+        raise RuntimeError("boom")
+
+    _run_loop([_event("a", "start"), _event("a", "die"), QItem("gc", "sweep"), _event("b", "die"), QItem("stop", None)],
+              process, control)
+
+    assert handled == ["die", "die"]
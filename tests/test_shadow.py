@@ -0,0 +1,38 @@
+from firewhale.bench.churn import service_labels
+from firewhale.container import Container
+from firewhale.nf import nfc
+from firewhale.shadow import nf_shadow
+
+
+# A chain left behind by a container Firewhale never heard about
+STRAY = "firewhale-container-0123456789abcdef-outbound"
+
+
+def _outbound(env):
+    return set(key for key, _ in env.backend.tables[("ip", "filter")].sets["firewhale-outbound"].elements.values())
+
+
+def test_shadow_follows_committed_commands(env):
+    cid = env.docker.run("web", labels=service_labels("web"), networks=["app_default"])
+    Container(cid).apply_rules()
+
+    assert set(nf_shadow.get_map_elements("firewhale-outbound")) == _outbound(env)
+    assert nf_shadow.verify(nfc) == 0
+
+def test_verify_detects_drift_and_resyncs(env):
+    cid = env.docker.run("web", labels=service_labels("web"), networks=["app_default"])
+    Container(cid).apply_rules()
+    ip = next(iter(_outbound(env)))
+    # Changed behind Firewhale's back
+    env.backend.cmd({ "delete": { "element": { "family": "ip", "table": "filter", "name": "firewhale-outbound", "elem": [ip] } } })
+    env.backend.cmd({ "add": { "chain": { "family": "ip", "table": "filter", "name": STRAY } } })
+    assert ip in nf_shadow.get_map_elements("firewhale-outbound")
+
+    assert nf_shadow.verify(nfc) == 2
+
+    assert ip not in nf_shadow.get_map_elements("firewhale-outbound")
+    assert nf_shadow.has_chain(STRAY)
+    assert nf_shadow.verify(nfc) == 0
+    # With the shadow in sync again, the next apply puts the element back
+    Container(cid).apply_rules()
+    assert ip in _outbound(env)
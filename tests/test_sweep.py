@@ -0,0 +1,96 @@
+from firewhale.bench.churn import service_labels
+from firewhale.container import Container
+from firewhale.dockercache import container_cache
+from firewhale.shadow import nf_shadow
+from firewhale.sweep import GarbageCollector
+
+
+def _vanish(env, count):
+    """ Starts `count` containers with chains of their own, then removes them without Firewhale seeing the events """
+    Container.shared_chains = False
+    keep = env.docker.run("keep", labels=service_labels("keep"), networks=["app_default"])
+    Container(keep).apply_rules()
+    gone = []
+    for i in range(count):
+        cid = env.docker.run(f"gone-{i}", labels=service_labels("gone"), networks=["app_default"])
+        Container(cid).apply_rules()
+        gone.append(cid)
+    for cid in gone:
+        env.docker.remove(cid)
+    container_cache().load_all()
+    return keep, gone
+
+def _chains_of(cid):
+    return nf_shadow.chains_for_container(cid[:16])
+
+
+def test_objects_are_collected_once_they_have_aged(env):
+    keep, gone = _vanish(env, 3)
+    gc = GarbageCollector(min_age=1)
+
+    assert gc.sweep() == 0
+    assert all(_chains_of(cid) for cid in gone)
+
+    assert gc.sweep() == 3
+    assert not any(_chains_of(cid) for cid in gone)
+    assert _chains_of(keep)
+    assert gc.stats.chains == 6
+    assert gc.stats.elements == 6
+
+def test_reused_ip_is_not_collected(env):
+    Container.shared_chains = False
+    old = env.docker.run("old", labels=service_labels("web"), networks=["app_default"])
+    Container(old).apply_rules()
+    env.docker.remove(old)
+    container_cache().load_all()
+    gc = GarbageCollector(min_age=1)
+    gc.sweep()
+
+    # Gets the IP the old container had, before its objects are ripe
+    new = env.docker.run("new", labels=service_labels("web"), networks=["app_default"])
+    Container(new).apply_rules()
+    container_cache().load_all()
+    ip = env.docker.containers.get(new).attrs["NetworkSettings"]["Networks"]["app_default"]["IPAddress"]
+
+    # Moving the IP already released the old container's chains
+    assert gc.sweep() == 0
+    assert not _chains_of(old)
+    assert nf_shadow.get_map_elements("firewhale-outbound")[ip] == { "jump": { "target": f"firewhale-container-{new[:16]}-outbound" } }
+
+def test_budget_spreads_a_backlog_over_sweeps(env):
+    _, gone = _vanish(env, 10)
+    # A vanished container is 6 commands: its elements in both maps, and a flush and delete per chain
+    gc = GarbageCollector(budget=12, min_age=0)
+
+    assert gc.sweep() == 2
+    assert gc.stats.backlog == 8
+    assert gc.stats.transactions == 1
+
+    while gc.stats.backlog:
+        gc.sweep()
+    assert not any(_chains_of(cid) for cid in gone)
+
+def test_a_unit_is_never_split(env):
+    _, gone = _vanish(env, 1)
+    gc = GarbageCollector(budget=1, min_age=0)
+
+    assert gc.sweep() == 1
+    assert not _chains_of(gone[0])
+
+def test_full_sweep_ignores_age_and_budget(env):
+    _, gone = _vanish(env, 10)
+    gc = GarbageCollector(budget=4, min_age=5)
+
+    assert gc.sweep(full=True) == 10
+    assert gc.stats.backlog == 0
+    assert not any(_chains_of(cid) for cid in gone)
+
+def test_unsubscribed_service_sets_are_collected(env):
+    env.ipmanager.subscribe_service("svc.net", "peer")
+    env.ipmanager.service_subscriptions.remove("svc.net", "peer")
+    gc = GarbageCollector(min_age=0)
+
+    gc.sweep()
+
+    assert "firewhale-service:svc.net:ip" not in env.backend.tables[("ip", "filter")].sets
+    assert gc.stats.sets == 1
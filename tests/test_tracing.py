@@ -0,0 +1,107 @@
+import importlib.util
+import sys
+
+import pytest
+
+from firewhale import tracing
+from firewhale.bench.churn import service_labels
+from firewhale.container import Container
+
+
+def _load_without_opentelemetry(monkeypatch):
+    """ A separate copy of the tracing module, imported as if the tracing extra wasn't installed """
+    for name in [m for m in sys.modules if m.startswith("opentelemetry.")] + ["opentelemetry"]:
+        monkeypatch.setitem(sys.modules, name, None)
+    spec = importlib.util.spec_from_file_location("firewhale_tracing_without_otel", tracing.__file__)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+# === Disabled ===
+
+def test_helpers_are_no_ops_until_set_up():
+    @tracing.traced("fn")
+    def fn(x):
+        return x * 2
+
+    assert tracing.tracer is None
+    with tracing.span("nothing", links=[None]) as s:
+        assert s is None
+    assert fn(2) == 4
+    assert tracing.start_span("root") is None
+    assert tracing.current_span() is None
+    assert tracing.inject() is None
+    with tracing.use_span(None), tracing.remote_span("remote", { "traceparent": "x" }) as s:
+        assert s is None
+
+def test_everything_is_a_no_op_without_the_tracing_extra(monkeypatch):
+    module = _load_without_opentelemetry(monkeypatch)
+
+    assert module.trace is None
+    with module.span("nothing"):
+        pass
+    assert module.traced("fn")(lambda: 1)() == 1
+    assert module.inject() is None
+    with pytest.raises(RuntimeError, match="tracing"):
+        module.setup_tracing("file:/dev/null")
+
+
+# === Enabled ===
+
+@pytest.fixture
+def spans(monkeypatch):
+    sdk_trace = pytest.importorskip("opentelemetry.sdk.trace")
+    from opentelemetry.sdk.trace.export import SimpleSpanProcessor
+    from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+
+    exporter = InMemorySpanExporter()
+    provider = sdk_trace.TracerProvider()
+    provider.add_span_processor(SimpleSpanProcessor(exporter))
+    monkeypatch.setattr(tracing, "tracer", provider.get_tracer("test"))
+    return exporter.get_finished_spans
+
+def test_nested_spans_share_the_trace(spans):
+    @tracing.traced("inner")
+    def inner():
+        return tracing.current_span()
+
+    with tracing.span("outer", action="start"):
+        current = inner()
+
+    inner_span, outer_span = spans()
+    assert (inner_span.name, outer_span.name) == ("inner", "outer")
+    assert inner_span.parent.span_id == outer_span.context.span_id
+    assert current.get_span_context().span_id == inner_span.context.span_id
+    assert outer_span.attributes["action"] == "start"
+
+def test_span_started_on_one_thread_is_continued_on_another(spans):
+    root = tracing.start_span("docker.event", attributes={ "container": "c1" })
+    with tracing.use_span(root), tracing.span("apply"):
+        pass
+    root.end()
+
+    apply_span, root_span = spans()
+    assert apply_span.parent.span_id == root_span.context.span_id
+    assert root_span.parent is None
+
+def test_trace_context_is_propagated_to_the_agent(spans):
+    with tracing.span("request"):
+        carrier = tracing.inject()
+    with tracing.remote_span("agent.cmd", carrier, requests=1):
+        pass
+
+    request, agent = spans()
+    assert "traceparent" in carrier
+    assert agent.context.trace_id == request.context.trace_id
+    assert agent.parent.span_id == request.context.span_id
+
+def test_container_events_are_traced(env, spans):
+    cid = env.docker.run("web", labels=service_labels("web"), networks=["app_default"])
+
+    with tracing.span("docker.event"):
+        Container(cid).handle_event("start")
+
+    names = [s.name for s in spans()]
+    assert names[-1] == "docker.event"
+    assert "IPSetManager.subscribe_service" in names
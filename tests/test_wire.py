@@ -0,0 +1,89 @@
+import json
+from concurrent.futures import Future
+
+import pytest
+
+from firewhale.nfbackends import wire
+from firewhale.nfbackends.socket import AgentConnection
+
+msgpack = pytest.importorskip("msgpack")
+pytest.importorskip("zstandard")
+
+
+RULESET = { "nftables": [
+    { "add": { "element": { "family": "ip", "table": "filter", "name": "firewhale-outbound", "elem": [
+        [f"10.0.{i // 256}.{i % 256}", { "jump": { "target": f"firewhale-shared-{i:016x}-outbound" } }]
+        for i in range(500)
+    ] } } },
+] }
+
+
+@pytest.mark.parametrize("encoding", ["json", "msgpack", "msgpack+zstd"])
+@pytest.mark.parametrize("message", [{ "id": 1, "status": "ok", "data": "" }, RULESET])
+def test_round_trip(encoding, message):
+    assert wire.decode(wire.encode(message, encoding)) == message
+
+def test_frames_are_tagged_with_their_encoding():
+    small = { "id": 1, "nfcmd": "list ruleset", "throw": True }
+
+    assert isinstance(wire.encode(small, "json"), str)
+    assert wire.encode(small, "msgpack")[:1] == wire.TAG_MSGPACK
+    # Not worth compressing
+    assert wire.encode(small, "msgpack+zstd")[:1] == wire.TAG_MSGPACK
+    large = wire.encode(RULESET, "msgpack+zstd")
+    assert large[:1] == wire.TAG_MSGPACK_ZSTD
+    assert len(large) < len(wire.encode(RULESET, "msgpack"))
+
+def test_unknown_frame_tag_raises():
+    with pytest.raises(ValueError):
+        wire.decode(b"x" + msgpack.packb({}))
+
+
+# === Negotiation ===
+
+def test_best_common_encoding_is_chosen():
+    assert wire.choose_encoding(["msgpack+zstd", "msgpack", "json"]) == "msgpack+zstd"
+    assert wire.choose_encoding(["brotli", "msgpack"]) == "msgpack"
+    assert wire.choose_encoding(None) == "json"
+
+def test_negotiation_downgrades_without_the_compact_extra(monkeypatch):
+    monkeypatch.setattr(wire, "zstandard", None)
+    assert wire.available_encodings() == ["msgpack", "json"]
+    assert wire.choose_encoding(["msgpack+zstd", "msgpack", "json"]) == "msgpack"
+
+    monkeypatch.setattr(wire, "msgpack", None)
+    assert wire.available_encodings() == ["json"]
+    assert wire.choose_encoding(["msgpack+zstd", "msgpack", "json"]) == "json"
+
+
+class _StubSocket:
+    def __init__(self):
+        self.sent = []
+
+    def send(self, message):
+        self.sent.append(message)
+
+def test_agent_connection_switches_to_the_encoding_the_agent_chose():
+    sock = _StubSocket()
+    conn = AgentConnection(sock)
+    conn.hello()
+    assert json.loads(sock.sent[0])["hello"]["encodings"] == wire.available_encodings()
+
+    conn.handle_message(json.dumps({ "hello": { "protocol": 3, "encoding": "msgpack" } }))
+
+    assert conn.encoding == "msgpack"
+    # A response still sent as JSON text (eg by an older agent) is recognised as such
+    conn._pending[1] = future = Future()
+    conn.handle_message(json.dumps({ "id": 1, "status": "ok", "data": "" }))
+    assert future.result(timeout=1)["status"] == "ok"
+
+@pytest.mark.parametrize("hello", [
+    # Version 2 agents don't know about encodings
+    { "protocol": 2 },
+    # Offered an encoding this side can't speak
+    { "protocol": 3, "encoding": "brotli" },
+])
+def test_agent_connection_falls_back_to_json(hello):
+    conn = AgentConnection(_StubSocket())
+    conn.handle_message(json.dumps({ "hello": hello }))
+    assert conn.encoding == "json"